@@ -4,6 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from seed import SeedDb
 from shared.db.db_engine import init_db, SessionLocal
+from shared.utils.executors import shutdown_pools
 from routers.auth import router as router_auth
 from routers.job import router as router_job
 from routers.media import router as router_media
@@ -40,6 +41,11 @@ async def startup():
             await seeder.seed_api_keys()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    shutdown_pools()
+
+
 @app.get("/")
 async def api_welcome():
     return {"message": "Hello, bienvenido a Tablemind API!"}
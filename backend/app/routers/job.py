@@ -2,7 +2,7 @@ import os
 import uuid
 import logging
 import pandas as pd
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from datetime import datetime
 
 from fastapi import APIRouter, Depends, Query, HTTPException, Header, Response
@@ -16,6 +16,7 @@ from shared.db.db_engine import get_db
 from shared.auth.auth import get_current_user, CurrentUser
 from shared.models.job import GranularityLevel, JobStatus
 
+from shared.schemas.generic import ResponseMessage
 from shared.schemas.job import ResponseJob, FormParams, QueryParams, ResponseJobStatus
 from shared.handlers.job import JobHandler
 
@@ -26,6 +27,10 @@ HOST_REDS = os.getenv("HOST_REDS", "redis")
 REDIS_URL_BROKER = f"redis://{HOST_REDS}:6379/0"
 REDIS_URL_BACKEND = f"redis://{HOST_REDS}:6379/1"
 
+# Seconds before the partial results of a cancelled job are first assembled; the
+# finalize task waits on its own for chunks that are still running
+JOB_CANCEL_FINALIZE_DELAY = int(os.getenv("JOB_CANCEL_FINALIZE_DELAY", "5"))
+
 
 router = APIRouter(tags=["Jobs"], prefix = '/job')
 dispatcher = Celery(
@@ -59,6 +64,10 @@ async def estimate_job(
 async def start_job(
     form_params: FormParams = Depends(FormParams.as_form),
     query_params: QueryParams = Depends(QueryParams.as_query),
+    use_cache: bool = Query(True, description="Reuse cached answers for rows seen before; disable for non-deterministic prompts"),
+    time_budget: Optional[int] = Query(None, ge=1, description="Wall-clock seconds the job may run; rows not reached by then are left out of the results"),
+    cost_cap: Optional[int] = Query(None, ge=0, description="Token cost in cents at which the job stops with partial results; defaults to the user tier's cap"),
+    estimate_id: Optional[str] = Query(None, description="estimate_id returned by /job/estimate; its estimate is reused instead of counting tokens again"),
     db: AsyncSession = Depends(get_db),
     current_user: CurrentUser = Depends(get_current_user)
 ):
@@ -74,13 +83,14 @@ async def start_job(
         granularity=GranularityLevel[query_params.granularity],
         verbosity=query_params.verbosity,
         chunk_size=query_params.chunk_size,
+        estimate_id=estimate_id,
     )
 
     # Create the actual job and store it - JobCreate now uses data from EstimateJob
-    job = await job_handler.JobCreate()
+    job = await job_handler.JobCreate(cache_responses=use_cache, time_budget=time_budget, cost_cap=cost_cap)
 
     # Queue the job for processing
-    task = dispatcher.send_task('workers.process_job', args=[str(job.job_id)])
+    task = dispatcher.send_task('workers.process_job', args=[str(job.job_id)], task_id=job.task_id)
 
     # Create a complete response with task info
     return ResponseJob(
@@ -95,6 +105,12 @@ async def start_job(
         cost_per_1m_output=job.cost_per_1m_output,
         handling_fee=job.handling_fee,
         estimated_cost=job.estimated_cost,
+        estimated_input_tokens_low=job.estimated_input_tokens_low,
+        estimated_input_tokens_high=job.estimated_input_tokens_high,
+        estimated_cost_low=job.estimated_cost_low,
+        estimated_cost_high=job.estimated_cost_high,
+        estimate_id=job.estimate_id,
+        cost_cap=job.cost_cap,
         job_status=job.job_status,
         created_at=job.created_at,
         completed_at=job.completed_at,
@@ -103,6 +119,22 @@ async def start_job(
     )
 
 
+@router.post("/cancel", response_model=ResponseMessage)
+async def cancel_job(
+    job_id: uuid.UUID = Query(..., description="Job ID"),
+    db: AsyncSession = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    """Stop a job: its queued tasks are revoked and running chunks stop before their next request"""
+    job_handler = JobHandler(db=db, current_user=current_user)
+    task_ids = await job_handler.JobCancel(job_id)
+    if task_ids:
+        dispatcher.control.revoke(task_ids)
+    # Revoked chunks never complete the chord, so the rows answered so far are assembled here
+    dispatcher.send_task('workers.finalize_job', args=[[], str(job_id)], countdown=JOB_CANCEL_FINALIZE_DELAY)
+    return ResponseMessage(message=f"Job {job_id} cancelado")
+
+
 @router.get("/status", response_model=ResponseJobStatus)
 async def check_job_status(
     job_id: uuid.UUID = Query(..., description="Job ID"),
@@ -137,6 +169,14 @@ async def check_job_status(
             chunks_completed=chunks_stats.get("completed", 0),
             chunks_in_progress=chunks_stats.get("in_progress", 0),
             chunks_failed=chunks_stats.get("failed", 0),
+            rows_total=chunks_stats.get("rows_total", 0),
+            rows_unique=chunks_stats.get("rows_unique", 0),
+            dedup_ratio=chunks_stats.get("dedup_ratio", 0.0),
+            stop_reason=job.stop_reason,
+            deadline_at=job.deadline_at,
+            input_tokens_used=job.input_tokens_used,
+            output_tokens_used=job.output_tokens_used,
+            actual_cost=job.actual_cost,
             created_at=created_at,
             completed_at=completed_at
         )
@@ -512,6 +552,7 @@ async def diagnose_job(
                 "output_data_type": str(type(chunk.output_data)) if hasattr(chunk, "output_data") else "None",
                 "source_data_len": len(chunk.source_data) if hasattr(chunk, "source_data") and chunk.source_data else 0,
                 "output_data_len": len(chunk.output_data) if hasattr(chunk, "output_data") and chunk.output_data else 0,
+                "diagnostics": chunk.diagnostics,
             }
 
             # Sample data (first item) if available
@@ -539,6 +580,10 @@ async def diagnose_job(
             "chunks_count": len(chunks),
             "chunks_with_output": sum(1 for c in chunks if hasattr(c, "output_data") and c.output_data),
             "chunks_finished": sum(1 for c in chunks if c.status == JobStatus.FINISHED),
+            "retries": {
+                name: sum((c.diagnostics or {}).get(name, 0) for c in chunks)
+                for name in ("calls", "retries", "transient_errors", "circuit_open")
+            },
             "chunks_analysis": chunks_analysis,
         }
 
@@ -9,7 +9,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.utils.auth import PasswordService
 from shared.utils.text import TextUtils
-from shared.utils.crypt import CryptoUtils
+from shared.utils.crypt import CryptoUtils, DecryptionException
 
 from shared.models.user import User_on_db, UserTier_on_db
 from shared.models.resources import Model_on_db, APIKey_on_db
@@ -35,18 +35,31 @@ class SeedDb:
     def __init__(self, db: AsyncSession):
         self.db = db
 
+    @staticmethod
+    def _fill_unset(row, values: dict, fields: tuple) -> None:
+        """Give a row seeded before `fields` existed their seeded values, keeping any already set"""
+        for field in fields:
+            if getattr(row, field) is None and values.get(field) is not None:
+                setattr(row, field, values[field])
+
     async def seed_usertypes(self) -> None:
         """Populate default tiers"""
         default_tiers = [
-            {"name": "free", "media_quota": 100_000_000, "price_per_job": 10, "can_use_premium_models": False},
-            {"name": "premium", "media_quota": 1_000_000_000, "price_per_job": 5, "can_use_premium_models": True},
-            {"name": "admin", "media_quota": 10_000_000_000, "price_per_job": 0, "can_use_premium_models": True},
+            {"name": "free", "media_quota": 100_000_000, "price_per_job": 10, "can_use_premium_models": False,
+             "max_job_cost": 100, "monthly_spend_limit": 500},
+            {"name": "premium", "media_quota": 1_000_000_000, "price_per_job": 5, "can_use_premium_models": True,
+             "max_job_cost": 5_000, "monthly_spend_limit": 50_000},
+            {"name": "admin", "media_quota": 10_000_000_000, "price_per_job": 0, "can_use_premium_models": True,
+             "max_job_cost": None, "monthly_spend_limit": None},
         ]
         try:
             for tier in default_tiers:
                 result = await self.db.execute(select(UserTier_on_db).where(UserTier_on_db.name == tier["name"]))
-                if not result.scalar_one_or_none():
+                existing = result.scalar_one_or_none()
+                if not existing:
                     self.db.add(UserTier_on_db(id=uuid.uuid4(), **tier))
+                else:
+                    self._fill_unset(existing, tier, ("max_job_cost", "monthly_spend_limit"))
 
             await self.db.commit()
         except Exception as e:
@@ -107,6 +120,8 @@ class SeedDb:
                 "cost_per_1m_output": 60,  # 0.60 dollars => 60 cents
                 "max_input_tokens": 1_048_576,
                 "max_output_tokens": 65_535,
+                "equivalence_group": "gemini-flash",
+                "fallback_encoders": ["gemini-2.0-flash"],
                 "is_active": True
             },
             {
@@ -245,8 +260,11 @@ class SeedDb:
         try:
             for model in default_models:
                 result = await self.db.execute(select(Model_on_db).where(Model_on_db.name == model["name"]))
-                if not result.scalar_one_or_none():
+                existing = result.scalar_one_or_none()
+                if not existing:
                     self.db.add(Model_on_db(id=uuid.uuid4(), **model))
+                else:
+                    self._fill_unset(existing, model, ("equivalence_group", "fallback_encoders"))
 
             await self.db.commit()
         except Exception as e:
@@ -258,6 +276,13 @@ class SeedDb:
 
 
 
+    @staticmethod
+    def _decrypts_to(crypto: CryptoUtils, token: str, api_key: str) -> bool:
+        try:
+            return crypto.decrypt(token) == api_key
+        except DecryptionException:
+            return False
+
     async def seed_api_keys(self) -> None:
         """Populate default tiers"""
         result = await self.db.execute(
@@ -266,17 +291,27 @@ class SeedDb:
         model = result.scalar_one_or_none()
         if not model:
             raise HTTPException(status_code=404, detail="El modelo no existe.")
+        crypto = CryptoUtils(key=KEY_FERNET_ENCRYPTION)
         default_keys = [
             {
                 "model_id": model.id,
-                "api_key": CryptoUtils(key=KEY_FERNET_ENCRYPTION).encrypt(KEY_API_GEMINI),
+                "api_key": KEY_API_GEMINI,
+                "is_active": True,
             },
         ]
         try:
             for key in default_keys:
                 result = await self.db.execute(select(APIKey_on_db).where(APIKey_on_db.model_id == key["model_id"]))
-                if not result.scalar_one_or_none():
-                    self.db.add(APIKey_on_db(id=uuid.uuid4(), **key))
+                existing = result.scalars().all()
+                if any(row.is_active for row in existing):
+                    continue
+                # Keys seeded before is_active was set were stored inactive and the worker
+                # only uses active keys: turn the seeded one on instead of adding a copy
+                seeded = next((row for row in existing if self._decrypts_to(crypto, row.api_key, key["api_key"])), None)
+                if seeded:
+                    seeded.is_active = True
+                else:
+                    self.db.add(APIKey_on_db(id=uuid.uuid4(), **{**key, "api_key": crypto.encrypt(key["api_key"])}))
 
             await self.db.commit()
         except Exception as e:
@@ -0,0 +1,171 @@
+"""Latency of lightweight endpoints while large job estimates run
+
+Measures the light endpoints alone, then again while --heavy clients post /job/estimate
+for large uploaded tables in a loop, and prints p50/p95/p99 of both phases. Each estimate
+uses a different chunk_size so the estimate cache cannot answer it, and the heavy clients
+rotate over more files than the per-process dataframe cache holds, so files are parsed
+again. Exits with status 1 when the loaded p99 is above --max-p99-ratio times the
+baseline p99 (and above --p99-floor ms).
+
+    python backend/loadtest.py --url http://localhost:8000 --username root --password secret
+
+The model must be active and have an API key; by default the first active model is used.
+"""
+import argparse
+import io
+import itertools
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def login(url: str, username: str, password: str) -> dict:
+    response = requests.post(f"{url}/auth/login", data={"username": username, "password": password}, timeout=30)
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def upload_tables(url: str, headers: dict, files: int, rows: int) -> list:
+    """Upload distinct CSV files of `rows` rows with long free-text cells"""
+    media_ids = []
+    for n in range(files):
+        body = io.StringIO()
+        body.write("id,name,notes\n")
+        for i in range(rows):
+            body.write(f'{i},file {n} row {i},"{"lorem ipsum dolor sit amet " * (1 + i % 20)}"\n')
+        response = requests.post(
+            f"{url}/media/upload/tabular",
+            headers=headers,
+            files={"file": (f"loadtest_{n}_{time.time_ns()}.csv", body.getvalue().encode("utf-8"), "text/csv")},
+            timeout=300
+        )
+        response.raise_for_status()
+        media_ids.append(response.json()["media_id"])
+    return media_ids
+
+
+def percentiles(latencies: list) -> dict:
+    if len(latencies) < 2:
+        return {"n": len(latencies), "p50": float("nan"), "p95": float("nan"), "p99": float("nan")}
+    cuts = statistics.quantiles(latencies, n=100)
+    return {"n": len(latencies), "p50": statistics.median(latencies), "p95": cuts[94], "p99": cuts[98]}
+
+
+def hammer_light(url: str, headers: dict, paths: list, clients: int, duration: float) -> tuple:
+    """Request the light endpoints from `clients` threads for `duration` seconds; latencies in ms"""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(offset: int):
+        session = requests.Session()
+        for path in itertools.islice(itertools.cycle(paths), offset, None):
+            if time.monotonic() >= stop_at:
+                return
+            started = time.perf_counter()
+            try:
+                response = session.get(f"{url}{path}", headers=headers, timeout=60)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for offset in range(clients):
+            pool.submit(client, offset)
+    return latencies, errors
+
+
+def run_heavy(url: str, headers: dict, args, media_ids: list, stop: threading.Event, stats: dict):
+    """Post uncached estimates in a loop until `stop` is set"""
+    chunk_sizes = itertools.count(1000)
+    lock = threading.Lock()
+
+    def client(offset: int):
+        session = requests.Session()
+        for media_id in itertools.islice(itertools.cycle(media_ids), offset, None):
+            if stop.is_set():
+                return
+            with lock:
+                chunk_size = next(chunk_sizes)
+            started = time.perf_counter()
+            response = session.post(
+                f"{url}/job/estimate",
+                headers=headers,
+                params={"granularity": "PER_ROW", "verbosity": 0.5, "chunk_size": chunk_size},
+                data={"prompt_id": args.prompt_id, "media_id": media_id, "model_id": args.model_id},
+                timeout=600
+            )
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                stats.setdefault(response.status_code, []).append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=args.heavy) as pool:
+        for offset in range(args.heavy):
+            pool.submit(client, offset)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--model-id", help="defaults to the first active model")
+    parser.add_argument("--prompt-id", help="defaults to a new prompt")
+    parser.add_argument("--files", type=int, default=12, help="distinct tables the estimates rotate over")
+    parser.add_argument("--rows", type=int, default=100_000, help="rows per table")
+    parser.add_argument("--heavy", type=int, default=4, help="concurrent estimate clients")
+    parser.add_argument("--light", type=int, default=16, help="concurrent light clients")
+    parser.add_argument("--light-path", action="append", help="light endpoint, repeatable (default: / and /model/fetch/all)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per phase")
+    parser.add_argument("--max-p99-ratio", type=float, default=3.0)
+    parser.add_argument("--p99-floor", type=float, default=100, help="ms under which a loaded p99 always passes")
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    headers = login(url, args.username, args.password)
+    paths = args.light_path or ["/", "/model/fetch/all"]
+
+    if not args.model_id:
+        models = requests.get(f"{url}/model/fetch/all", headers=headers, timeout=30).json()
+        args.model_id = next(model["model_id"] for model in models if model["is_active"])
+    if not args.prompt_id:
+        response = requests.post(f"{url}/prompt/new", headers=headers, data={"prompt_text": "Resume la fila en una frase."}, timeout=30)
+        response.raise_for_status()
+        args.prompt_id = response.json()["prompt_id"]
+
+    print(f"Uploading {args.files} tables of {args.rows} rows...")
+    media_ids = upload_tables(url, headers, args.files, args.rows)
+
+    print(f"Baseline: {args.light} light clients for {args.duration:g}s")
+    baseline, baseline_errors = hammer_light(url, headers, paths, args.light, args.duration)
+
+    print(f"Loaded: same light clients with {args.heavy} estimate clients")
+    stop = threading.Event()
+    heavy_stats = {}
+    heavy = threading.Thread(target=run_heavy, args=(url, headers, args, media_ids, stop, heavy_stats))
+    heavy.start()
+    time.sleep(min(5, args.duration / 3))  # let the first estimates reach the parse and count stages
+    loaded, loaded_errors = hammer_light(url, headers, paths, args.light, args.duration)
+    stop.set()
+    heavy.join()
+
+    before, after = percentiles(baseline), percentiles(loaded)
+    for name, result, errors in (("baseline", before, baseline_errors), ("loaded", after, loaded_errors)):
+        print(f"{name:>9}: n={result['n']} p50={result['p50']:.1f}ms p95={result['p95']:.1f}ms p99={result['p99']:.1f}ms errors={len(errors)}")
+    for status, latencies in sorted(heavy_stats.items()):
+        print(f" estimate: status {status} n={len(latencies)} p50={statistics.median(latencies):.0f}ms")
+
+    passed = after["p99"] <= max(args.p99_floor, args.max_p99_ratio * before["p99"]) and not loaded_errors
+    print("PASS" if passed else "FAIL")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
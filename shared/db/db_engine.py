@@ -1,9 +1,13 @@
+import logging
 from typing import AsyncGenerator
+from sqlalchemy import inspect, literal, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 import os
 
 from shared.models.base import Base
 
+logger = logging.getLogger(__name__)
+
 USER_DB = os.getenv("USER_DB", "postgres")
 PASS_DB = os.getenv("PASS_DB", "averysecurepassword")
 NAME_DB = os.getenv("NAME_DB", "Tablemind")
@@ -21,9 +25,36 @@ SessionLocal = async_sessionmaker(
     autoflush=False,
 )
 
+def add_missing_columns(connection) -> None:
+    """Add the columns of the models that existing tables lack
+
+    create_all only creates missing tables, so columns added to a model later are added
+    here with ALTER TABLE ... ADD COLUMN IF NOT EXISTS. A NOT NULL column gets its
+    scalar default as the server default, so the rows already stored can take it.
+    """
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE "{table.name}" ADD COLUMN IF NOT EXISTS "{column.name}" {column.type.compile(dialect=dialect)}'
+            if not column.nullable:
+                if column.default is None or not column.default.is_scalar:
+                    logger.error(f"Cannot add NOT NULL column {table.name}.{column.name} without a scalar default")
+                    continue
+                default = literal(column.default.arg, column.type).compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+                ddl += f" NOT NULL DEFAULT {default}"
+            logger.info(f"Adding column {table.name}.{column.name}")
+            connection.execute(text(ddl))
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
 
 async def get_db() -> AsyncGenerator[AsyncSession, None]:
     async with SessionLocal() as session:
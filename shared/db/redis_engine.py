@@ -0,0 +1,19 @@
+import os
+
+import redis
+
+HOST_REDS = os.getenv("HOST_REDS", "redis")
+
+# DB 0 and 1 belong to the Celery broker and result backend
+REDIS_URL_CACHE = f"redis://{HOST_REDS}:6379/2"
+
+redis_client = redis.Redis.from_url(
+    REDIS_URL_CACHE,
+    decode_responses=True,
+    socket_timeout=5,
+    socket_connect_timeout=5,
+    health_check_interval=30,
+)
+
+def get_redis() -> redis.Redis:
+    return redis_client
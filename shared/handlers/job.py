@@ -1,10 +1,12 @@
+import json
 import logging
 import os
 import random
 import uuid
 from typing import List, Optional, Tuple
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
+import pandas as pd
 from fastapi import HTTPException
 from fastapi.responses import FileResponse
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -18,6 +20,9 @@ from shared.ops.prompt import PromptDb
 from shared.ops.user import UsersDb
 from shared.schemas.generic import ResponseMessage
 from shared.schemas.job import ResponseJob, ResponseJobDownload
+from shared.utils.cancel import request_cancel
+from shared.utils.estimate_cache import dataframe_cache, estimate_cache
+from shared.utils.executors import blocking_pool
 from shared.utils.crypt import CryptoUtils
 from shared.utils.job import ChunkUtils, JobUtils
 from shared.utils.media import MediaUtils
@@ -57,8 +62,13 @@ class JobHandler:
             granularity: GranularityLevel,
             verbosity: float,
             chunk_size: int,
-            focus_column: Optional[str]
+            focus_column: Optional[str],
+            estimate_id: Optional[str] = None
         ) -> ResponseJob:
+        """Estimate tokens and cost of a job, reusing a cached estimate of the same parameters
+
+        estimate_id is the handle returned by an earlier estimate; it must match the parameters.
+        """
         # Store parameters for future use in JobCreate
         self.prompt_id = prompt_id
         self.media_id = media_id
@@ -67,6 +77,8 @@ class JobHandler:
         self.verbosity = verbosity
         self.chunk_size = chunk_size
         self.focus_column = focus_column
+        # Per cell jobs only ever read their focus column
+        self.columns = [focus_column] if granularity == GranularityLevel.PER_CELL and focus_column else None
 
         # Fetch required data
         self.prompt = await self.promptondb.get_prompt_entry(prompt_id)
@@ -79,40 +91,32 @@ class JobHandler:
 
         handling_fee = self.userdata.user_type.price_per_job
 
-        full_path = os.path.join(self.media.filepath, self.media.filename)
-        self.df = self.jobutils.load_dataframe(full_path, self.media.media_type)
-        
         if granularity == GranularityLevel.PER_CELL and not focus_column:
             raise HTTPException(status_code=400, detail="se requiere focus_column para modo PER_CELL")
 
-        if focus_column and focus_column not in self.df.columns:
-            raise HTTPException(status_code=400, detail=f"No se encontró '{focus_column}' en df.")
-
         if not self.model.is_active:
             raise HTTPException(status_code=403, detail=f"El modelo '{self.model.name}' no está activo.")
-            
-        if not self.model.api_keys:
-            raise HTTPException(status_code=400, detail=f"No API keys found for model '{self.model.name}'")
-
-        random_api_key_obj = random.choice(self.model.api_keys)
-        self.api_key = CryptoUtils(key=KEY_FERNET_ENCRYPTION).decrypt(random_api_key_obj.api_key)
 
-        self.input_tokens = self.jobutils.estimate_input_tokens(
-            df=self.df,
-            model=self.model,
-            api_key=self.api_key,
-            granularity=granularity,
-            focus_column=focus_column,
-            prompt_text=self.prompt.prompt_text
+        # /job/start reuses the estimate /job/estimate just made with the same parameters
+        self.estimate_id = estimate_cache.make_key(
+            str(self.user.id), self.media.filehash, self.prompt.hash, str(self.model.id),
+            granularity.name, focus_column, verbosity, chunk_size
         )
-        self.output_tokens, self.risk_level = self.jobutils.estimate_output_tokens(
-            self.input_tokens,
-            verbosity=verbosity,
-            model_max_output_tokens=self.model.max_output_tokens
-        )
-        self.cost_usd = round((((self.input_tokens / 1_000_000) * self.model.cost_per_1m_input) + \
-                        ((self.output_tokens / 1_000_000) * self.model.cost_per_1m_output)) + \
-                        (handling_fee))
+        if estimate_id is not None and estimate_id != self.estimate_id:
+            raise HTTPException(status_code=400, detail="El estimate_id no corresponde a estos parámetros")
+        estimate = estimate_cache.get(self.estimate_id)
+        if estimate is None:
+            df = await self.dataframe()
+            # Token counting calls the provider or walks every row; either blocks
+            estimate = await blocking_pool.run(self._compute_estimate, df, granularity, verbosity, focus_column, handling_fee)
+            estimate_cache.set(self.estimate_id, estimate)
+
+        self.input_tokens = estimate["input_tokens"]
+        self.output_tokens = estimate["output_tokens"]
+        self.risk_level = estimate["risk_level"]
+        self.cost_usd = estimate["cost_usd"]
+        self.input_tokens_range = tuple(estimate["input_tokens_range"])
+        self.cost_range = tuple(estimate["cost_range"])
 
         import time
         timestamp = str(time.time())
@@ -132,6 +136,11 @@ class JobHandler:
             cost_per_1m_output=self.model.cost_per_1m_output,
             handling_fee=handling_fee,
             estimated_cost=self.cost_usd,
+            estimated_input_tokens_low=self.input_tokens_range[0],
+            estimated_input_tokens_high=self.input_tokens_range[1],
+            estimated_cost_low=self.cost_range[0],
+            estimated_cost_high=self.cost_range[1],
+            estimate_id=self.estimate_id,
             job_status=None,
             task_id=None,
             task_status=None,
@@ -141,11 +150,87 @@ class JobHandler:
 
 
 
+    async def dataframe(self) -> pd.DataFrame:
+        """The columns of the job's file it needs, read at most once while they stay in the LRU"""
+        if getattr(self, "df", None) is None:
+            key = self.media.filehash if self.columns is None else f"{self.media.filehash}:{json.dumps(self.columns)}"
+            self.df = dataframe_cache.get(key)
+            if self.df is None:
+                full_path = os.path.join(self.media.filepath, self.media.filename)
+                self.df = await self.jobutils.load_dataframe_async(
+                    full_path, self.media.media_type, filehash=self.media.filehash, columns=self.columns
+                )
+                dataframe_cache.put(key, self.df)
+        return self.df
+
+
+
+    def _compute_estimate(
+            self,
+            df: pd.DataFrame,
+            granularity: GranularityLevel,
+            verbosity: float,
+            focus_column: Optional[str],
+            handling_fee: int
+        ) -> dict:
+        """Count the tokens of the job's file and price them, as stored in the estimate cache
+
+        Blocking: run it in the blocking pool.
+        """
+        if focus_column and focus_column not in df.columns:
+            raise HTTPException(status_code=400, detail=f"No se encontró '{focus_column}' en df.")
+
+        now = datetime.now(timezone.utc)
+        usable_keys = [
+            key for key in self.model.api_keys
+            if key.is_active and (key.expires_at is None or key.expires_at > now)
+        ]
+        if not usable_keys:
+            raise HTTPException(status_code=400, detail=f"No API keys found for model '{self.model.name}'")
+
+        # Count tokens with the least used key so estimates don't drain one key's quota
+        api_key_obj = min(usable_keys, key=lambda key: key.usage_count or 0)
+        self.api_key = CryptoUtils(key=KEY_FERNET_ENCRYPTION).decrypt(api_key_obj.api_key)
+
+        input_tokens, input_low, input_high = self.jobutils.estimate_input_token_range(
+            df=df,
+            model=self.model,
+            api_key=self.api_key,
+            granularity=granularity,
+            focus_column=focus_column,
+            prompt_text=self.prompt.prompt_text
+        )
+        output_tokens, risk_level = self.jobutils.estimate_output_tokens(
+            input_tokens,
+            verbosity=verbosity,
+            model_max_output_tokens=self.model.max_output_tokens
+        )
+
+        def price(input_count: int, output_count: int) -> int:
+            return round((((input_count / 1_000_000) * self.model.cost_per_1m_input) + \
+                          ((output_count / 1_000_000) * self.model.cost_per_1m_output)) + \
+                         (handling_fee))
+
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "risk_level": risk_level,
+            "cost_usd": price(input_tokens, output_tokens),
+            "input_tokens_range": [input_low, input_high],
+            # Output is estimated as a fixed multiple of input, so it scales with the interval
+            "cost_range": [price(tokens, int(tokens * round(verbosity, 2))) for tokens in (input_low, input_high)],
+        }
+
+
+
     async def JobCreate(
                 self,
                 granularity: Optional[GranularityLevel] = None,
                 chunk_size: Optional[int] = None,
                 focus_column: Optional[str] = None,
+                cache_responses: bool = True,
+                time_budget: Optional[int] = None,
+                cost_cap: Optional[int] = None,
             ) -> ResponseJob:
             granularity = granularity or self.granularity
             chunk_size = chunk_size or self.chunk_size
@@ -170,7 +255,7 @@ class JobHandler:
                             job_id=dup.id,
                             user_id=self.user.id,
                             granularity=granularity,
-                            df=self.df,
+                            df=await self.dataframe(),
                             chunk_size=chunk_size,
                             focus_column=focus_column or ""
                         )
@@ -198,6 +283,11 @@ class JobHandler:
             except Exception as e:
                 logger.error(f"Error checking for duplicate job: {str(e)}")
 
+            # The tier's cap applies unless the user asks for a lower one
+            tier_cap = self.userdata.user_type.max_job_cost if self.userdata and self.userdata.user_type else None
+            caps = [cap for cap in (cost_cap, tier_cap) if cap is not None]
+            cost_cap = min(caps) if caps else None
+
             try:
                 job = await self.jobondb.create_job_entry(
                     model_id=self.model.id,
@@ -208,6 +298,11 @@ class JobHandler:
                     input_token_count=self.input_tokens,
                     output_token_count=self.output_tokens,
                     hash=self.hash,
+                    cache_responses=cache_responses,
+                    deadline_at=datetime.now(timezone.utc) + timedelta(seconds=time_budget) if time_budget else None,
+                    cost_cap_usd=cost_cap,
+                    # Known before the task is sent, so a cancel can always revoke it
+                    task_id=str(uuid.uuid4()),
                 )
 
                 try:
@@ -215,7 +310,7 @@ class JobHandler:
                         job_id=job.id,
                         user_id=self.user.id,
                         granularity=granularity,
-                        df=self.df,
+                        df=await self.dataframe(),
                         chunk_size=chunk_size,
                         focus_column=focus_column or ""
                     )
@@ -234,8 +329,14 @@ class JobHandler:
                     cost_per_1m_output=self.model.cost_per_1m_output,
                     handling_fee=self.userdata.user_type.price_per_job if self.userdata and hasattr(self.userdata, 'user_type') else 0,
                     estimated_cost=self.cost_usd,
+                    estimated_input_tokens_low=self.input_tokens_range[0],
+                    estimated_input_tokens_high=self.input_tokens_range[1],
+                    estimated_cost_low=self.cost_range[0],
+                    estimated_cost_high=self.cost_range[1],
+                    estimate_id=self.estimate_id,
+                    cost_cap=job.cost_cap_usd,
                     job_status=JobStatus.QUEUED,
-                    task_id=None,
+                    task_id=job.task_id,
                     task_status=None,
                     created_at=None,
                     completed_at=None
@@ -327,7 +428,13 @@ class JobHandler:
                     task_id=None,  # Add missing parameter
                     task_status=None,  # Add missing parameter
                     created_at=job.created_at,
-                    completed_at=job.completed_at
+                    completed_at=job.completed_at,
+                    deadline_at=job.deadline_at,
+                    stop_reason=job.stop_reason,
+                    input_tokens_used=job.input_tokens_used,
+                    output_tokens_used=job.output_tokens_used,
+                    actual_cost=job.cost_actual_usd,
+                    cost_cap=job.cost_cap_usd
                 )
             except Exception as e:
                 raise HTTPException(
@@ -384,6 +491,23 @@ class JobHandler:
 
 
 
+    async def JobCancel(self, id: uuid.UUID) -> List[str]:
+        """Flag a job as cancelled for the workers and cancel its chunks that have not started
+
+        Returns the Celery task ids of the job and of those chunks so the caller can revoke them.
+        """
+        job = await self.jobondb.get_job_entry(id)
+        if job.job_status in (JobStatus.FINISHED, JobStatus.FAILED, JobStatus.CANCELLED):
+            raise HTTPException(status_code=409, detail="El job ya terminó")
+        try:
+            # Running chunks see the flag before their next request
+            request_cancel(str(job.id))
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"No se pudo cancelar el job: {str(e)}")
+        return await self.jobondb.cancel_job_entry(job)
+
+
+
     async def JobDelete(self, id: uuid.UUID) -> ResponseMessage:
         await self.jobondb.delete_job_entry(id)
         return ResponseMessage(message="Job eliminado correctamente")
@@ -402,6 +526,7 @@ class JobHandler:
         --------
         dict
             A dictionary with stats about chunks (total, completed, in_progress, failed)
+            and rows (rows_total, rows_unique, dedup_ratio)
         """
         from sqlalchemy import func, select
         
@@ -410,7 +535,10 @@ class JobHandler:
             "completed": 0,
             "in_progress": 0,
             "failed": 0,
-            "queued": 0
+            "queued": 0,
+            "rows_total": 0,
+            "rows_unique": 0,
+            "dedup_ratio": 0.0
         }
         
         try:
@@ -462,6 +590,22 @@ class JobHandler:
                 )
             )
             stats["queued"] = result.scalar() or 0
+
+            # Get row counts before and after intra-job deduplication
+            result = await self.db.execute(
+                select(
+                    func.sum(Chunk_on_db.total_rows),
+                    func.sum(func.coalesce(Chunk_on_db.unique_rows, Chunk_on_db.total_rows))
+                ).where(
+                    Chunk_on_db.job_id == job_id,
+                    Chunk_on_db.user_id == self.user.id
+                )
+            )
+            rows_total, rows_unique = result.one()
+            stats["rows_total"] = rows_total or 0
+            stats["rows_unique"] = rows_unique or 0
+            if stats["rows_total"]:
+                stats["dedup_ratio"] = round(1 - stats["rows_unique"] / stats["rows_total"], 4)
             
             return stats
             
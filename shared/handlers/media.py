@@ -1,3 +1,5 @@
+import asyncio
+import logging
 import uuid
 import os
 from typing import List
@@ -9,12 +11,20 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.auth.auth import CurrentUser
 from shared.utils.text import TextUtils
+from shared.models.resources import MediaType
 from shared.utils.media import MediaUtils
+from shared.utils.executors import parse_pool
+from shared.utils.tables import TABLE_MEDIA_TYPES, cache_path, convert_table, remove_cache
 
 from shared.ops.media import MediaDb, MediaDisk
 from shared.schemas.media import ResponseMedia
 from shared.schemas.generic import ResponseMessage
 
+logger = logging.getLogger(__name__)
+
+# Conversions still running, so their tasks are not garbage collected
+_ingestions = set()
+
 class MediaHandler:
     def __init__(self, db: AsyncSession, upload_dir: str, current_user: CurrentUser):
         self.db = db
@@ -53,7 +63,34 @@ class MediaHandler:
             )
         file.file.seek(0)
         await self.mediaondisk.save_file(self.user.id, file, filename, media.filepath)
+        if filetype in TABLE_MEDIA_TYPES:
+            self.schedule_ingest(media, filetype)
         return ResponseMedia(media_id=media.id)
+
+
+
+    def schedule_ingest(self, media, filetype: MediaType) -> None:
+        """Convert a table upload to its Parquet copy in the background
+
+        Estimates and job starts read the copy; until it exists they parse the original
+        and make the copy themselves, so a failed or rejected conversion costs nothing more.
+        """
+        task = asyncio.get_running_loop().create_task(parse_pool.run(
+            convert_table,
+            os.path.join(media.filepath, media.filename),
+            filetype,
+            cache_path(media.filepath, media.filehash)
+        ))
+        _ingestions.add(task)
+        task.add_done_callback(self._ingest_done)
+
+
+
+    @staticmethod
+    def _ingest_done(task: asyncio.Task) -> None:
+        _ingestions.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Could not convert upload to Parquet: {str(task.exception())}")
     
     
     
@@ -106,4 +143,5 @@ class MediaHandler:
 
         await self.mediaondb.delete_media_entry(id=id, owner=self.user.id)
         await self.mediaondisk.delete_file(self.user.id, filename, filepath)
+        remove_cache(filepath, media.filehash)
         return ResponseMessage(message="Archivo eliminado correctamente")
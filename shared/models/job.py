@@ -49,7 +49,15 @@ class Job_on_db(Base):
     cost_estimate_usd: Mapped[int] = mapped_column(nullable=False)
     input_token_count: Mapped[int] = mapped_column(nullable=False)
     output_token_count: Mapped[int] = mapped_column(nullable=False)
+    input_tokens_used: Mapped[Optional[int]] = mapped_column(nullable=True)  # reported by the provider
+    output_tokens_used: Mapped[Optional[int]] = mapped_column(nullable=True)
+    cost_actual_usd: Mapped[Optional[int]] = mapped_column(nullable=True)  # token cost of the used tokens, in cents
+    cost_cap_usd: Mapped[Optional[int]] = mapped_column(nullable=True)  # stop the job once its token cost reaches this, in cents
     combined_results: Mapped[Optional[List[dict]]] = mapped_column(JSONB, nullable=True)
+    cache_responses: Mapped[bool] = mapped_column(nullable=False, default=True)  # False for non-deterministic prompts
+    deadline_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)  # wall-clock budget
+    stop_reason: Mapped[Optional[str]] = mapped_column(nullable=True)  # why a job finished with rows left unprocessed
+    task_id: Mapped[Optional[str]] = mapped_column(nullable=True)  # Celery process_job task, to revoke it
 
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
@@ -80,6 +88,7 @@ class Chunk_on_db(Base):
     
     chunk_index: Mapped[int] = mapped_column(nullable=False)
     total_rows: Mapped[int] = mapped_column(nullable=False)
+    unique_rows: Mapped[Optional[int]] = mapped_column(nullable=True)  # rows actually sent to the model
     row_range: Mapped[str] = mapped_column(nullable=False)  # e.g. "10-19"
 
     granularity: Mapped[GranularityLevel] = mapped_column(PgEnum(GranularityLevel), nullable=False)
@@ -87,6 +96,10 @@ class Chunk_on_db(Base):
     
     source_data: Mapped[List[dict]] = mapped_column(JSONB, nullable=False)
     output_data: Mapped[Optional[List[dict]]] = mapped_column(JSONB, nullable=True)
+    diagnostics: Mapped[Optional[dict]] = mapped_column(JSONB, nullable=True)  # retry and circuit breaker counters
+    input_tokens_used: Mapped[Optional[int]] = mapped_column(nullable=True)  # summed over every run of the chunk
+    output_tokens_used: Mapped[Optional[int]] = mapped_column(nullable=True)
+    task_id: Mapped[Optional[str]] = mapped_column(nullable=True)  # Celery task of a fanned-out chunk, to revoke it
 
     created_at: Mapped[datetime] = mapped_column(server_default=func.now(), nullable=False)
     completed_at: Mapped[Optional[datetime]] = mapped_column(onupdate=func.now(), nullable=True)
@@ -2,11 +2,11 @@ from typing import TYPE_CHECKING
 import uuid
 from enum import Enum
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from sqlalchemy import ForeignKey, func, Text, String, DateTime, Enum as PgEnum
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 
 from shared.models.base import Base
 if TYPE_CHECKING:
@@ -105,6 +105,15 @@ class Model_on_db(Base):
 
     max_input_tokens: Mapped[int] = mapped_column(nullable=False)
     max_output_tokens: Mapped[int] = mapped_column(nullable=False)
+
+    # Routing: active models of the same provider and group are interchangeable, and
+    # fallback_encoders are tried when they are all unhealthy
+    equivalence_group: Mapped[Optional[str]] = mapped_column(nullable=True)
+    fallback_encoders: Mapped[Optional[List[str]]] = mapped_column(JSONB, nullable=True)
+
+    # Budgets shared by every worker, None means unlimited
+    requests_per_minute: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokens_per_minute: Mapped[Optional[int]] = mapped_column(nullable=True)
     
     is_active: Mapped[bool] = mapped_column(nullable=False, default=False)
 
@@ -123,6 +132,8 @@ class APIKey_on_db(Base):
     api_key: Mapped[str] = mapped_column(String(256), nullable=False, unique=True, index=True)
     is_active: Mapped[bool] = mapped_column(nullable=False, default=False)
     usage_count: Mapped[int] = mapped_column(nullable=False, default=0)
+    requests_per_minute: Mapped[Optional[int]] = mapped_column(nullable=True)
+    tokens_per_minute: Mapped[Optional[int]] = mapped_column(nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
@@ -70,6 +70,8 @@ class UserTier_on_db(Base):
     
     media_quota: Mapped[int] = mapped_column(BigInteger, nullable=False)  # bytes
     price_per_job: Mapped[int] = mapped_column(nullable=False, default=10)  # e.g., in usd cents
+    max_job_cost: Mapped[Optional[int]] = mapped_column(nullable=True)  # default per-job cap in usd cents, None for no cap
+    monthly_spend_limit: Mapped[Optional[int]] = mapped_column(nullable=True)  # usd cents per calendar month
     can_use_premium_models: Mapped[bool] = mapped_column(default=False)
 
     users: Mapped[List["User_on_db"]] = relationship("User_on_db", back_populates="user_type")
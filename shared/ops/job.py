@@ -1,13 +1,14 @@
 import uuid
-from typing import Sequence, Optional
+from datetime import datetime
+from typing import List, Sequence, Optional
 
 from fastapi import HTTPException
 
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from shared.auth.auth import CurrentUser
-from shared.models.job import Job_on_db, JobStatus
+from shared.models.job import Chunk_on_db, Job_on_db, JobStatus
 
 
 class JobDb:
@@ -43,6 +44,10 @@ class JobDb:
             input_token_count: int,
             output_token_count: int,
             hash: str,
+            cache_responses: bool = True,
+            deadline_at: Optional[datetime] = None,
+            cost_cap_usd: Optional[int] = None,
+            task_id: Optional[str] = None,
         ) -> Job_on_db:
         """Create an entry in the database for the job"""
         job = Job_on_db(
@@ -55,6 +60,10 @@ class JobDb:
             input_token_count=input_token_count,
             output_token_count=output_token_count,
             hash=hash,
+            cache_responses=cache_responses,
+            deadline_at=deadline_at,
+            cost_cap_usd=cost_cap_usd,
+            task_id=task_id,
         )
         try:
             self.db.add(job)
@@ -172,6 +181,37 @@ class JobDb:
 
 
 
+    async def cancel_job_entry(
+            self,
+            job: Job_on_db
+        ) -> List[str]:
+        """Mark a job and its chunks that have not started as cancelled
+
+        Returns the Celery task ids of the job and of those chunks, so they can be revoked.
+        """
+        job.job_status = JobStatus.CANCELLED
+        job.stop_reason = "cancelled"
+        try:
+            result = await self.db.execute(
+                update(Chunk_on_db)
+                .where(
+                    Chunk_on_db.job_id == job.id,
+                    Chunk_on_db.status == JobStatus.QUEUED
+                )
+                .values(status=JobStatus.CANCELLED)
+                .returning(Chunk_on_db.task_id)
+            )
+            task_ids = [task_id for task_id in [job.task_id, *result.scalars().all()] if task_id]
+            await self.db.commit()
+            return task_ids
+        except Exception as e:
+            await self.db.rollback()
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error cancelando el job: {str(e)}")
+
+
+
     async def delete_job_entry(
             self,
             id: uuid.UUID
@@ -15,12 +15,23 @@ class ResponseJob(BaseModel):
     cost_per_1m_output: int = Field(..., description='Costo por millón de tokens de salida')
     handling_fee: int = Field(..., description='Tarifa de manejo')
     estimated_cost: int = Field(..., description='Costo estimado')
+    estimated_input_tokens_low: Optional[int] = Field(None, description='Límite inferior del intervalo de confianza de los tokens de entrada')
+    estimated_input_tokens_high: Optional[int] = Field(None, description='Límite superior del intervalo de confianza de los tokens de entrada')
+    estimated_cost_low: Optional[int] = Field(None, description='Límite inferior del intervalo de confianza del costo')
+    estimated_cost_high: Optional[int] = Field(None, description='Límite superior del intervalo de confianza del costo')
+    estimate_id: Optional[str] = Field(None, description='Identificador de la estimación para reutilizarla en /job/start')
+    input_tokens_used: Optional[int] = Field(None, description='Tokens de entrada reportados por el proveedor')
+    output_tokens_used: Optional[int] = Field(None, description='Tokens de salida reportados por el proveedor')
+    actual_cost: Optional[int] = Field(None, description='Costo real de los tokens usados')
+    cost_cap: Optional[int] = Field(None, description='Costo máximo del trabajo; se detiene al alcanzarlo')
     task_id: Optional[str] = Field(None, description='ID de la tarea en Celery')
     task_status: Optional[str] = Field(None, description='Estado de la tarea')
     job_id: Optional[uuid.UUID] = Field(None, description='UUID del trabajo')
     job_status: Optional[str] = Field(None, description='Estado actual del trabajo')
     created_at: Optional[datetime] = Field(None, description='Fecha de creación')
     completed_at: Optional[datetime] = Field(None, description='Fecha de finalización')
+    deadline_at: Optional[datetime] = Field(None, description='Hora límite del trabajo')
+    stop_reason: Optional[str] = Field(None, description='Motivo por el que el trabajo terminó con filas sin procesar')
 
     def dict(self, *args, **kwargs):
         """Override dict method to include all fields"""
@@ -52,6 +63,14 @@ class ResponseJobStatus(BaseModel):
     chunks_completed: int = Field(..., description='Número de chunks completados')
     chunks_in_progress: int = Field(..., description='Número de chunks en proceso')
     chunks_failed: int = Field(..., description='Número de chunks fallidos')
+    rows_total: int = Field(0, description='Número total de filas del trabajo')
+    rows_unique: int = Field(0, description='Filas enviadas al modelo tras eliminar duplicados')
+    dedup_ratio: float = Field(0.0, description='Fracción de filas resueltas por deduplicación')
+    input_tokens_used: Optional[int] = Field(None, description='Tokens de entrada reportados por el proveedor')
+    output_tokens_used: Optional[int] = Field(None, description='Tokens de salida reportados por el proveedor')
+    actual_cost: Optional[int] = Field(None, description='Costo real de los tokens usados')
+    stop_reason: Optional[str] = Field(None, description='Motivo por el que el trabajo terminó con filas sin procesar')
+    deadline_at: Optional[datetime] = Field(None, description='Hora límite del trabajo')
     created_at: datetime = Field(..., description='Fecha de creación del trabajo')
     completed_at: Optional[datetime] = Field(None, description='Fecha de finalización del trabajo')
 
@@ -0,0 +1,53 @@
+import logging
+import os
+import threading
+import time
+
+from shared.db.redis_engine import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cancellation flag is kept, longer than any job runs
+JOB_CANCEL_TTL = int(os.getenv("JOB_CANCEL_TTL", str(24 * 3600)))
+# Workers look the flag up at most this often per job
+JOB_CANCEL_POLL_INTERVAL = float(os.getenv("JOB_CANCEL_POLL_INTERVAL", "1"))
+
+CANCEL_PREFIX = "tablemind:job_cancel"
+
+
+def request_cancel(job_id: str) -> None:
+    """Flag a job as cancelled; raises if Redis cannot be reached"""
+    get_redis().set(f"{CANCEL_PREFIX}:{job_id}", 1, ex=JOB_CANCEL_TTL)
+
+
+def is_cancelled(job_id: str) -> bool:
+    try:
+        return bool(get_redis().exists(f"{CANCEL_PREFIX}:{job_id}"))
+    except Exception as e:
+        logger.warning(f"Could not read the cancellation flag of job {job_id}: {str(e)}")
+        return False
+
+
+class CancelFlag:
+    """A job's cancellation flag as seen by a worker, cheap enough to check before every request
+
+    Redis is asked at most every poll_interval seconds; once the flag is seen it stays set.
+    """
+
+    def __init__(self, job_id: str, poll_interval: float = JOB_CANCEL_POLL_INTERVAL):
+        self.job_id = job_id
+        self.poll_interval = poll_interval
+        self._cancelled = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_set(self) -> bool:
+        with self._lock:
+            if self._cancelled or time.monotonic() - self._checked_at < self.poll_interval:
+                return self._cancelled
+            self._checked_at = time.monotonic()
+        cancelled = is_cancelled(self.job_id)
+        if cancelled:
+            with self._lock:
+                self._cancelled = True
+        return cancelled
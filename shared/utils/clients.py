@@ -0,0 +1,66 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from google import genai
+
+from shared.utils.metrics import metrics
+
+CLIENT_POOL_MAX_SIZE = int(os.getenv("CLIENT_POOL_MAX_SIZE", "32"))
+
+
+class ClientPool:
+    """Process-wide pool of provider clients keyed by API key
+
+    Building a genai.Client per call throws away its HTTP connection pool and TLS
+    sessions. Clients handed out here are reused for every row, chunk and job in the
+    process and are only dropped (least recently used first) when the pool is full.
+    """
+
+    def __init__(self, max_size: int = CLIENT_POOL_MAX_SIZE):
+        self.max_size = max(1, max_size)
+        self._clients: "OrderedDict[str, genai.Client]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def _pool_key(self, api_key: str) -> str:
+        # Never keep the raw key around as a dict key or in metrics
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    def get(self, api_key: str) -> genai.Client:
+        pool_key = self._pool_key(api_key)
+        with self._lock:
+            client = self._clients.get(pool_key)
+            if client is not None:
+                self._clients.move_to_end(pool_key)
+                self.reused += 1
+                metrics.incr("client_pool.reused")
+                return client
+
+            client = genai.Client(api_key=api_key)
+            self._clients[pool_key] = client
+            self.created += 1
+            metrics.incr("client_pool.created")
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evicted += 1
+                metrics.incr("client_pool.evicted")
+            metrics.gauge("client_pool.size", len(self._clients))
+            return client
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._clients),
+                "max_size": self.max_size,
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
+
+
+client_pool = ClientPool()
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import pandas as pd
+
+from shared.db.redis_engine import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds an estimate can be reused by /job/estimate and /job/start
+ESTIMATE_CACHE_TTL = int(os.getenv("ESTIMATE_CACHE_TTL", "900"))
+# Parsed files kept in memory by each API process
+DATAFRAME_CACHE_SIZE = int(os.getenv("DATAFRAME_CACHE_SIZE", "8"))
+
+
+class EstimateCache:
+    """Job estimates in Redis, keyed by everything the estimate depends on
+
+    The key doubles as the estimate handle returned by /job/estimate. It includes the
+    user, whose tier sets the handling fee. Redis errors only cost a recomputation.
+    """
+
+    prefix = "tablemind:estimate"
+
+    def __init__(self, ttl: int = ESTIMATE_CACHE_TTL):
+        self.ttl = ttl
+
+    def make_key(
+            self,
+            user_id: str,
+            filehash: str,
+            prompt_hash: str,
+            model_id: str,
+            granularity: str,
+            focus_column: Optional[str],
+            verbosity: float,
+            chunk_size: int
+        ) -> str:
+        payload = json.dumps(
+            [user_id, filehash, prompt_hash, model_id, granularity, focus_column or "", round(verbosity, 4), chunk_size]
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            value = get_redis().get(f"{self.prefix}:{key}")
+        except Exception as e:
+            logger.warning(f"Estimate cache read failed: {str(e)}")
+            return None
+        return json.loads(value) if value else None
+
+    def set(self, key: str, estimate: Dict[str, Any]) -> None:
+        try:
+            get_redis().set(f"{self.prefix}:{key}", json.dumps(estimate), ex=self.ttl)
+        except Exception as e:
+            logger.warning(f"Estimate cache write failed: {str(e)}")
+
+
+class DataFrameCache:
+    """Least recently used parsed files of this process, keyed by file hash and the columns read"""
+
+    def __init__(self, size: int = DATAFRAME_CACHE_SIZE):
+        self.size = size
+        self._frames: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        with self._lock:
+            df = self._frames.get(key)
+            if df is not None:
+                self._frames.move_to_end(key)
+            return df
+
+    def put(self, key: str, df: pd.DataFrame) -> None:
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._frames[key] = df
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+
+
+estimate_cache = EstimateCache()
+dataframe_cache = DataFrameCache()
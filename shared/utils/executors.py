@@ -0,0 +1,118 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from shared.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Processes parsing uploaded tables (pd.read_csv / read_excel); CPU bound, so about one per core
+PARSE_POOL_WORKERS = int(os.getenv("PARSE_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Threads for blocking calls made while serving a request (provider APIs, token counting, formatting)
+BLOCKING_POOL_WORKERS = int(os.getenv("BLOCKING_POOL_WORKERS", "16"))
+# Tasks each pool takes, running or waiting, before further requests are turned away with a 503
+PARSE_POOL_MAX_PENDING = int(os.getenv("PARSE_POOL_MAX_PENDING", str(4 * PARSE_POOL_WORKERS)))
+BLOCKING_POOL_MAX_PENDING = int(os.getenv("BLOCKING_POOL_MAX_PENDING", str(4 * BLOCKING_POOL_WORKERS)))
+# Seconds a turned away client is asked to wait before retrying
+POOL_RETRY_AFTER = int(os.getenv("POOL_RETRY_AFTER", "5"))
+
+
+class BoundedPool:
+    """An executor for blocking work of async handlers, with a bounded queue
+
+    The executor is created on first use, so each uvicorn worker process gets its own.
+    A task holds its slot until it has really finished, even when the request that
+    awaited it is gone, so max_pending bounds the work in the pool. Past it run() fails
+    fast with a 503 instead of queueing requests behind minutes of parsing.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Executor], max_pending: int):
+        self.name = name
+        self.max_pending = max(1, max_pending)
+        self._factory = factory
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Executor:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.incr(f"pool.{self.name}.rejected")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Servidor ocupado, intente de nuevo en unos segundos",
+                    headers={"Retry-After": str(POOL_RETRY_AFTER)}
+                )
+            if self._executor is None:
+                self._executor = self._factory()
+            self._pending += 1
+            pending = self._pending
+        metrics.gauge(f"pool.{self.name}.pending", pending)
+        return self._executor
+
+    def _release(self, _future=None) -> None:
+        with self._lock:
+            self._pending -= 1
+            pending = self._pending
+        metrics.gauge(f"pool.{self.name}.pending", pending)
+
+    def _discard(self, executor: Executor) -> None:
+        # A killed child breaks a process pool for good; the next task gets a fresh one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Run fn(*args, **kwargs) in the pool and wait for it without blocking the event loop"""
+        executor = self._acquire()
+        try:
+            future = executor.submit(functools.partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            self._release()
+            self._discard(executor)
+            raise
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            logger.error(f"The {self.name} pool lost a worker process; starting a new pool")
+            self._discard(executor)
+            raise
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Queued tasks are dropped; running ones finish so child processes exit cleanly
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Parsing runs in separate processes so it holds neither the GIL nor the event loop.
+# They are spawned rather than forked: a fork would copy the running loop and its sockets.
+parse_pool = BoundedPool(
+    "parse",
+    lambda: ProcessPoolExecutor(max_workers=PARSE_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn")),
+    PARSE_POOL_MAX_PENDING
+)
+blocking_pool = BoundedPool(
+    "blocking",
+    lambda: ThreadPoolExecutor(max_workers=BLOCKING_POOL_WORKERS, thread_name_prefix="blocking"),
+    BLOCKING_POOL_MAX_PENDING
+)
+
+
+def shutdown_pools() -> None:
+    parse_pool.shutdown()
+    blocking_pool.shutdown()
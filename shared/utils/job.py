@@ -1,11 +1,11 @@
+import math
+import os
 import uuid
 from typing import Optional, List, Tuple
 import pandas as pd
 import json
 from enum import Enum
 
-from google import genai
-
 from fastapi import HTTPException
 
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -14,8 +14,26 @@ from sqlalchemy.exc import SQLAlchemyError
 from shared.models.resources import MediaType
 from shared.models.job import GranularityLevel, JobStatus, Chunk_on_db
 from shared.models.resources import Model_on_db
+from shared.utils.clients import client_pool
+from shared.utils.executors import blocking_pool, parse_pool
 from shared.utils.text import TextUtils
-
+from shared.utils.sampling import ratio_estimate, stratified_sample
+from shared.utils.tables import TABLE_MEDIA_TYPES, cache_path, ingest_table, project, read_cache, read_table
+from shared.utils.tokenizer import CalibratedTokenizer, get_tokenizer
+
+# "local" counts input tokens offline with shared.utils.tokenizer, never calling the
+# network; models without a local vocabulary get an approximate characters-per-token
+# count with its calibration interval. "provider" asks the provider's count_tokens API
+# for a few sampled rows
+TOKEN_ESTIMATE_MODE = os.getenv("TOKEN_ESTIMATE_MODE", "local").lower()
+# Rows counted with the provider's API in provider mode. Each is one count_tokens round
+# trip, made one after the other (plus one for the prompt), so an estimate takes about
+# this many plus one round trips; 10 is the least that gives every stratum (ESTIMATE_STRATA)
+# the two rows its variance needs
+TOKEN_ESTIMATE_SAMPLE_SIZE = int(os.getenv("TOKEN_ESTIMATE_SAMPLE_SIZE", "10"))
+# Frames up to this many rows are counted in full by a local vocabulary; larger ones are sampled
+TOKEN_ESTIMATE_EXACT_ROWS = int(os.getenv("TOKEN_ESTIMATE_EXACT_ROWS", "50000"))
+TOKEN_ESTIMATE_LOCAL_SAMPLE_SIZE = int(os.getenv("TOKEN_ESTIMATE_LOCAL_SAMPLE_SIZE", "2000"))
 
 
 class OutputVerbosity(Enum):
@@ -32,22 +50,42 @@ class OutputVerbosity(Enum):
 
 class JobUtils:
     def load_dataframe(self, filepath: str, media_type: MediaType) -> pd.DataFrame:
+        if media_type not in TABLE_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unsupported media type: {media_type}")
         try:
-            if media_type == MediaType.TABLE_CSV:
-                return pd.read_csv(filepath)
-
-            elif media_type == MediaType.TABLE_TSV:
-                return pd.read_csv(filepath, sep="\t")
+            return read_table(filepath, media_type)
+        except (ValueError, FileNotFoundError, pd.errors.ParserError, SQLAlchemyError) as e:
+            raise HTTPException(status_code=500, detail=f"Error loading file: {str(e)}")
 
-            elif media_type == MediaType.TABLE_EXCEL:
-                return pd.read_excel(filepath, engine="openpyxl")
 
-            elif media_type == MediaType.TABLE_OPEN:
-                return pd.read_excel(filepath, engine="odf")
 
-            else:
-                raise HTTPException(status_code=400, detail=f"Unsupported media type: {media_type}")
+    async def load_dataframe_async(
+            self,
+            filepath: str,
+            media_type: MediaType,
+            filehash: Optional[str] = None,
+            columns: Optional[List[str]] = None
+        ) -> pd.DataFrame:
+        """load_dataframe for request handlers, off the event loop
+
+        Given the file's hash, the Parquet copy made at upload is read instead of the
+        original, only the given columns when columns is set. Files without a copy yet
+        are parsed in the parse pool and get one on the way.
+        """
+        if media_type not in TABLE_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unsupported media type: {media_type}")
+        try:
+            if filehash is None:
+                return project(await parse_pool.run(read_table, filepath, media_type), columns)
 
+            path = cache_path(os.path.dirname(filepath), filehash)
+            if os.path.exists(path):
+                try:
+                    # pyarrow decodes outside the GIL, so a thread is enough
+                    return await blocking_pool.run(read_cache, path, columns)
+                except (OSError, ValueError) as e:
+                    print(f"Warning: unreadable Parquet copy {path}, parsing the original: {str(e)}")
+            return project(await parse_pool.run(ingest_table, filepath, media_type, path), columns)
         except (ValueError, FileNotFoundError, pd.errors.ParserError, SQLAlchemyError) as e:
             raise HTTPException(status_code=500, detail=f"Error loading file: {str(e)}")
     
@@ -67,7 +105,7 @@ class JobUtils:
                 }
             ]
 
-            client = genai.Client(api_key=api_key)
+            client = client_pool.get(api_key)
             response = client.models.count_tokens(
                 model=model_encoder, 
                 contents=contents_to_send
@@ -95,8 +133,8 @@ class JobUtils:
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"No se pudo contar el número de tokens con OpenAI: {str(e)}")
         else:
-            # Default estimation: assume 4 characters per token as a fallback
-            return len(content) // 4
+            # No count_tokens API for this provider: count locally
+            return get_tokenizer(model.provider, model.encoder).count(content)
         
 
 
@@ -109,27 +147,117 @@ class JobUtils:
         prompt_text: str,
         granularity: GranularityLevel = GranularityLevel.PER_ROW,
         focus_column: Optional[str] = None,
-        sample_size: int = 5
+        sample_size: int = TOKEN_ESTIMATE_SAMPLE_SIZE
     ) -> int:
+        """Input tokens of sending every row with the prompt (see estimate_input_token_range)"""
+        return self.estimate_input_token_range(
+            df, model, api_key, prompt_text, granularity, focus_column, sample_size
+        )[0]
+
+
+
+    def estimate_input_token_range(
+        self,
+        df: pd.DataFrame,
+        model: Model_on_db,
+        api_key,
+        prompt_text: str,
+        granularity: GranularityLevel = GranularityLevel.PER_ROW,
+        focus_column: Optional[str] = None,
+        sample_size: int = TOKEN_ESTIMATE_SAMPLE_SIZE
+    ) -> Tuple[int, int, int]:
+        """Input tokens of sending every row with the prompt, as (estimate, low, high)
+
+        The exact length of every row is computed first. In local mode, models with a
+        local vocabulary have their rows counted by it: all of them when the frame is small
+        enough (TOKEN_ESTIMATE_EXACT_ROWS), and only then is the interval empty. Otherwise a
+        sample stratified by length is counted (by the local vocabulary, or with the provider's
+        API in provider mode) and scaled up with a ratio estimator, whose confidence interval
+        gives low and high (see shared.utils.sampling). In local mode, models without a
+        vocabulary are approximated from the lengths, with an interval as wide as the
+        approximation's calibration error (TOKENIZER_CALIBRATION_ERROR).
+        """
         if df.empty:
-            return 0
-    
-        sample = df.sample(n=min(sample_size, len(df)))
-    
-        total_sample_tokens = 0
-        for _, row in sample.iterrows():
-            if granularity == GranularityLevel.PER_CELL:
-                if not focus_column or focus_column not in df.columns:
-                    raise ValueError("focus_column must be provided and valid for PER_CELL granularity")
-                content = str(row[focus_column])
-            else:
-                content = str(row.to_dict())
-    
-            content = f"{prompt_text}\n{content}"
-            total_sample_tokens += self.provider_picker(model, content, api_key)
-    
-        avg_tokens_per_row = total_sample_tokens / len(sample)
-        return int(avg_tokens_per_row * len(df))
+            return 0, 0, 0
+        if granularity == GranularityLevel.PER_CELL and (not focus_column or focus_column not in df.columns):
+            raise ValueError("focus_column must be provided and valid for PER_CELL granularity")
+
+        lengths = self.row_lengths(df, granularity, focus_column)
+        tokenizer = get_tokenizer(model.provider, model.encoder)
+        approximate = isinstance(tokenizer, CalibratedTokenizer)
+        if TOKEN_ESTIMATE_MODE != "local":
+            # Every request repeats the prompt and the newline before the row
+            prompt_tokens = self.provider_picker(model, f"{prompt_text}\n", api_key) * len(df)
+            labels, sampled = stratified_sample(lengths, sample_size)
+            contents = self.row_contents(df.loc[sampled], granularity, focus_column)
+            sample_tokens = contents.apply(lambda content: self.provider_picker(model, content, api_key))
+            return self.scale_sample(lengths, labels, sample_tokens, prompt_tokens)
+
+        prompt_tokens = tokenizer.count(f"{prompt_text}\n") * len(df)
+        if approximate:
+            # A characters-per-token ratio is no count: the interval is its calibration error
+            total = int(tokenizer.count_lengths(lengths).sum()) + prompt_tokens
+            return (total, *tokenizer.interval(total))
+        if len(df) <= TOKEN_ESTIMATE_EXACT_ROWS:
+            total = int(tokenizer.count_batch(self.row_contents(df, granularity, focus_column)).sum()) + prompt_tokens
+            return total, total, total
+        labels, sampled = stratified_sample(lengths, TOKEN_ESTIMATE_LOCAL_SAMPLE_SIZE)
+        sample_tokens = tokenizer.count_batch(self.row_contents(df.loc[sampled], granularity, focus_column))
+        return self.scale_sample(lengths, labels, sample_tokens, prompt_tokens)
+
+
+
+    def scale_sample(
+        self,
+        lengths: pd.Series,
+        labels: pd.Series,
+        sample_tokens: pd.Series,
+        prompt_tokens: int
+    ) -> Tuple[int, int, int]:
+        """Total input tokens and interval from the counted sample, plus the prompt of every row"""
+        estimate, low, high = ratio_estimate(lengths, labels, sample_tokens)
+        return int(estimate) + prompt_tokens, int(low) + prompt_tokens, math.ceil(high) + prompt_tokens
+
+
+
+    def row_contents(
+        self,
+        df: pd.DataFrame,
+        granularity: GranularityLevel,
+        focus_column: Optional[str] = None
+    ) -> pd.Series:
+        """Text of each row as counted for the estimate: the focus cell, or the whole row as a dict
+
+        Missing cells are None, as ChunkUtils.format sends them.
+        """
+        if granularity == GranularityLevel.PER_CELL:
+            cells = df[focus_column]
+            return cells.astype(str).where(cells.notna(), "None")
+        records = df.astype(object).where(df.notna(), None).to_dict("records")
+        return pd.Series([str(record) for record in records], index=df.index)
+
+
+
+    def row_lengths(
+        self,
+        df: pd.DataFrame,
+        granularity: GranularityLevel,
+        focus_column: Optional[str] = None
+    ) -> pd.Series:
+        """Length of each row_contents text, computed column by column without building the texts"""
+        if granularity == GranularityLevel.PER_CELL:
+            cells = df[focus_column]
+            return cells.astype(str).str.len().where(cells.notna(), len("None")).astype(int)
+        # "{'col': value, ...}": braces, then per column its quoted name, ": " and the value,
+        # joined by ", "; text values are quoted too, missing ones are an unquoted None
+        lengths = pd.Series(2 + 2 * max(len(df.columns) - 1, 0), index=df.index)
+        for column in df.columns:
+            values = df[column].astype(str).str.len()
+            if df[column].dtype == object or pd.api.types.is_string_dtype(df[column]):
+                values = values + 2
+            values = values.where(df[column].notna(), len("None"))
+            lengths = lengths + len(repr(column)) + 2 + values
+        return lengths.astype(int)
 
 
 
@@ -237,6 +365,50 @@ class ChunkUtils:
         return formatted
 
 
+    def mark_duplicates(self, formatted: List[dict], seen: dict) -> int:
+        """Point repeated payloads at the first row of the job that carries them
+
+        `seen` maps a payload to its first row and is shared across all chunks of a job, so
+        only one occurrence of each distinct value is sent to the model. Returns how many
+        rows of this chunk still need a model call.
+        """
+        unique = 0
+        for item in formatted:
+            payload = json.dumps(item["data"], sort_keys=True, default=str)
+            if payload in seen:
+                item["duplicate_of"] = seen[payload]
+            else:
+                seen[payload] = item["row"]
+                unique += 1
+        return unique
+
+
+    def format_chunks(
+            self,
+            chunks: List[pd.DataFrame],
+            granularity: GranularityLevel,
+            focus_column: str
+        ) -> List[Tuple[int, pd.DataFrame, List[dict], int]]:
+        """Format every chunk and mark payloads repeated across them
+
+        Returns (chunk index, chunk, formatted rows, rows needing a model call) for each
+        chunk, leaving out chunks that could not be formatted.
+        """
+        seen_payloads = {}
+        formatted_chunks = []
+        for i, df_chunk in enumerate(chunks):
+            try:
+                formatted_data = self.format(df_chunk, granularity, focus_column)
+                if not formatted_data:
+                    print(f"Warning: Empty formatted data for chunk {i}")
+                    continue
+                chunk_unique_rows = self.mark_duplicates(formatted_data, seen_payloads)
+                formatted_chunks.append((i, df_chunk, formatted_data, chunk_unique_rows))
+            except Exception as chunk_error:
+                print(f"Error processing chunk {i}: {str(chunk_error)}")
+        return formatted_chunks
+
+
     async def store(
             self,
             job_id: uuid.UUID,
@@ -269,14 +441,16 @@ class ChunkUtils:
         import uuid
         import random
         timestamp = str(time.time())
+        total_rows = 0
+        unique_rows = 0
         
         try:
-            for i, df_chunk in enumerate(chunks):
+            # Formatting walks every row in Python; keep it off the event loop
+            formatted_chunks = await blocking_pool.run(self.format_chunks, chunks, granularity, focus_column)
+            for i, df_chunk, formatted_data, chunk_unique_rows in formatted_chunks:
                 try:
-                    formatted_data = self.format(df_chunk, granularity, focus_column)
-                    if not formatted_data:
-                        print(f"Warning: Empty formatted data for chunk {i}")
-                        continue
+                    total_rows += len(formatted_data)
+                    unique_rows += chunk_unique_rows
                         
                     # Generate unique hash
                     random_salt = str(random.randint(10000, 99999))
@@ -292,6 +466,7 @@ class ChunkUtils:
                         user_id=user_id,
                         chunk_index=i,
                         total_rows=len(df_chunk),
+                        unique_rows=chunk_unique_rows,
                         row_range=f"{start_index}-{end_index}",
                         source_data=formatted_data,
                         granularity=granularity,
@@ -304,6 +479,8 @@ class ChunkUtils:
                     # Continue with next chunk instead of failing the whole process
             
             await self.db.commit()
+            if total_rows:
+                print(f"Job {job_id}: {unique_rows} distinct payloads out of {total_rows} rows ({1 - unique_rows / total_rows:.1%} deduplicated)")
         except Exception as e:
             print(f"Error storing chunks: {str(e)}")
             await self.db.rollback()
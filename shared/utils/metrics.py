@@ -0,0 +1,69 @@
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Union
+
+from shared.db.redis_engine import get_redis
+
+logger = logging.getLogger(__name__)
+
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "10"))
+METRICS_TTL = int(os.getenv("METRICS_TTL", "300"))
+
+Number = Union[int, float]
+
+
+class Metrics:
+    """Process-local counters and gauges
+
+    Values are mirrored to the Redis hash `tablemind:metrics:<host>:<pid>` at most once
+    every METRICS_PUBLISH_INTERVAL seconds, so every backend and worker process can be
+    inspected from one place. The hash expires when a process stops publishing.
+    """
+
+    def __init__(self, publish_interval: float = METRICS_PUBLISH_INTERVAL):
+        self.publish_interval = publish_interval
+        self._values: Dict[str, Number] = {}
+        self._lock = threading.Lock()
+        self._last_publish = 0.0
+
+    @property
+    def redis_key(self) -> str:
+        # Resolved on every call because prefork workers change pid after import
+        return f"tablemind:metrics:{socket.gethostname()}:{os.getpid()}"
+
+    def incr(self, name: str, amount: Number = 1) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+        self._maybe_publish()
+
+    def gauge(self, name: str, value: Number) -> None:
+        with self._lock:
+            self._values[name] = value
+        self._maybe_publish()
+
+    def snapshot(self) -> Dict[str, Number]:
+        with self._lock:
+            return dict(self._values)
+
+    def _maybe_publish(self) -> None:
+        if time.monotonic() - self._last_publish >= self.publish_interval:
+            self.publish()
+
+    def publish(self) -> None:
+        self._last_publish = time.monotonic()
+        values = self.snapshot()
+        if not values:
+            return
+        try:
+            pipe = get_redis().pipeline()
+            pipe.hset(self.redis_key, mapping=values)
+            pipe.expire(self.redis_key, METRICS_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not publish metrics: {str(e)}")
+
+
+metrics = Metrics()
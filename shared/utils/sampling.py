@@ -0,0 +1,88 @@
+import math
+import os
+from typing import Tuple
+
+import pandas as pd
+
+# Length strata a token-count sample is spread over
+ESTIMATE_STRATA = int(os.getenv("ESTIMATE_STRATA", "5"))
+# Normal quantile of the confidence interval returned with estimates (1.96 for 95%)
+ESTIMATE_CONFIDENCE_Z = float(os.getenv("ESTIMATE_CONFIDENCE_Z", "1.96"))
+
+
+def stratify(lengths: pd.Series, strata: int = ESTIMATE_STRATA) -> pd.Series:
+    """Label each row with its length stratum, from shortest (0) to longest
+
+    Strata hold equal shares of the total length rather than equal row counts, so a few
+    giant cells end up in small strata of their own and are counted nearly in full.
+    """
+    strata = max(1, min(strata, len(lengths)))
+    ordered = lengths.sort_values(kind="stable")
+    total = ordered.sum()
+    if total <= 0:
+        return pd.Series(0, index=lengths.index)
+    # A row belongs to the stratum its first character falls in
+    share = (ordered.cumsum() - ordered) / total
+    return (share * strata).astype(int).clip(upper=strata - 1).reindex(lengths.index)
+
+
+def allocate(lengths: pd.Series, labels: pd.Series, sample_size: int) -> pd.Series:
+    """Rows to sample per stratum, Neyman allocation: in proportion to row count times length spread
+
+    Strata of long, uneven rows (a few giant free-text cells) get most of the sample. Every
+    stratum gets at least 2 rows, enough to estimate its variance, and never more than it has.
+    """
+    groups = lengths.groupby(labels)
+    sizes = groups.size()
+    weights = sizes * groups.std(ddof=0).fillna(0)
+    if weights.sum() <= 0:
+        weights = sizes.astype(float)
+    spare = max(0, sample_size - 2 * len(sizes))
+    return (2 + (weights / weights.sum() * spare).round().astype(int)).clip(upper=sizes)
+
+
+def stratified_sample(lengths: pd.Series, sample_size: int, strata: int = ESTIMATE_STRATA, seed: int = 0) -> Tuple[pd.Series, pd.Index]:
+    """Stratum labels of every row and the index of the rows chosen to be token-counted"""
+    lengths = lengths.fillna(0)
+    labels = stratify(lengths, strata)
+    counts = allocate(lengths, labels, sample_size)
+    chosen = [
+        group.sample(n=int(counts[label]), random_state=seed).index
+        for label, group in lengths.groupby(labels)
+    ]
+    return labels, chosen[0].append(chosen[1:]) if chosen else lengths.index[:0]
+
+
+def ratio_estimate(
+        lengths: pd.Series,
+        labels: pd.Series,
+        sample_tokens: pd.Series,
+        z: float = ESTIMATE_CONFIDENCE_Z
+    ) -> Tuple[float, float, float]:
+    """Total tokens of every row from the counted sample, with a confidence interval
+
+    Separate ratio estimator: within each stratum tokens are taken as proportional to
+    length, and the stratum's tokens per character (measured on its sample) is applied
+    to its exact total length. The variance comes from the residuals of that ratio, with
+    the finite population correction. Returns (estimate, low, high).
+    """
+    lengths = lengths.fillna(0)
+    total = 0.0
+    variance = 0.0
+    for label, stratum_lengths in lengths.groupby(labels):
+        counted = sample_tokens[sample_tokens.index.isin(stratum_lengths.index)]
+        if counted.empty:
+            continue
+        counted_lengths = stratum_lengths.loc[counted.index]
+        size, n = len(stratum_lengths), len(counted)
+        if counted_lengths.sum() > 0:
+            ratio = counted.sum() / counted_lengths.sum()
+            total += ratio * stratum_lengths.sum()
+            residuals = counted - ratio * counted_lengths
+        else:
+            total += counted.mean() * size
+            residuals = counted - counted.mean()
+        if n > 1:
+            variance += size ** 2 * (1 - n / size) * residuals.var(ddof=1) / n
+    margin = z * math.sqrt(variance)
+    return total, max(float(sample_tokens.sum()), total - margin), total + margin
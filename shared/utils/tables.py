@@ -0,0 +1,92 @@
+import logging
+import os
+import uuid
+from typing import List, Optional
+
+import pandas as pd
+
+from shared.models.resources import MediaType
+
+logger = logging.getLogger(__name__)
+
+# Parquet copies of uploaded tables are kept in this directory next to the originals
+TABLE_CACHE_SUBDIR = os.getenv("TABLE_CACHE_SUBDIR", ".parquet")
+
+TABLE_MEDIA_TYPES = (MediaType.TABLE_CSV, MediaType.TABLE_TSV, MediaType.TABLE_EXCEL, MediaType.TABLE_OPEN)
+
+
+def read_table(filepath: str, media_type: MediaType) -> pd.DataFrame:
+    """Parse an uploaded table; module level so the parse pool can run it in another process"""
+    if media_type == MediaType.TABLE_CSV:
+        return pd.read_csv(filepath)
+
+    elif media_type == MediaType.TABLE_TSV:
+        return pd.read_csv(filepath, sep="\t")
+
+    elif media_type == MediaType.TABLE_EXCEL:
+        return pd.read_excel(filepath, engine="openpyxl")
+
+    elif media_type == MediaType.TABLE_OPEN:
+        return pd.read_excel(filepath, engine="odf")
+
+    raise ValueError(f"Unsupported media type: {media_type}")
+
+
+def cache_path(filepath: str, filehash: str) -> str:
+    """Parquet copy of an upload; keyed by content, so renaming the original keeps it valid"""
+    return os.path.join(filepath, TABLE_CACHE_SUBDIR, f"{filehash}.parquet")
+
+
+def write_cache(df: pd.DataFrame, path: str) -> bool:
+    """Store df as Parquet at path, atomically; False when the table can't be stored as Parquet
+
+    Tables Arrow cannot type (a column mixing numbers and text, non-string headers) are
+    left uncached rather than coerced, since coercion would change the rows sent to the model.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logger.warning(f"Could not cache {path} as Parquet: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def ingest_table(filepath: str, media_type: MediaType, path: str) -> pd.DataFrame:
+    """Parse an original upload once and keep its Parquet copy at path"""
+    df = read_table(filepath, media_type)
+    write_cache(df, path)
+    return df
+
+
+def convert_table(filepath: str, media_type: MediaType, path: str) -> bool:
+    """ingest_table for uploads: only whether the copy was made goes back to the caller"""
+    return write_cache(read_table(filepath, media_type), path)
+
+
+def read_cache(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read a Parquet copy, only the given columns (those the table has) when columns is set"""
+    if columns is not None:
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        columns = [column for column in columns if column in names]
+    return pd.read_parquet(path, engine="pyarrow", columns=columns)
+
+
+def project(df: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    if columns is None:
+        return df
+    return df[[column for column in columns if column in df.columns]]
+
+
+def remove_cache(filepath: str, filehash: str) -> None:
+    path = cache_path(filepath, filehash)
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove {path}: {str(e)}")
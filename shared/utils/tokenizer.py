@@ -0,0 +1,117 @@
+import logging
+import math
+import os
+import threading
+from typing import Dict, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# tiktoken encoding used for OpenAI encoders it does not know by name
+TOKENIZER_DEFAULT_ENCODING = os.getenv("TOKENIZER_DEFAULT_ENCODING", "o200k_base")
+
+# Characters per token measured against each provider's own counter, for providers
+# whose vocabulary is not available offline
+PROVIDER_CHARS_PER_TOKEN: Dict[str, float] = {
+    "Google": 4.0,
+    "Anthropic": 3.5,
+    "Meta": 3.8,
+    "Mistral": 3.6,
+    "Cohere": 4.0,
+}
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# Relative error of those ratios on real text; approximate counts get an interval this wide
+TOKENIZER_CALIBRATION_ERROR = float(os.getenv("TOKENIZER_CALIBRATION_ERROR", "0.25"))
+
+
+class Tokenizer:
+    """Counts tokens locally, many texts at a time"""
+
+    name = "tokenizer"
+
+    def count_batch(self, texts: pd.Series) -> pd.Series:
+        raise NotImplementedError
+
+    def count(self, text: str) -> int:
+        return int(self.count_batch(pd.Series([text])).iloc[0])
+
+
+class TiktokenTokenizer(Tokenizer):
+    """Exact counts with a tiktoken vocabulary, encoded in batches on tiktoken's thread pool"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = f"tiktoken:{encoding.name}"
+
+    def count_batch(self, texts: pd.Series) -> pd.Series:
+        encoded = self.encoding.encode_batch(texts.fillna("").astype(str).tolist(), disallowed_special=())
+        return pd.Series([len(tokens) for tokens in encoded], index=texts.index)
+
+
+class CalibratedTokenizer(Tokenizer):
+    """Approximate counts from the text length, for vocabularies that are not available offline"""
+
+    def __init__(self, chars_per_token: float, error: float = TOKENIZER_CALIBRATION_ERROR):
+        self.chars_per_token = chars_per_token
+        self.error = error
+        self.name = f"approx:{chars_per_token:g}"
+
+    def count_batch(self, texts: pd.Series) -> pd.Series:
+        return self.count_lengths(texts.fillna("").astype(str).str.len())
+
+    def count_lengths(self, lengths: pd.Series) -> pd.Series:
+        """Counts from text lengths alone, so callers can skip building the texts"""
+        # Rounded up: a short non-empty text is still one token; a missing text has none
+        return (-(-lengths.fillna(0) // self.chars_per_token)).astype(int)
+
+    def interval(self, tokens: int) -> Tuple[int, int]:
+        """Range the true count of an approximated total falls in, given the calibration error"""
+        return int(tokens * (1 - self.error)), math.ceil(tokens * (1 + self.error))
+
+
+def _load_tiktoken(encoder: str):
+    """tiktoken encoding for an encoder, or None when tiktoken or its vocabulary is unavailable
+
+    Vocabularies are downloaded once and cached (TIKTOKEN_CACHE_DIR); images that must
+    work offline should ship that cache.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(encoder)
+        except KeyError:
+            return tiktoken.get_encoding(TOKENIZER_DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load the tiktoken vocabulary for {encoder}: {str(e)}")
+        return None
+
+
+_tokenizers: Dict[str, Tokenizer] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(provider: str, encoder: str) -> Tokenizer:
+    """Process-wide tokenizer for a model
+
+    OpenAI encoders get their tiktoken vocabulary; other providers, or OpenAI without a
+    vocabulary at hand, get a CalibratedTokenizer with the provider's characters per token.
+    That ratio is a provider-wide average, so its estimates carry the calibration error
+    as their interval; TOKEN_ESTIMATE_MODE=provider counts with the provider's API instead.
+    """
+    cache_key = f"{provider}:{encoder}"
+    with _tokenizers_lock:
+        tokenizer = _tokenizers.get(cache_key)
+    if tokenizer is not None:
+        return tokenizer
+
+    encoding = _load_tiktoken(encoder) if provider == "OpenAI" else None
+    if encoding is not None:
+        tokenizer = TiktokenTokenizer(encoding)
+    else:
+        tokenizer = CalibratedTokenizer(PROVIDER_CHARS_PER_TOKEN.get(provider, DEFAULT_CHARS_PER_TOKEN))
+    with _tokenizers_lock:
+        return _tokenizers.setdefault(cache_key, tokenizer)
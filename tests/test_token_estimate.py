@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shared.models.job import GranularityLevel
+from shared.utils.job import JobUtils
+from shared.utils.tokenizer import CalibratedTokenizer
+
+
+@pytest.fixture
+def df_with_missing():
+    return pd.DataFrame({
+        "a": [1, 2, 3],
+        "b": ["x", "y", None],
+        "c": [1.5, np.nan, 2.0],
+    })
+
+
+def test_row_lengths_match_contents_with_missing_values(df_with_missing):
+    utils = JobUtils()
+    for granularity, focus_column in ((GranularityLevel.PER_ROW, None), (GranularityLevel.PER_CELL, "b")):
+        lengths = utils.row_lengths(df_with_missing, granularity, focus_column)
+        contents = utils.row_contents(df_with_missing, granularity, focus_column)
+        assert lengths.tolist() == contents.str.len().tolist()
+    assert "'b': None" in utils.row_contents(df_with_missing, GranularityLevel.PER_ROW)[2]
+
+
+def test_calibrated_tokenizer_counts_missing_texts_as_empty():
+    tokenizer = CalibratedTokenizer(4.0)
+    assert tokenizer.count_batch(pd.Series(["abcde", None])).tolist() == [2, 0]
+    assert tokenizer.count_lengths(pd.Series([5, np.nan])).tolist() == [2, 0]
+
+
+@pytest.mark.parametrize("granularity,focus_column", [(GranularityLevel.PER_ROW, None), (GranularityLevel.PER_CELL, "b")])
+def test_estimate_with_missing_values(df_with_missing, granularity, focus_column):
+    model = SimpleNamespace(provider="Meta", encoder="llama")
+    estimate, low, high = JobUtils().estimate_input_token_range(
+        df_with_missing, model, api_key=None, prompt_text="Resume",
+        granularity=granularity, focus_column=focus_column
+    )
+    assert 0 < low <= estimate <= high
+
+
+def test_google_counts_with_provider_api_in_provider_mode(monkeypatch, df_with_missing):
+    calls = []
+
+    def count_tokens(model, contents):
+        text = contents[0]["parts"][0]["text"]
+        calls.append(text)
+        return SimpleNamespace(total_tokens=len(text))
+
+    client = SimpleNamespace(models=SimpleNamespace(count_tokens=count_tokens))
+    monkeypatch.setattr("shared.utils.job.TOKEN_ESTIMATE_MODE", "provider")
+    monkeypatch.setattr("shared.utils.job.client_pool", SimpleNamespace(get=lambda api_key: client))
+    model = SimpleNamespace(provider="Google", encoder="gemini-2.0-flash")
+    estimate, low, high = JobUtils().estimate_input_token_range(df_with_missing, model, "key", "Resume")
+    assert calls
+    assert estimate == sum(JobUtils().row_lengths(df_with_missing, GranularityLevel.PER_ROW)) + 3 * len("Resume\n")
+
+
+def test_google_local_mode_stays_offline(monkeypatch, df_with_missing):
+    def get(api_key):
+        raise AssertionError("local mode must not call the provider")
+
+    monkeypatch.setattr("shared.utils.job.client_pool", SimpleNamespace(get=get))
+    model = SimpleNamespace(provider="Google", encoder="gemini-2.0-flash")
+    estimate, low, high = JobUtils().estimate_input_token_range(df_with_missing, model, "key", "Resume")
+    assert 0 < low < estimate < high
+
+
+def test_approximate_estimate_has_calibration_interval(df_with_missing):
+    model = SimpleNamespace(provider="Meta", encoder="llama")
+    estimate, low, high = JobUtils().estimate_input_token_range(df_with_missing, model, None, "Resume")
+    assert low < estimate < high
+
+
+def test_sampling_tolerates_missing_lengths():
+    from shared.utils.sampling import ratio_estimate, stratified_sample
+
+    lengths = pd.Series([10, 20, np.nan, 40, 50, 60, 70, 80, 90, 1000])
+    labels, sampled = stratified_sample(lengths, 6, strata=3)
+    estimate, low, high = ratio_estimate(lengths, labels, lengths.fillna(0).loc[sampled] / 4)
+    assert low <= estimate <= high
@@ -0,0 +1,82 @@
+"""Microbenchmark of the per-task overhead of running async work from a Celery task
+
+Compares the old pattern (a fresh event loop plus create_all for every task) with the
+persistent per-process loop used by main.run_async. Each simulated task opens a session
+and runs SELECT 1, which is the least work any real task does.
+
+Run it inside the worker container, where the database is reachable:
+
+    python bench.py --iterations 200
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from sqlalchemy import text
+
+from shared.db.db_engine import engine, init_db, SessionLocal
+
+
+async def touch_db():
+    async with SessionLocal() as session:
+        await session.execute(text("SELECT 1"))
+
+
+def fresh_loop_task():
+    """What every task used to do"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(init_db())
+        loop.run_until_complete(touch_db())
+    finally:
+        loop.close()
+        # Pooled connections belong to the closed loop and cannot be reused
+        engine.sync_engine.dispose(close=False)
+
+
+def persistent_loop_task(loop):
+    loop.run_until_complete(touch_db())
+
+
+def measure(task, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        task()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def report(name: str, timings: list) -> None:
+    ordered = sorted(timings)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    print(f"{name:<18} mean {statistics.mean(timings):8.2f} ms   median {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+    # The engine echoes every statement; keep it out of the timings
+    engine.echo = False
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    before = measure(fresh_loop_task, args.iterations)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    persistent_loop_task(loop)  # warm up the pool, as the first task of a process would
+    after = measure(lambda: persistent_loop_task(loop), args.iterations)
+    loop.run_until_complete(engine.dispose())
+    loop.close()
+
+    report("fresh loop", before)
+    report("persistent loop", after)
+    print(f"speedup            {statistics.mean(before) / statistics.mean(after):8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
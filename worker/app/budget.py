@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+from typing import Optional
+
+from shared.db.redis_engine import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a job's running spend is kept in Redis after its last update
+JOB_SPEND_TTL = int(os.getenv("JOB_SPEND_TTL", str(7 * 24 * 3600)))
+# Seconds a user's spend of a month is kept; longer than the month it counts
+USER_SPEND_TTL = int(os.getenv("USER_SPEND_TTL", str(40 * 24 * 3600)))
+
+
+def token_cost(input_tokens: int, output_tokens: int, cost_per_1m_input: int, cost_per_1m_output: int) -> int:
+    """Cost of the tokens in millionths of a cent, the unit spend is counted in"""
+    return input_tokens * cost_per_1m_input + output_tokens * cost_per_1m_output
+
+
+class SpendCounter:
+    """A running spend in Redis, shared by every worker process, with a limit in cents
+
+    Without Redis the spend is counted in this process only. already_spent seeds the
+    counter when Redis does not have it yet; once it exists, the Redis total wins.
+    """
+
+    def __init__(self, key: str, limit: Optional[int], ttl: int, already_spent: int = 0):
+        self.key = key
+        self.limit = limit
+        self.ttl = ttl
+        self._local = already_spent
+        self._lock = threading.Lock()
+        if limit is not None:
+            try:
+                get_redis().set(self.key, already_spent, ex=ttl, nx=True)
+            except Exception as e:
+                logger.warning(f"Could not initialize spend {self.key}: {str(e)}")
+
+    def add(self, cost: int) -> None:
+        if self.limit is None or not cost:
+            return
+        with self._lock:
+            self._local += cost
+        try:
+            pipe = get_redis().pipeline()
+            pipe.incrby(self.key, cost)
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not record spend {self.key}: {str(e)}")
+
+    def spent(self) -> int:
+        """Spend so far in millionths of a cent"""
+        with self._lock:
+            local = self._local
+        try:
+            return max(int(get_redis().get(self.key) or 0), local)
+        except Exception:
+            return local
+
+    def exceeded(self) -> bool:
+        return self.limit is not None and self.spent() >= self.limit * 1_000_000
+
+
+class SpendingCap:
+    """Running token cost of a job and of its user's month, checked before each request is sent
+
+    Every call is charged to both counters as its usage comes in, so concurrent jobs of
+    one user draw from the same monthly remainder instead of each seeing all of it.
+    Limits are in cents, None for no cap. Requests already in flight when a cap is
+    reached still finish, so a job may overshoot it by at most one round of concurrent
+    requests.
+    """
+
+    prefix = "tablemind:job_spend"
+    user_prefix = "tablemind:user_spend"
+
+    def __init__(
+            self,
+            job_id: str,
+            limit: Optional[int],
+            cost_per_1m_input: int,
+            cost_per_1m_output: int,
+            already_spent: int = 0,
+            user_id: Optional[str] = None,
+            month: Optional[str] = None,
+            monthly_limit: Optional[int] = None,
+            month_spent: int = 0,
+        ):
+        self.cost_per_1m_input = cost_per_1m_input
+        self.cost_per_1m_output = cost_per_1m_output
+        # Earlier runs of the job were billed too; keep the total if another chunk set it
+        self.job = SpendCounter(f"{self.prefix}:{job_id}", limit, JOB_SPEND_TTL, already_spent)
+        self.month = SpendCounter(f"{self.user_prefix}:{user_id}:{month}", monthly_limit, USER_SPEND_TTL, month_spent)
+
+    def add(self, input_tokens: int, output_tokens: int) -> None:
+        cost = token_cost(input_tokens, output_tokens, self.cost_per_1m_input, self.cost_per_1m_output)
+        self.job.add(cost)
+        self.month.add(cost)
+
+    def spent(self) -> int:
+        """Spend of the job so far in millionths of a cent"""
+        return self.job.spent()
+
+    def exceeded(self) -> bool:
+        return self.job.exceeded() or self.month.exceeded()
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, Optional
+
+from shared.db.redis_engine import get_redis
+from shared.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# "redis", "disk" or "off"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "redis").lower()
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "200000"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "/tmp/tablemind/response_cache")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+class RedisCacheBackend:
+    """Entries expire with their TTL; a sorted set of write times trims the oldest past max_entries"""
+
+    prefix = "tablemind:response_cache"
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @property
+    def index_key(self) -> str:
+        return f"{self.prefix}:index"
+
+    def get(self, key: str) -> Optional[str]:
+        return get_redis().get(f"{self.prefix}:{key}")
+
+    def set(self, key: str, value: str) -> None:
+        client = get_redis()
+        now = time.time()
+        pipe = client.pipeline()
+        pipe.set(f"{self.prefix}:{key}", value, ex=self.ttl)
+        pipe.zadd(self.index_key, {key: now})
+        pipe.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+        pipe.zcard(self.index_key)
+        size = pipe.execute()[-1]
+
+        excess = size - self.max_entries
+        if excess > 0:
+            evicted = [member for member, _ in client.zpopmin(self.index_key, excess)]
+            if evicted:
+                client.delete(*[f"{self.prefix}:{member}" for member in evicted])
+                metrics.incr("response_cache.evicted", len(evicted))
+
+
+class DiskCacheBackend:
+    """One file per entry; expired files are dropped on read and the oldest files go once over max_bytes"""
+
+    def __init__(self, directory: str, ttl: int, max_bytes: int, evict_every: int = 200):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        files = []
+        total = 0
+        now = time.time()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        files.sort()
+        evicted = 0
+        while total > self.max_bytes and files:
+            _, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        if evicted:
+            metrics.incr("response_cache.evicted", evicted)
+
+
+class ResponseCache:
+    """Cross-job cache of row outputs keyed by prompt, model, generation config and row data"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _normalize_prompt(self, prompt_text: str) -> str:
+        text = unicodedata.normalize("NFKC", prompt_text or "")
+        return re.sub(r"\s+", " ", text).strip()
+
+    def make_key(self, prompt_text: str, model_name: str, config: Dict[str, Any], data: Any) -> str:
+        payload = json.dumps(
+            {
+                "prompt": self._normalize_prompt(prompt_text),
+                "model": model_name,
+                "config": config,
+                "data": data,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Response cache read failed: {str(e)}")
+            value = None
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.incr("response_cache.misses" if value is None else "response_cache.hits")
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logger.warning(f"Response cache write failed: {str(e)}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return ResponseCache(RedisCacheBackend(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES))
+    if RESPONSE_CACHE_BACKEND == "disk":
+        return ResponseCache(DiskCacheBackend(RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES))
+    return None
+
+
+response_cache = build_response_cache()
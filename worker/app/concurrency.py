@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from shared.utils.metrics import metrics
+
+from retry import api_error, is_timeout_error
+
+logger = logging.getLogger(__name__)
+
+# Provider calls allowed at once when the worker process starts
+LLM_WORKER_CONCURRENCY = int(os.getenv("LLM_WORKER_CONCURRENCY", "16"))
+# Bounds the adaptive limit moves between
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+# Factor the limit is multiplied by on 429s, 503s and timeouts
+LLM_CONCURRENCY_BACKOFF = float(os.getenv("LLM_CONCURRENCY_BACKOFF", "0.5"))
+# A call counts as healthy while its latency stays under this multiple of the fastest recent call
+LLM_CONCURRENCY_LATENCY_FACTOR = float(os.getenv("LLM_CONCURRENCY_LATENCY_FACTOR", "3"))
+
+# Provider answers that mean it is taking more than it can handle
+OVERLOAD_STATUS_CODES = (429, 503, 504)
+OVERLOAD_STATUSES = ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED")
+
+
+def is_overload_error(error: Exception) -> bool:
+    """Whether a provider error means we are sending faster than it can take"""
+    provider_error = api_error(error)
+    if provider_error is not None:
+        return provider_error.code in OVERLOAD_STATUS_CODES or provider_error.status in OVERLOAD_STATUSES
+    return is_timeout_error(error)
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the provider calls in flight in this worker process
+
+    Each healthy call grows the limit by 1/limit, i.e. by one slot per round of calls.
+    A 429, 503 or timeout halves it (LLM_CONCURRENCY_BACKOFF), once per round: calls that
+    started before the last decrease don't cut it again. Slow calls hold the limit steady.
+    The current limit and in-flight count are exported as the llm.concurrency_limit and
+    llm.in_flight gauges.
+    """
+
+    def __init__(
+            self,
+            initial: int = LLM_WORKER_CONCURRENCY,
+            minimum: int = LLM_CONCURRENCY_MIN,
+            maximum: int = LLM_CONCURRENCY_MAX,
+            backoff: float = LLM_CONCURRENCY_BACKOFF,
+            latency_factor: float = LLM_CONCURRENCY_LATENCY_FACTOR,
+            window: int = 50
+        ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, interrupt: Optional[Callable[[], None]] = None) -> float:
+        """Wait for a free slot; returns the start time to hand back to release()
+
+        While waiting, `interrupt` is called about once a second; whatever it raises ends the wait.
+        """
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    limit, in_flight = int(self.limit), self.in_flight
+                    break
+                self._cond.wait(timeout=None if interrupt is None else 1.0)
+            if interrupt is not None:
+                # Outside the lock: the check may talk to Redis
+                interrupt()
+        self._export(limit, in_flight)
+        return time.monotonic()
+
+    def release(self, started: float, overloaded: bool = False, failed: bool = False) -> None:
+        """Free a slot and adjust the limit from how the call went"""
+        latency = time.monotonic() - started
+        decreased = False
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                if started >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = time.monotonic()
+                    decreased = True
+            elif not failed:
+                self._latencies.append(latency)
+                if latency <= min(self._latencies) * self.latency_factor:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            limit, in_flight = int(self.limit), self.in_flight
+            self._cond.notify_all()
+        if decreased:
+            metrics.incr("llm.concurrency_decreases")
+            logger.info(f"Provider overloaded, concurrency limit lowered to {limit}")
+        self._export(limit, in_flight)
+
+    def _export(self, limit: int, in_flight: int) -> None:
+        # Outside the lock: publishing may talk to Redis
+        metrics.gauge("llm.concurrency_limit", limit)
+        metrics.gauge("llm.in_flight", in_flight)
+
+
+concurrency_limiter = AdaptiveLimiter()
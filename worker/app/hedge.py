@@ -0,0 +1,81 @@
+import os
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+# Send a duplicate of slow requests on another API key
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+# A request is hedged once it has been running longer than this percentile of recent latencies
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+# Never hedge sooner than this many seconds, however fast the model usually is
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+# Hedges allowed per chunk as a share of its calls, which bounds the extra cost
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))
+# Latencies observed before a model's percentile is trusted
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model, shared by the worker process"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model_name: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(model_name)
+            if samples is None:
+                samples = self._samples[model_name] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model_name: str, p: float, min_samples: int = 1) -> Optional[float]:
+        """Latency below which a share p of recent calls finished, or None without enough data"""
+        with self._lock:
+            samples = sorted(self._samples.get(model_name) or ())
+        if len(samples) < max(1, min_samples):
+            return None
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
+class HedgeBudget:
+    """Decide when a chunk's request is hedged and cap how many hedges it may send
+
+    delay() is how long to wait for the first answer before hedging (None when the
+    model has too few observations). spend() takes one hedge out of a budget of
+    LLM_HEDGE_BUDGET times the calls made so far, with at least one hedge per chunk.
+    """
+
+    def __init__(
+            self,
+            tracker: LatencyTracker,
+            percentile: float = LLM_HEDGE_PERCENTILE,
+            budget: float = LLM_HEDGE_BUDGET,
+            min_delay: float = LLM_HEDGE_MIN_DELAY,
+            min_samples: int = LLM_HEDGE_MIN_SAMPLES
+        ):
+        self.tracker = tracker
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def delay(self, model_name: str) -> Optional[float]:
+        threshold = self.tracker.percentile(model_name, self.percentile, self.min_samples)
+        if threshold is None:
+            return None
+        return max(self.min_delay, threshold)
+
+    def spend(self, calls: int) -> bool:
+        with self._lock:
+            if self.spent >= max(1, int(calls * self.budget)):
+                return False
+            self.spent += 1
+            return True
+
+
+latency_tracker = LatencyTracker()
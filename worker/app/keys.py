@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ratelimit import RateLimit
+from retry import api_error
+
+logger = logging.getLogger(__name__)
+
+# Seconds a key stays out of rotation after the provider reports it out of quota
+KEY_POOL_COOLDOWN = float(os.getenv("KEY_POOL_COOLDOWN", "60"))
+
+def is_quota_error(error: Exception) -> bool:
+    """Whether a provider error means the key ran out of quota rather than the request being bad"""
+    provider_error = api_error(error)
+    return provider_error is not None and (provider_error.code == 429 or provider_error.status == "RESOURCE_EXHAUSTED")
+
+
+class PooledKey:
+    """One decrypted API key of a model together with its own rate limit"""
+
+    def __init__(self, key_id: str, api_key: str, rate_limit: Optional[RateLimit] = None):
+        self.key_id = key_id
+        self.api_key = api_key
+        self.rate_limit = rate_limit or RateLimit(f"key:{key_id}")
+        self.in_flight = 0
+        self.benched_until = 0.0
+
+
+class KeyPool:
+    """Spread the requests of a model over all of its active API keys
+
+    acquire() hands out the key with the fewest requests in flight, rotating between keys
+    that are tied, and skips keys benched after a quota error until their cooldown ends.
+    Every request sent is counted so usage_count/last_used can be written in one batch per chunk.
+    """
+
+    def __init__(self, keys: Iterable[PooledKey] = (), cooldown: float = KEY_POOL_COOLDOWN):
+        self.cooldown = cooldown
+        self._keys: Dict[str, PooledKey] = {}
+        self._usage: Dict[str, Tuple[int, float]] = {}
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self.update(keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def keys(self) -> List[PooledKey]:
+        with self._lock:
+            return list(self._keys.values())
+
+    def update(self, keys: Iterable[PooledKey]) -> None:
+        """Replace the set of keys, keeping the load and bench state of keys that stay"""
+        with self._lock:
+            fresh = {}
+            for key in keys:
+                current = self._keys.get(key.key_id)
+                if current is not None:
+                    current.api_key = key.api_key
+                    current.rate_limit = key.rate_limit
+                    key = current
+                fresh[key.key_id] = key
+            self._keys = fresh
+
+    def acquire(self, exclude: Iterable[str] = ()) -> PooledKey:
+        """Lease the least loaded key that is not benched; release() it when the call is done"""
+        excluded = set(exclude)
+        with self._lock:
+            keys = [key for key in self._keys.values() if key.key_id not in excluded] or list(self._keys.values())
+            if not keys:
+                raise LookupError("Key pool is empty")
+            now = time.monotonic()
+            ready = [key for key in keys if key.benched_until <= now]
+            if not ready:
+                # Every key is cooling down: use the one that comes back first
+                ready = [min(keys, key=lambda key: key.benched_until)]
+            lowest = min(key.in_flight for key in ready)
+            tied = [key for key in ready if key.in_flight == lowest]
+            chosen = tied[self._cursor % len(tied)]
+            self._cursor += 1
+            chosen.in_flight += 1
+            return chosen
+
+    def release(self, key: PooledKey, quota_error: bool = False, sent: bool = True) -> None:
+        """Return a leased key, counting the call if it was sent and benching the key on a quota error"""
+        with self._lock:
+            key.in_flight = max(0, key.in_flight - 1)
+            if sent:
+                count, _ = self._usage.get(key.key_id, (0, 0.0))
+                self._usage[key.key_id] = (count + 1, time.time())
+            if quota_error:
+                key.benched_until = time.monotonic() + self.cooldown
+                logger.warning(f"API key {key.key_id} hit its quota, out of rotation for {self.cooldown:.0f}s")
+
+    def drain_usage(self) -> Dict[str, Tuple[int, float]]:
+        """Calls made per key id since the last drain as (count, last used epoch seconds)"""
+        with self._lock:
+            usage, self._usage = self._usage, {}
+        return usage
+
+    def stats(self) -> List[Dict[str, object]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {"key_id": key.key_id, "in_flight": key.in_flight, "benched": key.benched_until > now}
+                for key in self._keys.values()
+            ]
+
+
+_pools: Dict[str, KeyPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_key_pool(scope: str, keys: Iterable[PooledKey]) -> KeyPool:
+    """Process-wide pool for a model, shared by every chunk so load and benching carry over"""
+    with _pools_lock:
+        pool = _pools.get(scope)
+        if pool is None:
+            pool = _pools[scope] = KeyPool(keys)
+            return pool
+    pool.update(keys)
+    return pool
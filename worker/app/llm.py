@@ -1,40 +1,521 @@
 import json
 import os
 import datetime
-from typing import Dict, Any
-from google import genai
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed, wait
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from google.genai import types
 
+from shared.utils.cancel import CancelFlag
+from shared.utils.clients import client_pool
+from shared.utils.metrics import metrics
+
+from ratelimit import RateLimit, rate_limiter
+from keys import KeyPool, PooledKey, is_quota_error
+from concurrency import concurrency_limiter, is_overload_error
+from retry import CircuitOpenError, RetryPolicy, get_breaker, is_transient_error, retry_policy
+from hedge import LLM_HEDGE_ENABLED, HedgeBudget, latency_tracker
+from router import ModelGroup, model_router
+from budget import SpendingCap
+
+# Threads sending the rows of a single chunk; they only wait for adaptive concurrency slots,
+# so by default there are enough of them for the limit to grow to LLM_CONCURRENCY_MAX
+LLM_CHUNK_CONCURRENCY = int(os.getenv("LLM_CHUNK_CONCURRENCY", os.getenv("LLM_CONCURRENCY_MAX", "64")))
+
+# Rows packed into one request in batch mode (1 sends every row on its own)
+LLM_ROWS_PER_REQUEST = int(os.getenv("LLM_ROWS_PER_REQUEST", "1"))
+# Share of the model's max_input_tokens a batched request may use
+LLM_BATCH_INPUT_FRACTION = float(os.getenv("LLM_BATCH_INPUT_FRACTION", "0.5"))
+
+# Seconds a single provider request may take before it is abandoned (and retried)
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+# Seconds a row (or batch) may spend across all of its attempts, backoff included
+LLM_ROW_DEADLINE = float(os.getenv("LLM_ROW_DEADLINE", "300"))
+
+# Save the rows finished so far after this many new rows or seconds, whichever comes first
+CHUNK_CHECKPOINT_ROWS = int(os.getenv("CHUNK_CHECKPOINT_ROWS", "20"))
+CHUNK_CHECKPOINT_INTERVAL = float(os.getenv("CHUNK_CHECKPOINT_INTERVAL", "10"))
+
+# Runs first attempts and their hedges when hedging is on; threads are only started on use
+_hedge_executor = ThreadPoolExecutor(max_workers=2 * max(1, LLM_CHUNK_CONCURRENCY), thread_name_prefix="hedge")
+
 class GenerationException(Exception):
     """Custom exception for generation errors."""
     pass
 
 
+class DeadlineExceeded(Exception):
+    """Raised when a row runs out of time before it got an answer."""
+    pass
+
+
+class JobStopped(Exception):
+    """Raised instead of sending a request once the job was cancelled or ran out of time or budget."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Job stopped: {reason}")
+        self.reason = reason
+
+
+class Usage:
+    """Tokens, calls and provider time reported for the requests made for a row, batch or chunk
+
+    Every call that got an answer is counted, retries and hedges included, and is added
+    to the parent as well, so a chunk's Usage totals what its rows really consumed.
+    Responses cut off at maxOutputTokens are counted as truncated. on_add(input_tokens,
+    output_tokens) is told about every call, e.g. to charge a SpendingCap.
+    """
+
+    def __init__(self, parent: Optional["Usage"] = None, on_add=None):
+        self.parent = parent
+        self.on_add = on_add
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.calls = 0
+        self.latency = 0.0
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    def add(self, input_tokens: int, output_tokens: int, seconds: float, truncated: bool = False) -> None:
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.calls += 1
+            self.latency += seconds
+            self.truncated += int(truncated)
+        if self.parent is not None:
+            self.parent.add(input_tokens, output_tokens, seconds, truncated)
+        if self.on_add is not None:
+            self.on_add(input_tokens, output_tokens)
+
+    def as_dict(self, shared_by: int = 1) -> Dict[str, Any]:
+        """Totals as stored in output_data; shared_by splits a batched request among its rows"""
+        with self._lock:
+            usage = {
+                "input_tokens": self.input_tokens // shared_by,
+                "output_tokens": self.output_tokens // shared_by,
+                "calls": self.calls,
+                "latency_ms": round(self.latency * 1000),
+                "truncated": self.truncated,
+            }
+        if shared_by > 1:
+            usage["batched"] = shared_by
+        return usage
+
+
+class ChunkContext:
+    """Settings shared by every request made for one chunk, and the retry counters it collects
+
+    Requests are routed among the members of model_group, which defaults to model_name alone.
+    The tokens used are charged to spending_cap, if any, and no request is started once
+    cancel_flag is set.
+    """
+
+    def __init__(
+            self,
+            prompt_text: str,
+            model_name: str,
+            key_pool: KeyPool,
+            verbosity: float,
+            maxOutputTokens: int,
+            rate_limits: Optional[List[RateLimit]] = None,
+            retry_policy: RetryPolicy = retry_policy,
+            model_rate_limits: Optional[Dict[str, RateLimit]] = None,
+            hedge: Optional[HedgeBudget] = None,
+            model_group: Optional[ModelGroup] = None,
+            deadline: Optional[float] = None,
+            spending_cap: Optional[SpendingCap] = None,
+            cancel_flag: Optional[CancelFlag] = None,
+            time_limit: Optional[float] = None
+        ):
+        self.prompt_text = prompt_text
+        self.model_name = model_name
+        self.key_pool = key_pool
+        self.verbosity = verbosity
+        self.maxOutputTokens = maxOutputTokens
+        self.rate_limits = rate_limits or []
+        self.model_rate_limits = model_rate_limits or {}  # per group member, charged only when it is called
+        self.retry_policy = retry_policy
+        self.hedge = hedge
+        self.model_group = model_group or ModelGroup(model_name)
+        self.deadline = deadline  # epoch seconds the job must stop by, None for no limit
+        self.spending_cap = spending_cap
+        self.cancel_flag = cancel_flag
+        self.time_limit = time_limit  # epoch seconds the task must hand the chunk back by, None for no limit
+        self.usage = Usage(on_add=spending_cap.add if spending_cap is not None else None)
+        self.stopped: Optional[str] = None  # why rows were skipped: 'cancelled', 'deadline', 'budget' or 'time_limit'
+        self.counters = {
+            "calls": 0, "retries": 0, "transient_errors": 0, "circuit_open": 0,
+            "hedges": 0, "hedges_won": 0, "deadline_exceeded": 0, "rows_skipped": 0,
+        }
+        self.calls_by_model: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def job_expired(self) -> bool:
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def stop_reason(self) -> Optional[str]:
+        """Why no new request may be started for the chunk, or None"""
+        if self.cancel_flag is not None and self.cancel_flag.is_set():
+            return "cancelled"
+        if self.job_expired():
+            return "deadline"
+        if self.spending_cap is not None and self.spending_cap.exceeded():
+            return "budget"
+        if self.time_limit is not None and time.time() >= self.time_limit:
+            return "time_limit"
+        return None
+
+    def stop(self, reason: str) -> None:
+        with self._lock:
+            self.stopped = self.stopped or reason
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def count_model(self, model_name: str) -> None:
+        with self._lock:
+            self.calls_by_model[model_name] = self.calls_by_model.get(model_name, 0) + 1
+
+    def diagnostics(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+            counters["calls_by_model"] = dict(self.calls_by_model)
+        counters["breakers"] = {name: get_breaker(name).snapshot() for name in self.model_group.members}
+        counters["models"] = model_router.snapshot(self.model_group)
+        return counters
+
+
+class RowClock:
+    """The LLM_ROW_DEADLINE of one _call, started when its first request is actually sent
+
+    Time spent waiting for rate-limit or concurrency capacity before that does not
+    count, so a throttled row waits as long as the job allows instead of timing out in
+    the queue. interrupt() is handed to those waits; start() is called right before a
+    request goes out, or when the row starts waiting for a circuit breaker.
+    """
+
+    def __init__(self, ctx: ChunkContext):
+        self.ctx = ctx
+        self.deadline: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self.deadline is None:
+                self.deadline = time.time() + LLM_ROW_DEADLINE
+
+    def remaining(self) -> float:
+        """Seconds left for the row, the job deadline included; a full row deadline until the first send"""
+        with self._lock:
+            deadline = self.deadline if self.deadline is not None else time.time() + LLM_ROW_DEADLINE
+        if self.ctx.deadline is not None:
+            deadline = min(deadline, self.ctx.deadline)
+        return deadline - time.time()
+
+    def interrupt(self) -> None:
+        # Ends rate-limit and concurrency waits the way the checks of _call end attempts
+        stop_reason = self.ctx.stop_reason()
+        if stop_reason:
+            raise JobStopped(stop_reason)
+        with self._lock:
+            started = self.deadline is not None
+        if started and self.remaining() <= 0:
+            raise DeadlineExceeded("No answer within the row deadline while waiting for capacity")
+
+
+class SentFlag:
+    """The RowClock as handed to one request, recording whether the request was sent
+
+    A request stopped while it waits for capacity never reaches the provider, so its
+    key is released without counting it as used.
+    """
+
+    def __init__(self, clock: RowClock):
+        self.clock = clock
+        self.sent = False
+
+    def start(self) -> None:
+        self.sent = True
+        self.clock.start()
+
+    def interrupt(self) -> None:
+        self.clock.interrupt()
+
+
+def _call(ctx: ChunkContext, send) -> Tuple[Any, str]:
+    """Call send(api_key, rate_limits, model_name, timeout, clock) under the retry policy and circuit breakers
+
+    Returns the answer and the member of the model group that gave it.
+
+    Each attempt goes to the member of the chunk's model group that model_router rates
+    healthiest and fastest, skipping members whose breaker is open; when none is left
+    the call waits for the first breaker to let a probe through, and raises
+    CircuitOpenError only if that is past the row deadline. Transient errors (throttling, 5xx,
+    timeouts) are retried up to retry_policy.attempts calls; other errors are tried once
+    on each other member of the group and then raised. A retry moves straight to another live member or, on a quota error, another
+    key; only when there is none left does it wait with exponential backoff and jitter.
+
+    Each attempt is cut off after LLM_REQUEST_TIMEOUT seconds, and the whole call
+    LLM_ROW_DEADLINE seconds after its first request was sent or at the job deadline,
+    whichever comes first, raising DeadlineExceeded (see RowClock). No attempt is
+    started, and waits are cut short, once the job is cancelled, past its deadline or
+    out of budget (JobStopped).
+    """
+    clock = RowClock(ctx)
+    quota_keys = set()
+    failed_models = set()
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = clock.remaining()
+        if remaining <= 0:
+            ctx.count("deadline_exceeded")
+            raise DeadlineExceeded(f"No answer within the row deadline after {attempt - 1} attempts")
+        stop_reason = ctx.stop_reason()
+        if stop_reason:
+            raise JobStopped(stop_reason)
+        model_name = model_router.choose(ctx.model_group, avoid=failed_models)
+        if model_name is None:
+            ctx.count("circuit_open")
+            _wait_for_breaker(ctx, clock)
+            attempt -= 1  # nothing was sent
+            continue
+        breaker = get_breaker(model_name)
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            # Another request is probing this model; try a different one if there is any
+            ctx.count("circuit_open")
+            failed_models.add(model_name)
+            if len(failed_models) >= len(ctx.model_group):
+                _wait_for_breaker(ctx, clock)
+                failed_models.clear()
+            attempt -= 1
+            continue
+        key = ctx.key_pool.acquire(exclude=quota_keys)
+        ctx.count("calls")
+        ctx.count_model(model_name)
+        quota_error = False
+        try:
+            result = _send(ctx, key, send, model_name, min(LLM_REQUEST_TIMEOUT, remaining), clock)
+            breaker.record_success()
+            return result, model_name
+        except (JobStopped, DeadlineExceeded) as e:
+            # Stopped while waiting for capacity: nothing was sent
+            breaker.release_probe()
+            if isinstance(e, DeadlineExceeded):
+                ctx.count("deadline_exceeded")
+            raise
+        except Exception as e:
+            quota_error = is_quota_error(e)
+            transient = is_transient_error(e)
+            if transient:
+                ctx.count("transient_errors")
+            if transient and not quota_error:
+                breaker.record_failure()
+            else:
+                breaker.release_probe()
+            if not transient:
+                # Rejected by this model (retired, unsupported parameter): another member may take it
+                failed_models.add(model_name)
+                if attempt >= ctx.retry_policy.attempts or len(failed_models) >= len(ctx.model_group):
+                    raise
+                ctx.count("retries")
+                print(f"WARNING: attempt {attempt} on {model_name} failed, trying another model of the group: {str(e)}")
+                continue
+            if attempt >= ctx.retry_policy.attempts:
+                raise
+            ctx.count("retries")
+            if quota_error:
+                quota_keys.add(key.key_id)
+            else:
+                failed_models.add(model_name)
+            print(f"WARNING: attempt {attempt} on {model_name} failed with a transient error, retrying: {str(e)}")
+        if quota_error and len(quota_keys) < len(ctx.key_pool):
+            continue  # another key may still have quota
+        if not quota_error and len(failed_models) < len(ctx.model_group):
+            continue  # fail over to another member of the group
+        _backoff(ctx, min(ctx.retry_policy.delay(attempt), clock.remaining()))
+
+
+def _wait_for_breaker(ctx: ChunkContext, clock: RowClock) -> None:
+    """Wait until the breaker of some member of the group lets a call through
+
+    The wait counts against the row deadline; CircuitOpenError once it would run past it.
+    """
+    clock.start()
+    wait = max(0.05, min(get_breaker(name).retry_in() for name in ctx.model_group.members))
+    if wait >= clock.remaining():
+        raise CircuitOpenError(f"Circuit breaker open for every model of the group of {ctx.model_name}")
+    _backoff(ctx, wait)
+    stop_reason = ctx.stop_reason()
+    if stop_reason:
+        raise JobStopped(stop_reason)
+
+
+def _backoff(ctx: ChunkContext, seconds: float) -> None:
+    """Sleep between attempts, waking up early if the job is stopped meanwhile"""
+    until = time.monotonic() + max(0.0, seconds)
+    while not ctx.stop_reason():
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(1.0, remaining))
+
+
+def _limits(ctx: ChunkContext, key: PooledKey, model_name: str) -> List[RateLimit]:
+    """Buckets a request to model_name on key waits in: the shared ones, the member's model and the key"""
+    model_limit = ctx.model_rate_limits.get(model_name)
+    return ctx.rate_limits + ([model_limit] if model_limit is not None else []) + [key.rate_limit]
+
+
+def _send(ctx: ChunkContext, key: PooledKey, send, model_name: str, timeout: float, clock: RowClock):
+    """Make one attempt on the leased key, hedging it on a second key if it runs slow
+
+    With hedging on, the attempt runs in the hedge executor. If it has not answered
+    within the model's latency percentile and the chunk's hedge budget allows it, the
+    same request is sent on another key and the first successful answer wins. The
+    slower request cannot be cancelled; its answer is dropped when it arrives.
+
+    Releases the leased key (and the hedge key) once the request on it has returned, not
+    when the answer is, so a key stays counted as busy while a dropped request runs on.
+    The key's usage is counted only if the request was actually sent (see SentFlag).
+    """
+    delay = ctx.hedge.delay(model_name) if ctx.hedge is not None and len(ctx.key_pool) > 1 else None
+    request = SentFlag(clock)
+    if delay is None:
+        quota_error = False
+        try:
+            return send(key.api_key, _limits(ctx, key, model_name), model_name, timeout, request)
+        except Exception as e:
+            quota_error = is_quota_error(e)
+            raise
+        finally:
+            ctx.key_pool.release(key, quota_error=quota_error, sent=request.sent)
+
+    primary = _hedge_executor.submit(send, key.api_key, _limits(ctx, key, model_name), model_name, timeout, request)
+    _release_when_done(ctx, key, primary, request)
+    try:
+        return primary.result(timeout=delay)
+    except FuturesTimeout:
+        pass
+    if not ctx.hedge.spend(ctx.counters["calls"]):
+        return primary.result()
+
+    hedge_key = ctx.key_pool.acquire(exclude=[key.key_id])
+    ctx.count("hedges")
+    print(f"DEBUG: Request on key {key.key_id} slower than {delay:.1f}s, hedging on key {hedge_key.key_id}")
+    hedge_request = SentFlag(clock)
+    hedged = _hedge_executor.submit(send, hedge_key.api_key, _limits(ctx, hedge_key, model_name), model_name, timeout, hedge_request)
+    _release_when_done(ctx, hedge_key, hedged, hedge_request)
+    done, _ = wait([primary, hedged], return_when=FIRST_COMPLETED)
+    first = done.pop()
+    if first.exception() is None:
+        if first is hedged:
+            ctx.count("hedges_won")
+        return first.result()
+    # The first to finish failed: the other one decides
+    other = hedged if first is primary else primary
+    if other is hedged and other.exception() is None:
+        ctx.count("hedges_won")
+    return other.result()
+
+
+def _release_when_done(ctx: ChunkContext, key: PooledKey, future, request: SentFlag) -> None:
+    """Release the key when the request running on it returns, benching it on a quota error"""
+    future.add_done_callback(lambda done: ctx.key_pool.release(
+        key, quota_error=done.exception() is not None and is_quota_error(done.exception()), sent=request.sent
+    ))
+
+
 def generate_response(
         prompt_text: str,
         data: str,
         model_name: str,
         api_key: str,
         verbosity: float = 0.2,
-        maxOutputTokens: int = 60000
+        maxOutputTokens: int = 60000,
+        rate_limits: Optional[List[RateLimit]] = None,
+        timeout: Optional[float] = None,
+        usage: Optional[Usage] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+        on_send: Optional[Callable[[], None]] = None
     ):
+    input_text = f"""
+        PROMPT: {prompt_text}
+        
+        DATA: {data}
+        
+        Please analyze the data according to the prompt. Provide a concise, insightful analysis.
+        """
+    return _generate(
+        input_text, model_name, api_key, verbosity, maxOutputTokens,
+        rate_limits=rate_limits, timeout=timeout, usage=usage, interrupt=interrupt, on_send=on_send
+    )
+
 
+def generate_batch_response(
+        prompt_text: str,
+        rows: List[Tuple[Any, Any]],
+        model_name: str,
+        api_key: str,
+        verbosity: float = 0.2,
+        maxOutputTokens: int = 60000,
+        rate_limits: Optional[List[RateLimit]] = None,
+        timeout: Optional[float] = None,
+        usage: Optional[Usage] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+        on_send: Optional[Callable[[], None]] = None
+    ):
+    """Ask for the analysis of several (row, data) pairs in one request, answered as a JSON array"""
+    data = json.dumps([{"row": row_idx, "data": row_data} for row_idx, row_data in rows])
+    input_text = f"""
+        PROMPT: {prompt_text}
+        
+        DATA: a JSON array of rows, each with its "row" id and its "data": {data}
+        
+        Please analyze the data of each row independently according to the prompt. Provide a concise, insightful analysis for every row.
+        Respond only with a JSON array holding one object per row, in the form {{"row": <row id>, "output": "<analysis>"}}.
+        """
+    return _generate(
+        input_text, model_name, api_key, verbosity, maxOutputTokens,
+        response_mime_type="application/json", rate_limits=rate_limits, timeout=timeout, usage=usage,
+        interrupt=interrupt, on_send=on_send
+    )
+
+
+def _generate(
+        input_text: str,
+        model_name: str,
+        api_key: str,
+        verbosity: float,
+        maxOutputTokens: int,
+        response_mime_type: Optional[str] = None,
+        rate_limits: Optional[List[RateLimit]] = None,
+        timeout: Optional[float] = None,
+        usage: Optional[Usage] = None,
+        interrupt: Optional[Callable[[], None]] = None,
+        on_send: Optional[Callable[[], None]] = None
+    ):
+    """Send one request, waiting for rate-limit capacity and an adaptive concurrency slot first
+
+    The provider call is abandoned after `timeout` seconds. Failures are raised as
+    GenerationException; retrying them is up to the caller. Whatever `interrupt` raises
+    while waiting (JobStopped, DeadlineExceeded) is passed through as is, and on_send is
+    called once the request is about to go out. The tokens the provider reports for the
+    answer are added to `usage`.
+    """
     try:
         print(f"DEBUG: Using model name: {model_name}")
         
         # Validate model name or use default
-        fallback_models = ["gemini-1.5-flash", "gemini-1.0-pro", "gemini-pro"]
         if not model_name or model_name.strip() == "":
             print("WARNING: Empty model name provided, using fallback")
-            model_name = fallback_models[0]
-        
-        input_text = f"""
-        PROMPT: {prompt_text}
+            model_name = "gemini-1.5-flash"
         
-        DATA: {data}
-        
-        Please analyze the data according to the prompt. Provide a concise, insightful analysis.
-        """
         contents = [
             {
                 "role": "user",
@@ -42,50 +523,367 @@ def generate_response(
             }
         ]
 
-        print(f"DEBUG: Initializing Gemini client with API key length: {len(api_key) if api_key else 0}")
-        client = genai.Client(api_key=api_key)
-        
-        for attempt_model in [model_name] + fallback_models:
-            try:
-                print(f"DEBUG: Attempting with model: {attempt_model}, temperature: {verbosity}, maxOutputTokens: {maxOutputTokens}")
-                response = client.models.generate_content(
-                    model=attempt_model,
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        temperature=verbosity,
-                        top_p=verbosity,
-                        maxOutputTokens=maxOutputTokens,
-                    )
+        client = client_pool.get(api_key)
+        # Only the prompt can be estimated up front; the rest is debited once the usage is known
+        reserved = _approx_tokens(input_text)
+        rate_limiter.acquire(rate_limits, reserved, interrupt=interrupt)
+        
+        started = concurrency_limiter.acquire(interrupt=interrupt)
+        overloaded = False
+        failed = True
+        try:
+            print(f"DEBUG: Attempting with model: {model_name}, temperature: {verbosity}, maxOutputTokens: {maxOutputTokens}")
+            if on_send is not None:
+                on_send()
+            response = client.models.generate_content(
+                model=model_name,
+                contents=contents,
+                config=types.GenerateContentConfig(
+                    temperature=verbosity,
+                    top_p=verbosity,
+                    maxOutputTokens=maxOutputTokens,
+                    response_mime_type=response_mime_type,
+                    http_options=types.HttpOptions(timeout=int(timeout * 1000)) if timeout else None,
                 )
-                print(f"DEBUG: Successfully got response from Gemini API using model {attempt_model}")
-                return response.text
-            except Exception as model_error:
-                print(f"ERROR with model {attempt_model}: {str(model_error)}")
-                if attempt_model == fallback_models[-1]:
-                    # If we've tried all models and still failed, raise the exception
-                    raise
-                else:
-                    print(f"Trying fallback model...")
-                    continue
+            )
+            print(f"DEBUG: Successfully got response from Gemini API using model {model_name}")
+            latency = time.monotonic() - started
+            latency_tracker.observe(model_name, latency)
+            model_router.record(model_name, True)
+            failed = False
+            used = _record_usage(response, input_text, latency, usage)
+            rate_limiter.debit(rate_limits, used - reserved)
+            return response.text
+        except Exception as model_error:
+            overloaded = is_overload_error(model_error)
+            if is_transient_error(model_error):
+                model_router.record(model_name, False)
+            raise
+        finally:
+            concurrency_limiter.release(started, overloaded=overloaded, failed=failed)
 
+    except (JobStopped, DeadlineExceeded):
+        raise
     except Exception as e:
-        print(f"ERROR: Failed to generate content after all attempts: {str(e)}")
-        raise GenerationException(f"Failed to generate content: {str(e)}")
+        print(f"ERROR: Failed to generate content: {str(e)}")
+        raise GenerationException(f"Failed to generate content: {str(e)}") from e
+
+
+def _record_usage(response: Any, input_text: str, seconds: float, usage: Optional[Usage]) -> int:
+    """Add the token counts of a response's usage_metadata to usage and the llm.* token metrics
+
+    Responses without usage metadata are counted with the 4 characters per token rule.
+    Returns the tokens the request used, input and output together.
+    """
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is not None and metadata.prompt_token_count is not None:
+        input_tokens = metadata.prompt_token_count
+        # Thinking tokens are billed as output
+        output_tokens = (metadata.candidates_token_count or 0) + (getattr(metadata, "thoughts_token_count", None) or 0)
+    else:
+        input_tokens = _approx_tokens(input_text)
+        output_tokens = _approx_tokens(response.text or "")
+    candidates = getattr(response, "candidates", None) or []
+    truncated = bool(candidates) and "MAX_TOKENS" in str(getattr(candidates[0], "finish_reason", ""))
+
+    metrics.incr("llm.input_tokens", input_tokens)
+    metrics.incr("llm.output_tokens", output_tokens)
+    if truncated:
+        metrics.incr("llm.truncated_responses")
+    if usage is not None:
+        usage.add(input_tokens, output_tokens, seconds, truncated)
+    return input_tokens + output_tokens
+
+
+def _process_row(idx: int, item: Dict[str, Any], ctx: ChunkContext) -> Dict[str, Any]:
+    """Run a single source row through the model and return its output_data entry
+
+    The entry's 'usage' holds the tokens, calls and provider time the row took.
+    """
+    row_idx = item.get("row", idx)
+    usage = Usage(ctx.usage)
+    
+    try:
+        # Process each row individually
+        row_data = json.dumps(item["data"])
+        print(f"DEBUG: Processing row {idx} (original index: {row_idx}) with model: {ctx.model_name}")
+        row_response, answered_by = _call(ctx, lambda api_key, rate_limits, model_name, timeout, clock: generate_response(
+            ctx.prompt_text, row_data, model_name, api_key,
+            ctx.verbosity, min(ctx.maxOutputTokens, 10000),  # Smaller token limit for single rows
+            rate_limits=rate_limits, timeout=timeout, usage=usage,
+            interrupt=clock.interrupt, on_send=clock.start
+        ))
+        print(f"DEBUG: Successfully processed row {idx}")
+        
+        return {
+            "row": row_idx,
+            "input": item["data"],
+            "output": _clean_output(row_response),
+            "model": answered_by,
+            "usage": usage.as_dict()
+        }
+    except Exception as e:
+        if isinstance(e, JobStopped):
+            return _skipped_entry(idx, item, ctx, e.reason)
+        if isinstance(e, DeadlineExceeded) and ctx.job_expired():
+            return _skipped_entry(idx, item, ctx, "deadline")
+        # If individual processing fails, add error message
+        error_msg = f"Error processing this row: {str(e)}"
+        print(f"ERROR processing row {idx}: {str(e)}")
+        return {
+            "row": row_idx,
+            "input": item["data"],
+            "output": error_msg,
+            "status": "error",
+            "usage": usage.as_dict()
+        }
+
+
+def _skipped_entry(idx: int, item: Dict[str, Any], ctx: ChunkContext, reason: str) -> Dict[str, Any]:
+    """output_data entry for a row left unprocessed because the job ran out of time or budget"""
+    ctx.count("rows_skipped")
+    ctx.stop(reason)
+    return {
+        "row": item.get("row", idx),
+        "input": item["data"],
+        "output": None,
+        "status": "skipped"
+    }
+
+
+def _clean_output(response: Any) -> str:
+    """Ensure a model response is well-formatted for Excel output"""
+    formatted_response = response.strip() if isinstance(response, str) else str(response)
+    # Remove any markdown formatting if present
+    if formatted_response.startswith("```") and "```" in formatted_response[3:]:
+        # Extract content between markdown code blocks
+        parts = formatted_response.split("```")
+        if len(parts) >= 3:  # At least one code block
+            formatted_response = parts[1].strip()
+            # Drop the language tag of fenced blocks such as ```json
+            if formatted_response.startswith("json\n"):
+                formatted_response = formatted_response[5:].strip()
+    return formatted_response
+
+
+def _approx_tokens(text: str) -> int:
+    # Same 4 characters per token rule the estimator falls back to
+    return len(text) // 4 + 1
+
+
+def _pack_batches(
+        indexed_rows: List[Tuple[int, Dict[str, Any]]],
+        prompt_text: str,
+        rows_per_request: int,
+        max_input_tokens: Optional[int]
+    ) -> List[List[Tuple[int, Dict[str, Any]]]]:
+    """Group rows into requests of at most rows_per_request rows that fit the model's input budget"""
+    budget = int(max_input_tokens * LLM_BATCH_INPUT_FRACTION) if max_input_tokens else None
+    base_tokens = _approx_tokens(prompt_text) + 100  # instructions wrapped around the rows
+
+    batches = []
+    current = []
+    current_tokens = base_tokens
+    for idx, item in indexed_rows:
+        row_tokens = _approx_tokens(json.dumps(item["data"])) + 10
+        full = len(current) >= rows_per_request
+        over_budget = budget is not None and current_tokens + row_tokens > budget
+        if current and (full or over_budget):
+            batches.append(current)
+            current = []
+            current_tokens = base_tokens
+        current.append((idx, item))
+        current_tokens += row_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _parse_batch_output(response: Any) -> Dict[str, str]:
+    """Map each row id found in a batched JSON answer to its output text"""
+    try:
+        parsed = json.loads(_clean_output(response))
+    except (TypeError, ValueError):
+        return {}
+    if isinstance(parsed, dict):
+        # Some answers wrap the array, e.g. {"results": [...]}
+        parsed = next((value for value in parsed.values() if isinstance(value, list)), [])
+    if not isinstance(parsed, list):
+        return {}
+
+    outputs = {}
+    for entry in parsed:
+        if not isinstance(entry, dict) or "row" not in entry or entry.get("output") in (None, ""):
+            continue
+        output = entry["output"]
+        outputs[str(entry["row"])] = output.strip() if isinstance(output, str) else json.dumps(output)
+    return outputs
+
+
+def _process_batch(batch: List[Tuple[int, Dict[str, Any]]], ctx: ChunkContext) -> List[Dict[str, Any]]:
+    """Run several rows through one request, retrying rows the model dropped or mangled one by one"""
+    if len(batch) == 1:
+        idx, item = batch[0]
+        return [_process_row(idx, item, ctx)]
+
+    rows = [(item.get("row", idx), item["data"]) for idx, item in batch]
+    usage = Usage(ctx.usage)
+    try:
+        print(f"DEBUG: Processing {len(batch)} rows in one request with model: {ctx.model_name}")
+        batch_response, answered_by = _call(ctx, lambda api_key, rate_limits, model_name, timeout, clock: generate_batch_response(
+            ctx.prompt_text, rows, model_name, api_key,
+            ctx.verbosity, min(ctx.maxOutputTokens, 10000 * len(batch)),
+            rate_limits=rate_limits, timeout=timeout, usage=usage,
+            interrupt=clock.interrupt, on_send=clock.start
+        ))
+        outputs = _parse_batch_output(batch_response)
+    except Exception as e:
+        print(f"ERROR processing batch of {len(batch)} rows: {str(e)}")
+        outputs = {}
+
+    results = []
+    for (idx, item), (row_idx, row_data) in zip(batch, rows):
+        if str(row_idx) in outputs:
+            results.append({
+                "row": row_idx,
+                "input": row_data,
+                "output": outputs[str(row_idx)],
+                "model": answered_by,
+                "usage": usage.as_dict(shared_by=len(batch))
+            })
+        else:
+            print(f"WARNING: Row {row_idx} missing from batched answer, retrying it on its own")
+            results.append(_process_row(idx, item, ctx))
+    return results
+
+
+def _duplicate_entry(idx: int, item: Dict[str, Any], original: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """output_data entry for a row that repeats the payload of an earlier row of the job"""
+    entry = {
+        "row": item.get("row", idx),
+        "input": item["data"],
+        "output": None,
+        "duplicate_of": item["duplicate_of"]
+    }
+    if original is not None:
+        entry["output"] = original["output"]
+        if original.get("status"):
+            entry["status"] = original["status"]
+    return entry
+
+
+def _resumable_entries(completed_rows: Optional[List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Rows of an earlier run that already have an answer, by row id; failed rows are sent again"""
+    done = {}
+    for entry in completed_rows or []:
+        if not isinstance(entry, dict) or "duplicate_of" in entry:
+            continue
+        if entry.get("status") == "error" or entry.get("output") is None:
+            continue
+        done[str(entry.get("row"))] = entry
+    return done
+
+
+class _Checkpointer:
+    """Hand the rows finished so far to a checkpoint callback every few rows or seconds"""
+
+    def __init__(self, checkpoint, every_rows: int = CHUNK_CHECKPOINT_ROWS, every_seconds: float = CHUNK_CHECKPOINT_INTERVAL):
+        self.checkpoint = checkpoint
+        self.every_rows = max(1, every_rows)
+        self.every_seconds = every_seconds
+        self._rows = 0
+        self._last = time.monotonic()
+
+    def tick(self, output_data: List[Optional[Dict[str, Any]]], rows: int) -> None:
+        if self.checkpoint is None:
+            return
+        self._rows += rows
+        if self._rows < self.every_rows and time.monotonic() - self._last < self.every_seconds:
+            return
+        self._rows = 0
+        self._last = time.monotonic()
+        try:
+            self.checkpoint([entry for entry in output_data if entry is not None])
+        except Exception as e:
+            # A missed checkpoint only costs work on a restart; keep processing
+            print(f"WARNING: Could not save chunk progress: {str(e)}")
 
 
 def process_chunk(
         chunk_data: Dict[str, Any],
         prompt_text: str,
         api_key: str,
-        model_name: str = None,  # Will use fallback model list if None
+        model_name: str = None,  # Defaults to gemini-1.5-flash if None
         verbosity: float = 0.5,
-        maxOutputTokens: int = 60000
+        maxOutputTokens: int = 60000,
+        concurrency: int = LLM_CHUNK_CONCURRENCY,
+        rows_per_request: int = LLM_ROWS_PER_REQUEST,
+        max_input_tokens: Optional[int] = None,
+        response_cache=None,
+        rate_limits: Optional[List[RateLimit]] = None,
+        model_rate_limits: Optional[Dict[str, RateLimit]] = None,
+        key_pool: Optional[KeyPool] = None,
+        completed_rows: Optional[List[Dict[str, Any]]] = None,
+        checkpoint=None,
+        hedge: bool = LLM_HEDGE_ENABLED,
+        model_group: Optional[ModelGroup] = None,
+        deadline: Optional[float] = None,
+        spending_cap: Optional[SpendingCap] = None,
+        cancel_flag: Optional[CancelFlag] = None,
+        time_limit: Optional[float] = None
     ) -> Dict[str, Any]:
     """Process a data chunk and generate responses that can be mapped back to original dataframe
     
     This function takes a chunk of data, processes it through the LLM and ensures
     the output preserves the original row indices for proper mapping back to the dataframe.
     The results will be added to the dataframe as a new column 'Analysis_Result'.
+
+    Up to `concurrency` rows are sent at once (1 keeps the old serial behaviour), and
+    every call also takes a slot from the process-wide adaptive concurrency limit, which
+    grows while the provider answers quickly and shrinks on 429s, 503s and timeouts.
+
+    With rows_per_request > 1, rows are packed into requests that fit within
+    max_input_tokens and the model answers with a JSON array keyed by row; rows it
+    drops or mangles are retried one by one.
+
+    When a response_cache is given, rows whose prompt, model, generation config and
+    data were answered before are served from it and only the misses are sent. An
+    answer is cached under the member of model_group that gave it. With rows_per_request
+    > 1 the cache key includes it, so answers written for a batched prompt are only
+    served to batched runs and never mixed with single-row answers.
+
+    Every request waits for capacity in the shared rate_limits buckets, the bucket of
+    the member it goes to (model_rate_limits, by encoder) and its API key's bucket
+    (requests/tokens per minute) instead of being sent into a 429.
+
+    Requests are spread over the keys of key_pool; without one, api_key is used alone.
+
+    Transient provider errors are retried with backoff (see retry.py) and calls fail fast
+    while the model's circuit breaker is open. The retry counters and breaker state are
+    returned under 'diagnostics'.
+
+    Rows answered in completed_rows (the output_data saved by an interrupted run) are kept
+    as they are, and checkpoint(entries) is called with the rows finished so far every
+    CHUNK_CHECKPOINT_ROWS rows or CHUNK_CHECKPOINT_INTERVAL seconds, so a restarted chunk
+    only sends what it has not answered yet.
+
+    With hedge on, a request slower than the model's recent latency percentile is sent
+    again on another key of the pool and the first answer wins, within a per-chunk
+    budget of hedged requests (see hedge.py).
+
+    Each request is routed to the healthiest, fastest member of model_group (the model,
+    its equivalence group and its fallback encoders, see router.py).
+
+    Once the job is cancelled (cancel_flag), `deadline` (epoch seconds) has passed or
+    the job's spending_cap is used up, no new request is started and retries stop
+    waiting: the rows not reached are returned with status 'skipped' and no output,
+    'stopped' is set to 'cancelled', 'deadline' or 'budget', and a later run picks them
+    up like any other unanswered row. Requests already sent run to their timeout. The
+    same happens, with 'stopped' set to 'time_limit', once the task's own time_limit
+    (epoch seconds) has passed, so the chunk can be handed back before Celery kills it.
+
+    The tokens the provider reported are returned per row under each entry's 'usage'
+    and for the whole chunk under 'usage' (see Usage).
     
     Returns a dictionary with 'output_data' containing the processed results for each row.
     Each row result includes 'row' (original index), 'input' (original data), and 'output' (LLM response).
@@ -99,8 +897,10 @@ def process_chunk(
             return {"output_data": [], "error": "Invalid or empty chunk data"}
             
         # Use environment variable if API key not provided
-        api_key = api_key or os.environ.get("GEMINI_API_KEY", "")
-        if not api_key:
+        if key_pool is None:
+            api_key = api_key or os.environ.get("GEMINI_API_KEY", "")
+            key_pool = KeyPool([PooledKey("default", api_key)]) if api_key else None
+        if not key_pool:
             print("WARNING: No API key provided, using dummy results")
             # Return dummy result for testing if no API key
             return {
@@ -110,52 +910,90 @@ def process_chunk(
                     "output": "Test processed output (no API key provided)"
                 } for idx, item in enumerate(chunk_data["source_data"])]
             }
-        print(f"DEBUG: Using API key (length: {len(api_key)})")
-        
-        # Always process row by row for more reliable results
-        output_data = []
-        print(f"Processing {len(chunk_data['source_data'])} rows individually")
+        print(f"DEBUG: Using {len(key_pool)} API key(s)")
         
-        for idx, item in enumerate(chunk_data["source_data"]):
-            row_idx = item.get("row", idx)
-            
-            try:
-                # Process each row individually
-                row_data = json.dumps(item["data"])
-                print(f"DEBUG: Processing row {idx} (original index: {row_idx}) with model: {model_name}")
-                row_response = generate_response(
-                    prompt_text, row_data, model_name, api_key, 
-                    verbosity, min(maxOutputTokens, 10000)  # Smaller token limit for single rows
-                )
-                print(f"DEBUG: Successfully processed row {idx}")
-                
-                # Ensure response is well-formatted for Excel output
-                formatted_response = row_response.strip() if isinstance(row_response, str) else str(row_response)
-                # Remove any markdown formatting if present
-                if formatted_response.startswith("```") and "```" in formatted_response[3:]:
-                    # Extract content between markdown code blocks
-                    parts = formatted_response.split("```")
-                    if len(parts) >= 3:  # At least one code block
-                        formatted_response = parts[1].strip()
-                
-                output_data.append({
-                    "row": row_idx,
-                    "input": item["data"],
-                    "output": formatted_response
-                })
-            except Exception as e:
-                # If individual processing fails, add error message
-                error_msg = f"Error processing this row: {str(e)}"
-                print(f"ERROR processing row {idx}: {str(e)}")
-                output_data.append({
-                    "row": row_idx,
-                    "input": item["data"],
-                    "output": error_msg
-                })
+        rows = chunk_data["source_data"]
+        output_data = [None] * len(rows)
+        row_config = {"temperature": verbosity, "top_p": verbosity, "max_output_tokens": min(maxOutputTokens, 10000)}
+        rows_per_request = max(1, rows_per_request or 1)
+        # Batched answers come from a different prompt, so they are cached apart
+        cache_config = dict(row_config, rows_per_request=rows_per_request) if rows_per_request > 1 else row_config
+        cache_keys = {}
+        pending = []
+        resumed = _resumable_entries(completed_rows)
+        for idx, item in enumerate(rows):
+            if "duplicate_of" in item:
+                continue  # the job sends each distinct payload once; filled in below or when finalizing
+            previous = resumed.get(str(item.get("row", idx)))
+            if previous is not None:
+                output_data[idx] = previous
+                continue
+            if response_cache is not None:
+                cache_key = response_cache.make_key(prompt_text, model_name, cache_config, item["data"])
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    output_data[idx] = {"row": item.get("row", idx), "input": item["data"], "output": cached}
+                    continue
+                cache_keys[idx] = cache_key
+            pending.append((idx, item))
+
+        batches = _pack_batches(pending, prompt_text, rows_per_request, max_input_tokens)
+        max_workers = max(1, min(concurrency or 1, len(batches)))
+        print(f"Processing {len(pending)} of {len(rows)} rows in {len(batches)} requests ({max_workers} concurrent, {len(resumed)} resumed)")
+
+        ctx = ChunkContext(
+            prompt_text, model_name, key_pool, verbosity, maxOutputTokens, rate_limits,
+            model_rate_limits=model_rate_limits,
+            hedge=HedgeBudget(latency_tracker) if hedge else None,
+            model_group=model_group,
+            deadline=deadline,
+            spending_cap=spending_cap,
+            cancel_flag=cancel_flag,
+            time_limit=time_limit
+        )
+
+        def run_batch(batch):
+            reason = ctx.stop_reason()
+            if reason:
+                return [_skipped_entry(idx, item, ctx, reason) for idx, item in batch]
+            return _process_batch(batch, ctx)
+
+        checkpointer = _Checkpointer(checkpoint)
+
+        def record(batch, batch_output):
+            # Entries go to their row's slot, so rows keep their original order
+            for (idx, _), entry in zip(batch, batch_output):
+                output_data[idx] = entry
+                if idx in cache_keys and not entry.get("status"):
+                    # The key looked up was the primary's; an answer from another member is its own
+                    answered_by = entry.get("model", model_name)
+                    if answered_by != model_name:
+                        cache_keys[idx] = response_cache.make_key(prompt_text, answered_by, cache_config, rows[idx]["data"])
+                    response_cache.set(cache_keys[idx], entry["output"])
+            checkpointer.tick(output_data, len(batch))
+
+        if max_workers == 1:
+            for batch in batches:
+                record(batch, run_batch(batch))
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="row") as executor:
+                futures = {executor.submit(run_batch, batch): batch for batch in batches}
+                for future in as_completed(futures):
+                    record(futures[future], future.result())
+
+        # Broadcast answers to repeated payloads whose first occurrence is in this chunk
+        by_row = {str(entry["row"]): entry for entry in output_data if entry is not None}
+        for idx, item in enumerate(rows):
+            if "duplicate_of" in item:
+                output_data[idx] = _duplicate_entry(idx, item, by_row.get(str(item["duplicate_of"])))
         
         # Update the chunk with the results
         processed_chunk = chunk_data.copy()
         processed_chunk["output_data"] = output_data
+        processed_chunk["diagnostics"] = ctx.diagnostics()
+        processed_chunk["usage"] = ctx.usage.as_dict()
+        if any(entry.get("status") == "skipped" for entry in output_data):
+            processed_chunk["stopped"] = ctx.stopped
         
         # Print summary of processing
         success_count = sum(1 for item in output_data if not str(item.get('output', '')).startswith('Error'))
@@ -185,45 +1023,30 @@ def test_gemini_model(api_key: str, model_name: str = "gemini-1.5-flash") -> Dic
     }
     
     try:
-        # Import here to avoid circular imports
-        import datetime
-        
         print(f"Testing Gemini model: {model_name}")
         test_prompt = "Hello, my name is Claude. What's your name?"
         
-        client = genai.Client(api_key=api_key)
-        
-        # Try models in sequence if the requested one fails
-        fallback_models = ["gemini-1.5-flash", "gemini-1.0-pro", "gemini-pro"]
-        models_to_try = [model_name] + [m for m in fallback_models if m != model_name]
-        
-        for attempt_model in models_to_try:
-            try:
-                print(f"Attempting to use model: {attempt_model}")
-                response = client.models.generate_content(
-                    model=attempt_model,
-                    contents=[{"role": "user", "parts": [{"text": test_prompt}]}],
-                    config=types.GenerateContentConfig(
-                        temperature=0.2,
-                        top_p=0.8,
-                        maxOutputTokens=100,
-                    )
+        client = client_pool.get(api_key)
+        
+        # Only the model itself is tested; failing over to its group is up to model_router
+        try:
+            response = client.models.generate_content(
+                model=model_name,
+                contents=[{"role": "user", "parts": [{"text": test_prompt}]}],
+                config=types.GenerateContentConfig(
+                    temperature=0.2,
+                    top_p=0.8,
+                    maxOutputTokens=100,
                 )
-                result["success"] = True
-                result["model_tested"] = attempt_model
-                result["response"] = response.text
-                print(f"Test successful with model: {attempt_model}")
-                print(f"Response: {response.text}")
-                break
-            except Exception as model_error:
-                error_msg = f"Error with model {attempt_model}: {str(model_error)}"
-                print(error_msg)
-                if attempt_model == models_to_try[-1]:
-                    # This was our last attempt
-                    result["error"] = error_msg
-                    print("All model attempts failed")
-                else:
-                    print("Trying next model...")
+            )
+            result["success"] = True
+            result["response"] = response.text
+            print(f"Test successful with model: {model_name}")
+            print(f"Response: {response.text}")
+        except Exception as model_error:
+            error_msg = f"Error with model {model_name}: {str(model_error)}"
+            print(error_msg)
+            result["error"] = error_msg
         
         return result
     except Exception as e:
@@ -4,14 +4,29 @@ import os
 import uuid
 import asyncio
 import datetime
+import functools
+import time
+from typing import Any, Dict, List, Optional
 
-from sqlalchemy import select
+from celery import chord
+from celery.exceptions import Retry, SoftTimeLimitExceeded
+from celery.signals import worker_process_init
+from sqlalchemy import String, cast, select, update, or_, func
 
 from llm import process_chunk
+from registry import validation_registry
+from cache import response_cache
+from ratelimit import RateLimit
+from keys import KeyPool, PooledKey, get_key_pool
+from router import ModelGroup
+from budget import SpendingCap, token_cost
 from shared.models.job import Chunk_on_db, Job_on_db, JobStatus
 from shared.models.resources import Prompt_on_db, Model_on_db, APIKey_on_db
+from shared.models.user import User_on_db, UserTier_on_db
 from shared.utils.crypt import CryptoUtils
-from shared.db.db_engine import init_db, SessionLocal
+from shared.utils.cancel import CancelFlag, is_cancelled
+from shared.db.db_engine import engine, SessionLocal
+from shared.utils.clients import client_pool
 
 HOST_REDS = os.getenv("HOST_REDS", "redis")
 KEY_FERNET_ENCRYPTION = os.getenv("KEY_FERNET_ENCRYPTION", "A very safe key").encode()
@@ -19,6 +34,30 @@ KEY_FERNET_ENCRYPTION = os.getenv("KEY_FERNET_ENCRYPTION", "A very safe key").en
 REDIS_URL_BROKER = f"redis://{HOST_REDS}:6379/0"
 REDIS_URL_BACKEND = f"redis://{HOST_REDS}:6379/1"
 
+# Dispatch each chunk of a multi-chunk job as its own task instead of walking them in one task
+JOB_CHUNK_FANOUT = os.getenv("JOB_CHUNK_FANOUT", "true").lower() in ("1", "true", "yes")
+
+# Seconds between checks of a finalize that waits for running chunks to stop, and the
+# longest it waits (a chunk whose worker died stays RUNNING) before assembling anyway
+JOB_FINALIZE_RECHECK = int(os.getenv("JOB_FINALIZE_RECHECK", "5"))
+JOB_FINALIZE_MAX_WAIT = int(os.getenv("JOB_FINALIZE_MAX_WAIT", "900"))
+
+# Seconds a task may run: past the soft limit it is interrupted and retried, at the hard
+# limit it is killed. Chunks stop starting requests TASK_STOP_MARGIN seconds before the
+# soft limit, so the requests in flight can finish and the chunk is handed back cleanly
+TASK_TIME_LIMIT = int(os.getenv("TASK_TIME_LIMIT", "3600"))
+TASK_SOFT_TIME_LIMIT = int(os.getenv("TASK_SOFT_TIME_LIMIT", str(TASK_TIME_LIMIT - 300)))
+TASK_STOP_MARGIN = int(os.getenv("TASK_STOP_MARGIN", "300"))
+# Seconds before Redis hands an unacknowledged task to another worker; with acks_late it
+# must be longer than any task runs, or long chunks are redelivered while still running
+TASK_VISIBILITY_TIMEOUT = int(os.getenv("TASK_VISIBILITY_TIMEOUT", str(2 * TASK_TIME_LIMIT)))
+
+# Seconds task results are kept in the result backend (Redis DB 1)
+TASK_RESULT_EXPIRES = int(os.getenv("TASK_RESULT_EXPIRES", "21600"))
+# Error messages kept in a task result, and how much of each
+TASK_RESULT_ERROR_SAMPLES = int(os.getenv("TASK_RESULT_ERROR_SAMPLES", "5"))
+TASK_RESULT_ERROR_LENGTH = int(os.getenv("TASK_RESULT_ERROR_LENGTH", "500"))
+
 logger = get_task_logger(__name__)
 workers = Celery(
     "worker",
@@ -34,8 +73,16 @@ workers.conf.update(
     timezone="UTC",
     enable_utc=True,
     task_track_started=True,
-    task_time_limit=3600,  # 1 hour time limit
+    task_time_limit=TASK_TIME_LIMIT,
+    task_soft_time_limit=TASK_SOFT_TIME_LIMIT,
+    # Chunks checkpoint their rows, so a task lost with its worker is redelivered and resumes
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    broker_transport_options={"visibility_timeout": TASK_VISIBILITY_TIMEOUT},
+    # A long task reserves only itself, so queued chunks are not held (and timed out) behind it
+    worker_prefetch_multiplier=1,
     worker_concurrency=2,  # Adjust based on your resources
+    result_expires=TASK_RESULT_EXPIRES,
 )
 
 # Initialize DB at startup
@@ -61,59 +108,183 @@ def setup_periodic_tasks(sender, **kwargs):
 
 
 
-@workers.task(name="workers.process_job")
-def process_job(job_id: str):
+@workers.task(name="workers.process_job", bind=True)
+def process_job(self, job_id: str):
     """Process a job by handling all its chunks and mapping results back to dataframe
     
     This function coordinates the processing of all chunks in a job and ensures
     the results are properly mapped back to the original dataframe structure.
     Results are added as a new column 'Analysis_Result' in the final output.
+
+    When JOB_CHUNK_FANOUT is enabled and the job has more than one chunk, the chunks
+    are dispatched as a chord of `workers.process_chunk` tasks and `workers.finalize_job`
+    assembles the results once all of them are done. A redelivered task (acks_late)
+    does not dispatch the chunks that are already running again.
+
+    The task result is only a summary (see task_summary); the rows are read from Postgres.
+
+    A task that runs out of time (TASK_SOFT_TIME_LIMIT) hands its chunk back and is
+    retried, resuming from the rows checkpointed so far.
     """
     logger.info(f"Processing job {job_id}")
+    started = time.monotonic()
     results = {
         "job_id": job_id,
         "status": "processing",
         "chunks_processed": 0,
         "chunks_total": 0,
         "errors": [],
-        "combined_results": [],  # Will contain all processed results mapped back to original df
-        "debug_info": {"model_info": None, "start_time": datetime.datetime.now().isoformat()}
     }
     
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(init_db())
-        final_results = loop.run_until_complete(process_job_async(job_id))
-        loop.close()
-        if isinstance(final_results, dict):
-            final_results['completed_at'] = datetime.datetime.now().isoformat()
-            # Ensure we have combined_results even if it's empty
-            if 'combined_results' not in final_results:
-                final_results['combined_results'] = []
-            
-            # Add model information for debugging
-            final_results['model_info'] = {
-                'timestamp': datetime.datetime.now().isoformat(),
-                'note': 'If you see errors about missing model parameter, check that your model name is valid'
-            }
-        
+        final_results = run_async(process_job_async(job_id))
+        if final_results.get("status") == "requeued":
+            raise self.retry(countdown=0, max_retries=None)
         logger.info(f"Completed job {job_id} with status: {final_results.get('status', 'unknown')}")
-        return final_results
+        logger.info(f"Provider client pool: {client_pool.stats()}")
+        if response_cache is not None:
+            logger.info(f"Response cache: {response_cache.stats()}")
+        return task_summary(final_results, started)
+    except SoftTimeLimitExceeded:
+        logger.warning(f"Job {job_id} hit the soft time limit, retrying it")
+        raise self.retry(countdown=0, max_retries=None)
+    except Retry:
+        raise
     except Exception as e:
         logger.error(f"Error processing job {job_id}: {str(e)}")
         results["status"] = "failed"
         results["errors"].append(str(e))
         # Try to update job status in DB to failed
         try:
-            failure_loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(failure_loop)
-            failure_loop.run_until_complete(init_db())
-            failure_loop.run_until_complete(mark_job_failed(job_id, str(e)))
-            failure_loop.close()
+            run_async(mark_job_failed(job_id, str(e)))
+        except Exception as db_error:
+            logger.error(f"Failed to mark job as failed in DB: {str(db_error)}")
+        return task_summary(results, started)
+
+
+
+@workers.task(name="workers.process_chunk", bind=True)
+def process_job_chunk(self, job_id: str, chunk_id: str):
+    """Process a single chunk of a fanned-out job
+
+    Never fails: a failing chunk is recorded as FAILED so the chord callback still runs. A
+    chunk that runs out of task time is retried (same task id) and resumes where it stopped.
+    """
+    logger.info(f"Processing chunk {chunk_id} of job {job_id}")
+    try:
+        summary = run_async(process_chunk_async(job_id, chunk_id, self.request.id))
+    except SoftTimeLimitExceeded:
+        summary = {"status": "requeued"}
+    except Exception as e:
+        logger.error(f"Error processing chunk {chunk_id} of job {job_id}: {str(e)}")
+        return {"chunk_id": chunk_id, "status": "failed", "rows": 0, "error": str(e)}
+    if summary.get("status") == "requeued":
+        # Same task id, so the chord still waits for it and the chunk claim still holds
+        logger.info(f"Chunk {chunk_id} of job {job_id} ran out of task time, retrying it")
+        raise self.retry(countdown=0, max_retries=None)
+    return summary
+
+
+
+@workers.task(name="workers.finalize_job")
+def finalize_job(chunk_results: List[dict], job_id: str, waited: int = 0):
+    """Chord callback: set the job status and assemble combined_results from its chunks
+
+    Also sent by /job/cancel, while chunks may still be running. Until no chunk is
+    queued or running (or JOB_FINALIZE_MAX_WAIT has passed) the task sends itself again
+    instead of assembling, so the rows of a chunk that stops late are not left out.
+    """
+    logger.info(f"Finalizing job {job_id} after {len(chunk_results or [])} chunk tasks")
+    started = time.monotonic()
+    try:
+        summary = run_async(finalize_job_async(job_id, chunk_results or [], waited))
+        if summary["status"] == "waiting":
+            logger.info(f"Job {job_id}: {summary['chunks_running']} chunks still running, finalizing in {JOB_FINALIZE_RECHECK}s")
+            finalize_job.apply_async(
+                args=[chunk_results, job_id, waited + JOB_FINALIZE_RECHECK],
+                countdown=JOB_FINALIZE_RECHECK
+            )
+        return task_summary(summary, started)
+    except Exception as e:
+        logger.error(f"Error finalizing job {job_id}: {str(e)}")
+        try:
+            run_async(mark_job_failed(job_id, str(e)))
         except Exception as db_error:
             logger.error(f"Failed to mark job as failed in DB: {str(db_error)}")
-        return results
+        return task_summary({"job_id": job_id, "status": "failed", "errors": [str(e)]}, started)
+
+
+
+@workers.task(name="workers.finalize_failed_chord")
+def finalize_failed_chord(request, exc, traceback, job_id: str):
+    """Chord errback: finalize the job even though a chunk task failed
+
+    Chunk tasks do not fail on their own, but one killed by the hard time limit (or
+    retried past the broker's patience) would otherwise keep finalize_job from ever
+    running. Called inline by Celery, so it only sends finalize_job, which waits for
+    the chunks that are still running.
+    """
+    logger.error(f"Chunk task of job {job_id} failed, finalizing without it: {exc}")
+    finalize_job.apply_async(args=[[{"error": str(exc)}], job_id])
+
+
+
+def task_summary(results: Dict[str, Any], started: float) -> Dict[str, Any]:
+    """Compact task result: counts, timings and a few error samples
+
+    The rows themselves are already in Postgres (chunks and job.combined_results), so they
+    are never serialized into the result backend.
+    """
+    errors = results.get("errors") or []
+    summary = {
+        key: results[key]
+        for key in ("job_id", "status", "chunks_processed", "chunks_total", "rows_total",
+                    "rows_sent", "rows_broadcast", "rows_with_output", "rows_failed", "stop_reason", "chunks_running",
+                    "input_tokens_used", "output_tokens_used", "cost_actual_usd", "rows_truncated")
+        if key in results
+    }
+    summary["errors_total"] = len(errors)
+    summary["errors"] = [str(error)[:TASK_RESULT_ERROR_LENGTH] for error in errors[:TASK_RESULT_ERROR_SAMPLES]]
+    summary["duration_seconds"] = round(time.monotonic() - started, 3)
+    summary["completed_at"] = datetime.datetime.now().isoformat()
+    return summary
+
+
+
+# One event loop per worker process, so the asyncpg connections pooled by the engine
+# (which are bound to the loop that opened them) are reused by every task
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Give each forked worker process its own loop and connection pool
+
+    Connections inherited from the parent are dropped without closing them, as they
+    belong to the parent. The schema is created by the backend at startup, never here.
+    """
+    engine.sync_engine.dispose(close=False)
+    get_loop()
+    logger.info(f"Worker process {os.getpid()} ready with a persistent event loop")
+
+
+def run_async(coro):
+    """Run a coroutine to completion on this process's long-lived event loop"""
+    return get_loop().run_until_complete(coro)
+
+
+
+class JobSetupError(Exception):
+    """Raised when a job cannot be processed because its prompt, model or keys are missing."""
+    pass
 
 
 
@@ -132,6 +303,485 @@ async def mark_job_failed(job_id: str, error_message: str):
             logger.error(f"Error marking job {job_id} as failed: {str(e)}")
             await session.rollback()
 
+
+
+async def load_job_context(session, job: Job_on_db) -> Dict[str, Any]:
+    """Load the prompt, model and pool of decrypted API keys needed to process the chunks of a job"""
+    prompt_result = await session.execute(select(Prompt_on_db).where(Prompt_on_db.id == job.prompt_id))
+    prompt = prompt_result.scalar_one_or_none()
+    if not prompt:
+        raise JobSetupError("Prompt not found")
+
+    model_result = await session.execute(select(Model_on_db).where(Model_on_db.id == job.model_id))
+    model = model_result.scalar_one_or_none()
+    if not model:
+        raise JobSetupError("Model not found")
+
+    # Verify model fields are properly set
+    if not hasattr(model, 'encoder') or not model.encoder:
+        logger.error(f"Model {model.id} has no encoder defined")
+        raise JobSetupError(f"Model error: encoder not defined for model {model.name if hasattr(model, 'name') else 'unknown'}")
+
+    logger.info(f"Using model: {model.name}, encoder: {model.encoder}")
+
+    api_key_result = await session.execute(
+        select(APIKey_on_db)
+        .where(APIKey_on_db.model_id == model.id)
+        .where(APIKey_on_db.is_active.is_(True))
+        .where(or_(APIKey_on_db.expires_at.is_(None), APIKey_on_db.expires_at > datetime.datetime.now(datetime.timezone.utc)))
+    )
+    api_key_objs = api_key_result.scalars().all()
+    if not api_key_objs:
+        logger.error(f"No active API keys found for model {model.name}")
+        raise JobSetupError("No API keys found")
+
+    crypto = CryptoUtils(key=KEY_FERNET_ENCRYPTION)
+    key_pool = get_key_pool(str(model.id), [
+        PooledKey(
+            str(key.id),
+            crypto.decrypt(key.api_key),
+            RateLimit(f"key:{key.id}", key.requests_per_minute, key.tokens_per_minute),
+        )
+        for key in api_key_objs
+    ])
+    logger.info(f"Using {len(key_pool)} API key(s) for model {model.name}")
+
+    # Active models of the same provider declared equivalent in the catalog share the keys
+    equivalents = []
+    if model.equivalence_group:
+        equivalent_result = await session.execute(
+            select(Model_on_db.encoder)
+            .where(Model_on_db.equivalence_group == model.equivalence_group)
+            .where(Model_on_db.provider == model.provider)
+            .where(Model_on_db.is_active.is_(True))
+            .where(Model_on_db.id != model.id)
+        )
+        equivalents = list(equivalent_result.scalars().all())
+    model_group = ModelGroup(model.encoder, equivalents, model.fallback_encoders or [])
+
+    # Each member is charged to the bucket of its own catalog model, so failing over does
+    # not use up the primary's requests per minute; members not in the catalog have none
+    member_models = {model.encoder: model}
+    others = [name for name in model_group.members if name != model.encoder]
+    if others:
+        member_result = await session.execute(
+            select(Model_on_db)
+            .where(Model_on_db.encoder.in_(others))
+            .where(Model_on_db.is_active.is_(True))
+        )
+        for member in sorted(member_result.scalars().all(), key=lambda m: m.provider != model.provider):
+            member_models.setdefault(member.encoder, member)
+
+    return {
+        "prompt": prompt,
+        "model": model,
+        "cache_responses": job.cache_responses is not False,
+        "model_rate_limits": {
+            encoder: RateLimit(f"model:{member.id}", member.requests_per_minute, member.tokens_per_minute)
+            for encoder, member in member_models.items()
+        },
+        "key_pool": key_pool,
+        "model_group": model_group,
+        "deadline": job.deadline_at.timestamp() if job.deadline_at else None,
+        "spending_cap": await load_spending_cap(session, job, model),
+        "cancel_flag": CancelFlag(str(job.id)),
+        "time_limit": time.time() + TASK_SOFT_TIME_LIMIT - TASK_STOP_MARGIN,
+    }
+
+
+async def load_spending_cap(session, job: Job_on_db, model: Model_on_db) -> SpendingCap:
+    """The job's cap and its user's monthly spend limit, both charged as tokens are used
+
+    The user's spend of the month is a Redis counter every job of the user adds to. It
+    is seeded from the database the first time it is needed in a month: the finalized
+    cost of the user's other jobs plus what this job used in earlier runs.
+    """
+    used_result = await session.execute(
+        select(
+            func.coalesce(func.sum(Chunk_on_db.input_tokens_used), 0),
+            func.coalesce(func.sum(Chunk_on_db.output_tokens_used), 0),
+        ).where(Chunk_on_db.job_id == job.id)
+    )
+    input_used, output_used = used_result.one()
+    already_spent = token_cost(input_used, output_used, model.cost_per_1m_input, model.cost_per_1m_output)
+
+    tier_result = await session.execute(
+        select(UserTier_on_db)
+        .join(User_on_db, User_on_db.usertier == UserTier_on_db.id)
+        .where(User_on_db.id == job.user_id)
+    )
+    tier = tier_result.scalar_one_or_none()
+    monthly_limit = tier.monthly_spend_limit if tier is not None else None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    month_spent = already_spent
+    if monthly_limit is not None:
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        spent_result = await session.execute(
+            select(func.coalesce(func.sum(Job_on_db.cost_actual_usd), 0))
+            .where(Job_on_db.user_id == job.user_id)
+            .where(Job_on_db.id != job.id)
+            .where(Job_on_db.created_at >= month_start)
+        )
+        month_spent += spent_result.scalar_one() * 1_000_000
+
+    return SpendingCap(
+        str(job.id),
+        job.cost_cap_usd,
+        model.cost_per_1m_input,
+        model.cost_per_1m_output,
+        already_spent=already_spent,
+        user_id=str(job.user_id),
+        month=now.strftime("%Y-%m"),
+        monthly_limit=monthly_limit,
+        month_spent=month_spent,
+    )
+
+
+def job_stop_reason(context: Dict[str, Any]) -> Optional[str]:
+    """Why no more chunks of the job may start: 'cancelled', 'deadline', 'budget' or None"""
+    if context["cancel_flag"].is_set():
+        return "cancelled"
+    if context["deadline"] is not None and time.time() >= context["deadline"]:
+        return "deadline"
+    if context["spending_cap"].exceeded():
+        return "budget"
+    return None
+
+
+
+async def flush_key_usage(session, key_pool: KeyPool) -> None:
+    """Write the calls counted by the key pool to usage_count/last_used in one batch"""
+    usage = key_pool.drain_usage()
+    if not usage:
+        return
+    try:
+        for key_id, (count, last_used) in usage.items():
+            await session.execute(
+                update(APIKey_on_db)
+                .where(APIKey_on_db.id == uuid.UUID(key_id))
+                .values(
+                    usage_count=APIKey_on_db.usage_count + count,
+                    # The column is a naive timestamp holding UTC
+                    last_used=datetime.datetime.fromtimestamp(last_used, datetime.timezone.utc).replace(tzinfo=None),
+                )
+            )
+        await session.commit()
+    except Exception as e:
+        # Usage accounting must never fail a chunk
+        logger.warning(f"Could not record API key usage: {e}")
+        await session.rollback()
+
+
+
+async def save_chunk_progress(chunk_id: uuid.UUID, entries: List[dict]) -> None:
+    """Checkpoint the rows a running chunk has finished, in a session of its own"""
+    async with SessionLocal() as session:
+        await session.execute(update(Chunk_on_db).where(Chunk_on_db.id == chunk_id).values(output_data=entries))
+        await session.commit()
+
+
+
+async def run_chunk(session, chunk: Chunk_on_db, context: Dict[str, Any]) -> Dict[str, Any]:
+    """Send one chunk through the model and store its output_data and status
+
+    Rows already answered in the chunk's output_data (checkpointed by an interrupted run)
+    are not sent again. The model calls run in a thread so the event loop stays free to
+    save checkpoints while they are in flight.
+
+    Once the job is cancelled, its deadline has passed or its spending cap is used up
+    the chunk is CANCELLED, keeping the rows it answered so far, and its remaining rows
+    are left out of the results. When instead the task runs out of time (context
+    "time_limit") the chunk goes back to QUEUED with its rows so far and the summary
+    status is "requeued", for the task to be retried.
+
+    Returns a small summary of the chunk; errors are recorded on the chunk instead of raised.
+    """
+    model = context["model"]
+    summary = {"chunk_id": str(chunk.id), "chunk_index": chunk.chunk_index, "status": "completed", "rows": 0, "error": None}
+    stop_reason = job_stop_reason(context)
+    if stop_reason:
+        logger.info(f"Job stopped ({stop_reason}), not starting chunk {chunk.chunk_index}")
+        chunk.status = JobStatus.CANCELLED
+        chunk.diagnostics = dict(chunk.diagnostics or {}, stopped=stop_reason)
+        await session.commit()
+        summary["status"] = "stopped"
+        return summary
+    if time.time() >= context["time_limit"]:
+        summary["status"] = "requeued"
+        return summary
+    try:
+        chunk.status = JobStatus.RUNNING
+        await session.commit()
+        chunk_data = {
+            "source_data": chunk.source_data if hasattr(chunk, "source_data") and chunk.source_data else []
+        }
+        logger.info(f"Chunk {chunk.chunk_index} data has {len(chunk_data['source_data'])} rows")
+        verbosity = 0.7  # Default value if not stored
+        maxOutputTokens = 60000  # Default value if not stored
+
+        # Add fallback data if source_data is empty
+        if not chunk_data["source_data"]:
+            chunk_data["source_data"] = [{
+                "row": chunk.chunk_index,
+                "data": {"info": "Empty chunk data"}
+            }]
+
+        # load_job_context already rejected models without an encoder
+        model_name = model.encoder
+        model_group = context["model_group"]
+
+        logger.info(f"Processing chunk {chunk.chunk_index} with model: {model_name} (group: {', '.join(model_group.members)})")
+
+        loop = asyncio.get_running_loop()
+
+        # Consult the shared validation cache instead of probing the model for every chunk;
+        # a cold cache probes over the network, so keep it off the event loop
+        probe_key = context["key_pool"].keys()[0]
+        test_result = await loop.run_in_executor(
+            None, validation_registry.get, probe_key.key_id, probe_key.api_key, model_name
+        )
+        if test_result["success"]:
+            logger.info(f"✅ Model test successful with: {test_result['model_tested']}")
+        else:
+            logger.warning(f"⚠️ Model test failed, requests will be routed within: {', '.join(model_group.members)}")
+
+        # Add debug info to track processing
+        chunk_data["debug_info"] = {
+            "chunk_index": chunk.chunk_index,
+            "timestamp": datetime.datetime.now().isoformat()
+        }
+        completed_rows = chunk.output_data or []
+        if completed_rows:
+            logger.info(f"Resuming chunk {chunk.chunk_index} with {len(completed_rows)} rows already saved")
+
+        chunk_id = chunk.id
+
+        def checkpoint(entries):
+            asyncio.run_coroutine_threadsafe(save_chunk_progress(chunk_id, entries), loop).result(timeout=60)
+
+        try:
+            processed_chunk = await loop.run_in_executor(None, functools.partial(
+                process_chunk,
+                chunk_data=chunk_data,
+                prompt_text=context["prompt"].prompt_text,
+                model_name=model_name,
+                api_key=None,
+                key_pool=context["key_pool"],
+                verbosity=verbosity,
+                maxOutputTokens=maxOutputTokens,
+                max_input_tokens=model.max_input_tokens,
+                response_cache=response_cache if context["cache_responses"] else None,
+                model_rate_limits=context["model_rate_limits"],
+                completed_rows=completed_rows,
+                checkpoint=checkpoint,
+                model_group=model_group,
+                deadline=context["deadline"],
+                spending_cap=context["spending_cap"],
+                cancel_flag=context["cancel_flag"],
+                time_limit=context["time_limit"],
+            ))
+            # Validate the processed chunk has expected structure
+            if not processed_chunk or not isinstance(processed_chunk, dict):
+                raise Exception("Invalid processed chunk response format")
+            logger.info(f"Finished processing chunk {chunk.chunk_index} - received valid response")
+        except Exception as model_error:
+            logger.error(f"Error with model processing: {str(model_error)}")
+            raise Exception(f"Model processing error: {str(model_error)}")
+
+        chunk.diagnostics = processed_chunk.get("diagnostics")
+        record_chunk_usage(chunk, processed_chunk.get("usage"))
+
+        # Check for errors in the processed chunk
+        if "error" in processed_chunk:
+            raise Exception(processed_chunk["error"])
+
+        chunk.output_data = processed_chunk.get("output_data", [])
+        if processed_chunk.get("stopped") == "time_limit":
+            # The task ran out of time, not the job: the chunk is resumed by the retried task
+            logger.info(f"Chunk {chunk.chunk_index} handed back before the task time limit")
+            chunk.status = JobStatus.QUEUED
+            summary["status"] = "requeued"
+        elif processed_chunk.get("stopped"):
+            logger.info(f"Chunk {chunk.chunk_index} stopped early ({processed_chunk['stopped']})")
+            chunk.status = JobStatus.CANCELLED
+            chunk.diagnostics = dict(chunk.diagnostics or {}, stopped=processed_chunk["stopped"])
+            summary["status"] = "stopped"
+        else:
+            chunk.status = JobStatus.FINISHED
+        summary["rows"] = len(chunk.output_data)
+        logger.info(f"Stored {len(chunk.output_data)} results for chunk {chunk.chunk_index}")
+    except Exception as chunk_error:
+        # Handle chunk processing errors
+        error_msg = f"Error processing chunk {chunk.chunk_index}: {str(chunk_error)}"
+        logger.error(error_msg)
+        chunk.status = JobStatus.FAILED
+        summary["status"] = "failed"
+        summary["error"] = error_msg
+
+    await session.commit()
+    await flush_key_usage(session, context["key_pool"])
+    return summary
+
+
+
+def record_chunk_usage(chunk: Chunk_on_db, usage: Optional[Dict[str, Any]]) -> None:
+    """Add the tokens a run of the chunk used to its totals; earlier runs were billed too"""
+    if not usage:
+        return
+    chunk.input_tokens_used = (chunk.input_tokens_used or 0) + usage["input_tokens"]
+    chunk.output_tokens_used = (chunk.output_tokens_used or 0) + usage["output_tokens"]
+    chunk.diagnostics = dict(chunk.diagnostics or {}, usage=usage)
+
+
+def record_job_usage(job: Job_on_db, model: Optional[Model_on_db], chunks: List[Chunk_on_db], results: Dict[str, Any]) -> None:
+    """Sum the tokens used by the job's chunks and price them like the estimate, in cents"""
+    job.input_tokens_used = sum(chunk.input_tokens_used or 0 for chunk in chunks)
+    job.output_tokens_used = sum(chunk.output_tokens_used or 0 for chunk in chunks)
+    if model is not None:
+        job.cost_actual_usd = round(
+            (job.input_tokens_used / 1_000_000) * model.cost_per_1m_input
+            + (job.output_tokens_used / 1_000_000) * model.cost_per_1m_output
+        )
+    results["input_tokens_used"] = job.input_tokens_used
+    results["output_tokens_used"] = job.output_tokens_used
+    results["cost_actual_usd"] = job.cost_actual_usd
+    results["rows_truncated"] = sum(
+        ((chunk.diagnostics or {}).get("usage") or {}).get("truncated", 0) for chunk in chunks
+    )
+    # Outputs far above the estimate usually mean the prompt makes the model ramble
+    if job.output_token_count and job.output_tokens_used > 2 * job.output_token_count:
+        logger.warning(
+            f"Job {job.id} used {job.output_tokens_used} output tokens, "
+            f"{job.output_tokens_used / job.output_token_count:.1f}x the estimate of {job.output_token_count}"
+        )
+
+
+def broadcast_duplicates(chunks: List[Chunk_on_db]) -> int:
+    """Copy each distinct payload's output to the rows of other chunks that repeated it
+
+    Returns how many rows were filled in.
+    """
+    outputs = {}
+    for chunk in chunks:
+        for entry in chunk.output_data or []:
+            if isinstance(entry, dict) and "duplicate_of" not in entry:
+                outputs[str(entry.get("row"))] = entry
+
+    filled = 0
+    for chunk in chunks:
+        if not chunk.output_data:
+            continue
+        updated = []
+        changed = False
+        for entry in chunk.output_data:
+            if isinstance(entry, dict) and entry.get("duplicate_of") is not None and entry.get("output") is None:
+                original = outputs.get(str(entry["duplicate_of"]))
+                if original is not None:
+                    entry = {**entry, "output": original.get("output", "")}
+                    if original.get("status"):
+                        entry["status"] = original["status"]
+                    filled += 1
+                    changed = True
+            updated.append(entry)
+        if changed:
+            # Assign a new list so the JSONB column is flagged as modified
+            chunk.output_data = updated
+    return filled
+
+
+
+def collect_combined_results(chunks: List[Chunk_on_db]) -> List[dict]:
+    """Flatten the output_data of finished chunks into row-ordered results for the Excel output
+
+    Chunks stopped early (CANCELLED at the deadline or spending cap) contribute the rows they answered.
+    """
+    combined_results = []
+    for chunk in chunks:
+        if chunk.status not in (JobStatus.FINISHED, JobStatus.CANCELLED) or not chunk.output_data:
+            continue
+        # Make sure each result has proper row mapping
+        for output_item in chunk.output_data:
+            if isinstance(output_item, dict) and 'row' in output_item:
+                # Ensure clean output format for Excel
+                combined_results.append({
+                    "row": output_item.get("row", 0),
+                    "input": output_item.get("input", {}),
+                    "output": output_item.get("output") or ""
+                })
+    # Sort by row number for proper order
+    combined_results.sort(key=lambda x: x.get("row", 0))
+    return combined_results
+
+
+
+async def store_job_results(session, job: Job_on_db, chunks: List[Chunk_on_db], results: Dict[str, Any]) -> Dict[str, Any]:
+    """Set the final job status and save combined_results from the job's chunks"""
+    if not results["errors"]:
+        for chunk in chunks:
+            if chunk.status == JobStatus.FAILED:
+                results["errors"].append(f"Chunk {chunk.chunk_index} failed")
+
+    results["chunks_total"] = len(chunks)
+    results["chunks_processed"] = sum(1 for chunk in chunks if chunk.status == JobStatus.FINISHED)
+    results["rows_total"] = sum(chunk.total_rows or 0 for chunk in chunks)
+    results["rows_sent"] = sum(chunk.unique_rows if chunk.unique_rows is not None else chunk.total_rows or 0 for chunk in chunks)
+    results["rows_broadcast"] = broadcast_duplicates(chunks)
+    combined_results = collect_combined_results(chunks)
+    results["rows_with_output"] = len(combined_results)
+    results["rows_failed"] = sum(
+        1 for chunk in chunks for entry in chunk.output_data or []
+        if isinstance(entry, dict) and entry.get("status") == "error"
+    )
+
+    record_job_usage(job, await session.get(Model_on_db, job.model_id), chunks, results)
+
+    stopped = [chunk for chunk in chunks if chunk.status == JobStatus.CANCELLED]
+    if is_cancelled(str(job.id)):
+        job.stop_reason = "cancelled"
+    elif stopped:
+        # Chunks cancelled by the API before they ran carry no reason of their own
+        job.stop_reason = job.stop_reason or (stopped[0].diagnostics or {}).get("stopped", "cancelled")
+    results["stop_reason"] = job.stop_reason
+
+    if job.stop_reason == "cancelled":
+        job.job_status = JobStatus.CANCELLED
+        results["status"] = "cancelled"
+    elif results["errors"]:
+        job.job_status = JobStatus.FAILED
+        results["status"] = "failed"
+    else:
+        # A job stopped early still finishes, with the rows it got to
+        job.job_status = JobStatus.FINISHED
+        results["status"] = "partial" if job.stop_reason else "completed"
+
+    if not combined_results:
+        logger.warning(f"No results were collected for job {job.id}")
+    # Store the combined dataframe result with the job
+    job.combined_results = combined_results
+
+    # Make sure to commit changes
+    try:
+        await session.commit()
+        logger.info(f"Job {job.id} processed: {results['chunks_processed']}/{results['chunks_total']} chunks with {len(combined_results)} total rows for Excel output")
+    except Exception as commit_error:
+        logger.error(f"Error committing results: {str(commit_error)}")
+        await session.rollback()
+        results["errors"].append(f"Database error: {str(commit_error)}")
+        results["status"] = "failed"
+    return results
+
+
+
+async def load_job_chunks(session, job_uuid: uuid.UUID) -> List[Chunk_on_db]:
+    chunks_result = await session.execute(
+        select(Chunk_on_db)
+        .where(Chunk_on_db.job_id == job_uuid)
+        .order_by(Chunk_on_db.chunk_index)
+    )
+    return list(chunks_result.scalars().all())
+
+
+
 async def process_job_async(job_id: str):
     """Asynchronous implementation of job processing
     
@@ -145,7 +795,6 @@ async def process_job_async(job_id: str):
         "chunks_processed": 0,
         "chunks_total": 0,
         "errors": [],
-        "combined_results": []  # Store all processed results here for final dataframe
     }
     async with SessionLocal() as session:
         try:
@@ -167,230 +816,71 @@ async def process_job_async(job_id: str):
                 results["errors"].append("Job not found")
                 return results
 
+            if job.job_status == JobStatus.CANCELLED:
+                # Cancelled before this task started; revoking it may have come too late
+                logger.info(f"Job {job_id} was cancelled, not processing it")
+                results["status"] = "cancelled"
+                return results
+
             job.job_status = JobStatus.RUNNING
             await session.commit()
 
-            prompt_result = await session.execute(select(Prompt_on_db).where(Prompt_on_db.id == job.prompt_id))
-            prompt = prompt_result.scalar_one_or_none()
-    
-            if not prompt:
-                logger.error(f"Prompt for job {job_id} not found")
+            try:
+                context = await load_job_context(session, job)
+            except JobSetupError as setup_error:
+                logger.error(f"Job {job_id} cannot be processed: {str(setup_error)}")
                 job.job_status = JobStatus.FAILED
                 await session.commit()
                 results["status"] = "failed"
-                results["errors"].append("Prompt not found")
+                results["errors"].append(str(setup_error))
                 return results
 
-            model_result = await session.execute(select(Model_on_db).where(Model_on_db.id == job.model_id))
-            model = model_result.scalar_one_or_none()
-    
-            if not model:
-                logger.error(f"Model for job {job_id} not found")
-                job.job_status = JobStatus.FAILED
-                await session.commit()
-                results["status"] = "failed"
-                results["errors"].append("Model not found")
-                return results
-                
-            # Verify model fields are properly set
-            if not hasattr(model, 'encoder') or not model.encoder:
-                logger.error(f"Model {model.id} has no encoder defined")
-                job.job_status = JobStatus.FAILED
-                await session.commit()
-                results["status"] = "failed"
-                results["errors"].append(f"Model error: encoder not defined for model {model.name if hasattr(model, 'name') else 'unknown'}")
-                return results
-                
-            logger.info(f"Using model: {model.name}, encoder: {model.encoder}")
+            chunks = await load_job_chunks(session, job_uuid)
+            results["chunks_total"] = len(chunks)
+            # A rerun (or a redelivered task) only picks up the chunks that have not finished
+            pending = [chunk for chunk in chunks if chunk.status != JobStatus.FINISHED]
+            if len(pending) < len(chunks):
+                logger.info(f"Job {job_id}: skipping {len(chunks) - len(pending)} finished chunks")
 
-            api_key_result = await session.execute(select(APIKey_on_db).where(APIKey_on_db.model_id == model.id))
-            api_key_obj = api_key_result.scalar_one_or_none()
-    
-            if not api_key_obj:
-                logger.error(f"No API keys found for model {model.name}")
-                job.job_status = JobStatus.FAILED
+            if JOB_CHUNK_FANOUT and len(pending) > 1 and not context["cancel_flag"].is_set():
+                # One task per chunk so the job spreads across every worker process and node.
+                # Chunks are claimed in one statement with a new task id, stored first so
+                # /job/cancel can revoke the chunks still queued. A RUNNING chunk belongs to
+                # a live task (redelivered if its worker dies), so a redelivered process_job
+                # leaves it alone; queued tasks of an earlier dispatch see their id replaced
+                # and skip the chunk (see process_chunk_async)
+                claimed = (await session.execute(
+                    update(Chunk_on_db)
+                    .where(
+                        Chunk_on_db.job_id == job_uuid,
+                        Chunk_on_db.status.notin_([JobStatus.FINISHED, JobStatus.RUNNING])
+                    )
+                    .values(task_id=cast(func.gen_random_uuid(), String))
+                    .returning(Chunk_on_db.id, Chunk_on_db.task_id)
+                    .execution_options(synchronize_session=False)
+                )).all()
                 await session.commit()
-                results["status"] = "failed"
-                results["errors"].append("No API keys found")
+                if len(claimed) < len(pending):
+                    logger.info(f"Job {job_id}: {len(pending) - len(claimed)} chunks already running, not dispatched again")
+                if not claimed:
+                    results["status"] = "dispatched"
+                    return results
+                chord(
+                    process_job_chunk.s(job_id, str(chunk_id)).set(task_id=task_id) for chunk_id, task_id in claimed
+                )(finalize_job.s(job_id).on_error(finalize_failed_chord.s(job_id)))
+                logger.info(f"Dispatched {len(claimed)} chunk tasks for job {job_id}")
+                results["status"] = "dispatched"
                 return results
 
-            api_key = CryptoUtils(key=KEY_FERNET_ENCRYPTION).decrypt(api_key_obj.api_key)
+            for chunk in pending:
+                summary = await run_chunk(session, chunk, context)
+                if summary["error"]:
+                    results["errors"].append(summary["error"])
+                if summary["status"] == "requeued":
+                    results["status"] = "requeued"
+                    return results
 
-            chunks_result = await session.execute(
-                select(Chunk_on_db)
-                .where(Chunk_on_db.job_id == job_uuid)
-                .order_by(Chunk_on_db.chunk_index)
-            )
-            chunks = chunks_result.scalars().all()
-    
-            results["chunks_total"] = len(chunks)
-
-            for chunk in chunks:
-                try:
-                    chunk.status = JobStatus.RUNNING
-                    await session.commit()
-                    chunk_data = {
-                        "source_data": chunk.source_data if hasattr(chunk, "source_data") and chunk.source_data else []
-                    }
-                    logger.info(f"Chunk {chunk.chunk_index} data has {len(chunk_data['source_data'])} rows")
-                    verbosity = 0.7  # Default value if not stored
-                    maxOutputTokens = 60000  # Default value if not stored
-
-                    try:
-                        try:
-                            # Validate chunk data
-                            if not chunk_data or "source_data" not in chunk_data:
-                                chunk_data = {"source_data": []}
-                                
-                            # Add fallback data if source_data is empty
-                            if not chunk_data["source_data"]:
-                                chunk_data["source_data"] = [{
-                                    "row": chunk.chunk_index,
-                                    "data": {"info": "Empty chunk data"}
-                                }]
-                                
-                            # Ensure we have a valid model name - use fallbacks if necessary
-                            fallback_models = ["gemini-1.5-flash", "gemini-pro", "gemini-pro-vision"]
-                            model_name = None
-                            
-                            # Try to get model name from database
-                            if hasattr(model, 'encoder') and model.encoder and model.encoder.strip():
-                                model_name = model.encoder
-                            else:
-                                logger.warning(f"Model {model.id} has no encoder defined, using fallback model")
-                                model_name = fallback_models[0]
-                                
-                            logger.info(f"Processing chunk {chunk.chunk_index} with model: {model_name}")
-                        
-                            # First perform model validation test with a simple prompt
-                            from llm import test_gemini_model
-                            test_result = test_gemini_model(api_key, model_name)
-                            
-                            if test_result["success"]:
-                                logger.info(f"✅ Model test successful with: {test_result['model_tested']}")
-                                # Use the model that actually worked in the test
-                                verified_model = test_result['model_tested']
-                            else:
-                                logger.warning(f"⚠️ Model test failed, using fallback: {fallback_models[0]}")
-                                verified_model = fallback_models[0]
-                            
-                            try:
-                                logger.info(f"Starting chunk processing with model: {model_name}")
-                                # Add debug info to track processing
-                                chunk_data["debug_info"] = {
-                                    "chunk_index": chunk.chunk_index,
-                                    "timestamp": datetime.datetime.now().isoformat()
-                                }
-                            
-                                processed_chunk = process_chunk(
-                                    chunk_data=chunk_data,
-                                    prompt_text=prompt.prompt_text,
-                                    model_name=model_name,
-                                    api_key=api_key,
-                                    verbosity=verbosity,
-                                    maxOutputTokens=maxOutputTokens,
-                                )
-                            
-                                # Validate the processed chunk has expected structure
-                                if not processed_chunk or not isinstance(processed_chunk, dict):
-                                    raise Exception("Invalid processed chunk response format")
-                                
-                                logger.info(f"Finished processing chunk {chunk.chunk_index} - received valid response")
-                            except Exception as model_error:
-                                logger.error(f"Error with model processing: {str(model_error)}")
-                                raise Exception(f"Model processing error: {str(model_error)}")
-                    
-                        # Check for errors in the processed chunk
-                        if "error" in processed_chunk:
-                            raise Exception(processed_chunk["error"])
-                        
-                        chunk.output_data = processed_chunk.get("output_data", [])
-                        chunk.status = JobStatus.FINISHED
-                    
-                        # Add processed data to combined results, preserving original row mapping
-                        if chunk.output_data:
-                            # Make sure each result has proper row mapping
-                            for output_item in chunk.output_data:
-                                if isinstance(output_item, dict) and 'row' in output_item:
-                                    # Ensure clean output format for Excel
-                                    clean_item = {
-                                        "row": output_item.get("row", 0),
-                                        "input": output_item.get("input", {}),
-                                        "output": output_item.get("output", "")
-                                    }
-                                    results["combined_results"].append(clean_item)
-                                
-                            # Log success for tracking
-                            logger.info(f"Added {len(chunk.output_data)} results from chunk {chunk.chunk_index} to combined results")
-                        else:
-                            logger.warning(f"Chunk {chunk.chunk_index} has no output_data to add to combined results")
-                        
-                        results["chunks_processed"] += 1
-                    except Exception as chunk_error:
-                        # Handle chunk processing errors
-                        error_msg = f"Error processing chunk {chunk.chunk_index}: {str(chunk_error)}"
-                        logger.error(error_msg)
-                        chunk.status = JobStatus.FAILED
-                        results["errors"].append(error_msg)
-                        # Try to continue with other chunks instead of failing the whole job
-    
-                except Exception as e:
-                    logger.error(f"Error processing chunk {chunk.id}: {str(e)}")
-                    chunk.status = JobStatus.FAILED
-                    results["errors"].append(f"Chunk {chunk.chunk_index}: {str(e)}")
-    
-                await session.commit()
-    
-            if results["errors"]:
-                job.job_status = JobStatus.FAILED
-                results["status"] = "failed"
-            else:
-                job.job_status = JobStatus.FINISHED
-                results["status"] = "completed"
-                
-                # Check if we have any results to process
-                if results["combined_results"]:
-                    try:
-                        # Sort by row number for proper order
-                        results["combined_results"].sort(key=lambda x: x.get("row", 0))
-                        
-                        # Clear out any existing combined_results to avoid issues
-                        job.combined_results = []
-                        await session.commit()
-                        
-                        # Format the combined results for Excel output with 'Analysis_Result' column
-                        formatted_results = []
-                        for result in results["combined_results"]:
-                            if isinstance(result, dict) and 'output' in result:
-                                # Create a simplified result structure
-                                formatted_results.append({
-                                    "row": result.get("row", 0),
-                                    "input": result.get("input", {}),
-                                    "output": result.get("output", "")
-                                })
-                    
-                        # Store the combined dataframe result with the job
-                        job.combined_results = formatted_results
-                        logger.info(f"Saving {len(formatted_results)} results to job {job_id}")
-                        logger.info(f"Successfully mapped {len(formatted_results)} results back to dataframe with 'Analysis_Result' column")
-                    except Exception as format_error:
-                        logger.error(f"Error formatting results: {str(format_error)}")
-                        results["errors"].append(f"Error formatting results: {str(format_error)}")
-                else:
-                    logger.warning(f"No results were collected for job {job_id}")
-                    job.combined_results = []
-    
-            # Make sure to commit changes
-            try:
-                await session.commit()
-                logger.info(f"Job {job_id} processed: {results['chunks_processed']}/{results['chunks_total']} chunks with {len(results.get('combined_results', []))} total rows for Excel output")
-            except Exception as commit_error:
-                logger.error(f"Error committing results: {str(commit_error)}")
-                await session.rollback()
-                results["errors"].append(f"Database error: {str(commit_error)}")
-                results["status"] = "failed"
-            
-            return results
+            return await store_job_results(session, job, chunks, results)
 
         except Exception as e:
             logger.error(f"Error in async job processing {job_id}: {str(e)}")
@@ -398,24 +888,12 @@ async def process_job_async(job_id: str):
             results["errors"].append(str(e))
 
             try:
+                await session.rollback()
                 job_uuid = uuid.UUID(job_id)
                 result = await session.execute(select(Job_on_db).where(Job_on_db.id == job_uuid))
                 job = result.scalar_one_or_none()
                 if job:
                     job.job_status = JobStatus.FAILED
-                    # If we collected any results before the error, still save them
-                    if results.get("combined_results") and not hasattr(job, "combined_results"):
-                        try:
-                            formatted_results = []
-                            for result in results["combined_results"]:
-                                if isinstance(result, dict) and 'output' in result:
-                                    formatted_results.append({
-                                        "row": result.get("row", 0),
-                                        "output": result.get("output", "")
-                                    })
-                            job.combined_results = formatted_results
-                        except Exception as recovery_error:
-                            logger.error(f"Failed to save partial results: {str(recovery_error)}")
                     await session.commit()
             except Exception as db_error:
                 logger.error(f"Failed to update job status: {str(db_error)}")
@@ -424,4 +902,88 @@ async def process_job_async(job_id: str):
                 except:
                     pass
 
-            return results
\ No newline at end of file
+            return results
+
+
+
+async def process_chunk_async(job_id: str, chunk_id: str, task_id: Optional[str] = None) -> Dict[str, Any]:
+    """Process one chunk of a job as its own task
+
+    The chunk is only run by the task process_job last claimed it for: marking it
+    RUNNING and checking the task id is one statement, so a later claim either sees
+    it running or has already superseded this task.
+    """
+    async with SessionLocal() as session:
+        job_uuid = uuid.UUID(job_id)
+        if task_id:
+            started = (await session.execute(
+                update(Chunk_on_db)
+                .where(
+                    Chunk_on_db.id == uuid.UUID(chunk_id),
+                    Chunk_on_db.task_id == task_id,
+                    Chunk_on_db.status != JobStatus.FINISHED
+                )
+                .values(status=JobStatus.RUNNING)
+                .returning(Chunk_on_db.id)
+                .execution_options(synchronize_session=False)
+            )).first()
+            await session.commit()
+        else:
+            started = True
+        job = (await session.execute(select(Job_on_db).where(Job_on_db.id == job_uuid))).scalar_one_or_none()
+        chunk = (await session.execute(
+            select(Chunk_on_db).where(Chunk_on_db.id == uuid.UUID(chunk_id), Chunk_on_db.job_id == job_uuid)
+        )).scalar_one_or_none()
+        if not job or not chunk:
+            logger.error(f"Chunk {chunk_id} of job {job_id} not found")
+            return {"chunk_id": chunk_id, "status": "failed", "rows": 0, "error": "Chunk not found"}
+        if chunk.status == JobStatus.FINISHED:
+            logger.info(f"Chunk {chunk.chunk_index} of job {job_id} already finished, skipping")
+            return {"chunk_id": chunk_id, "chunk_index": chunk.chunk_index, "status": "completed", "rows": len(chunk.output_data or []), "error": None}
+        if not started:
+            logger.info(f"Chunk {chunk.chunk_index} of job {job_id} was dispatched again, skipping task {task_id}")
+            return {"chunk_id": chunk_id, "chunk_index": chunk.chunk_index, "status": "superseded", "rows": 0, "error": None}
+
+        try:
+            context = await load_job_context(session, job)
+        except JobSetupError as setup_error:
+            chunk.status = JobStatus.FAILED
+            await session.commit()
+            return {"chunk_id": chunk_id, "status": "failed", "rows": 0, "error": str(setup_error)}
+
+        return await run_chunk(session, chunk, context)
+
+
+
+async def finalize_job_async(job_id: str, chunk_results: List[dict], waited: int = 0) -> Dict[str, Any]:
+    """Assemble combined_results and the final status once every chunk task has run
+
+    Returns a "waiting" status without touching the job while a chunk is QUEUED or
+    RUNNING, unless the finalize has already waited JOB_FINALIZE_MAX_WAIT seconds.
+    """
+    results = {
+        "job_id": job_id,
+        "status": "started",
+        "chunks_processed": 0,
+        "chunks_total": 0,
+        "errors": [r["error"] for r in chunk_results if isinstance(r, dict) and r.get("error")],
+    }
+    async with SessionLocal() as session:
+        job_uuid = uuid.UUID(job_id)
+        job = (await session.execute(select(Job_on_db).where(Job_on_db.id == job_uuid))).scalar_one_or_none()
+        if not job:
+            logger.error(f"Job {job_id} not found")
+            results["status"] = "failed"
+            results["errors"].append("Job not found")
+            return results
+
+        chunks = await load_job_chunks(session, job_uuid)
+        # Queued chunks were claimed by a later dispatch whose chord has not run them yet
+        running = sum(1 for chunk in chunks if chunk.status in (JobStatus.QUEUED, JobStatus.RUNNING))
+        if running:
+            if waited < JOB_FINALIZE_MAX_WAIT:
+                results["status"] = "waiting"
+                results["chunks_running"] = running
+                return results
+            logger.warning(f"Job {job_id}: finalizing with {running} chunks still RUNNING after {waited}s")
+        return await store_job_results(session, job, chunks, results)
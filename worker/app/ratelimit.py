@@ -0,0 +1,178 @@
+import logging
+import os
+import random
+import time
+from typing import Callable, List, Optional
+
+from shared.db.redis_engine import get_redis
+from shared.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Longest single sleep while waiting for capacity, so waiters re-check regularly
+RATE_LIMIT_MAX_SLEEP = float(os.getenv("RATE_LIMIT_MAX_SLEEP", "5"))
+# Give up waiting after this long and let the request through (the provider will 429 it)
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "300"))
+
+# Token buckets for every key in KEYS are refilled and checked together; capacity is only
+# taken when all of them can afford their cost. Returns "0" when granted, otherwise the
+# seconds to wait as a string (Lua numbers would be truncated to integers).
+# ARGV holds (capacity, refill per second, cost) for each bucket.
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local wait = 0
+local states = {}
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[(i - 1) * 3 + 1])
+    local rate = tonumber(ARGV[(i - 1) * 3 + 2])
+    local cost = math.min(tonumber(ARGV[(i - 1) * 3 + 3]), capacity)
+    local data = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    if tokens < cost then
+        wait = math.max(wait, (cost - tokens) / rate)
+    end
+    states[i] = {tokens, cost, capacity, rate}
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i = 1, #KEYS do
+    local s = states[i]
+    redis.call('HSET', KEYS[i], 'tokens', s[1] - s[2], 'ts', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(s[3] / s[4]) + 60)
+end
+return "0"
+"""
+
+# Takes ARGV's cost from each bucket in KEYS without waiting, for tokens a request used
+# beyond what it reserved. The bucket may go into debt (down to -capacity), which later
+# requests wait out. ARGV is laid out like TOKEN_BUCKET_SCRIPT's.
+TOKEN_DEBIT_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[(i - 1) * 3 + 1])
+    local rate = tonumber(ARGV[(i - 1) * 3 + 2])
+    local cost = tonumber(ARGV[(i - 1) * 3 + 3])
+    local data = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    redis.call('HSET', KEYS[i], 'tokens', math.max(-capacity, tokens - cost), 'ts', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(2 * capacity / rate) + 60)
+end
+return "0"
+"""
+
+
+class RateLimit:
+    """Requests and tokens per minute allowed for one scope, e.g. a model or an API key"""
+
+    def __init__(self, scope: str, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.scope = scope
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+    def buckets(self, tokens: int) -> List[tuple]:
+        """(redis key, capacity, refill per second, cost) for each limit that is set"""
+        buckets = []
+        if self.requests_per_minute:
+            buckets.append((f"tablemind:ratelimit:{self.scope}:rpm", self.requests_per_minute, self.requests_per_minute / 60, 1))
+        buckets.extend(self.token_buckets(tokens))
+        return buckets
+
+    def token_buckets(self, tokens: int) -> List[tuple]:
+        """buckets() of the tokens per minute limit alone"""
+        if not self.tokens_per_minute:
+            return []
+        return [(f"tablemind:ratelimit:{self.scope}:tpm", self.tokens_per_minute, self.tokens_per_minute / 60, tokens)]
+
+
+class RateLimiter:
+    """Token-bucket limiter shared by every worker process through Redis
+
+    acquire() blocks the calling row until all of its buckets have capacity. If Redis is
+    unreachable the limiter fails open so jobs keep running at the provider's own limits.
+    The wait calls `interrupt` about once a second; whatever it raises ends the wait.
+
+    acquire() can only reserve the tokens a request is estimated to send; debit() charges
+    the token buckets for the rest once the provider reports what the request used.
+    """
+
+    def __init__(self, max_sleep: float = RATE_LIMIT_MAX_SLEEP, max_wait: float = RATE_LIMIT_MAX_WAIT):
+        self.max_sleep = max_sleep
+        self.max_wait = max_wait
+        self._script = None
+        self._debit_script = None
+
+    def _try_acquire(self, buckets: List[tuple]) -> float:
+        if self._script is None:
+            self._script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return float(self._script(keys=[bucket[0] for bucket in buckets], args=self._args(buckets)))
+
+    @staticmethod
+    def _args(buckets: List[tuple]) -> List[float]:
+        args = []
+        for _, capacity, rate, cost in buckets:
+            args.extend([capacity, rate, cost])
+        return args
+
+    def debit(self, limits: Optional[List[RateLimit]], tokens: int) -> None:
+        """Take `tokens` more from the tokens per minute buckets of limits, without waiting"""
+        buckets = [bucket for limit in limits or [] for bucket in limit.token_buckets(tokens)]
+        if not buckets or tokens <= 0:
+            return
+        try:
+            if self._debit_script is None:
+                self._debit_script = get_redis().register_script(TOKEN_DEBIT_SCRIPT)
+            self._debit_script(keys=[bucket[0] for bucket in buckets], args=self._args(buckets))
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable, token usage not charged: {str(e)}")
+
+    def acquire(
+            self,
+            limits: Optional[List[RateLimit]],
+            tokens: int = 0,
+            interrupt: Optional[Callable[[], None]] = None
+        ) -> float:
+        """Wait until every limit can take one request of `tokens` tokens; returns seconds waited"""
+        buckets = [bucket for limit in limits or [] for bucket in limit.buckets(tokens)]
+        if not buckets:
+            return 0.0
+
+        started = time.monotonic()
+        while True:
+            try:
+                wait = self._try_acquire(buckets)
+            except Exception as e:
+                logger.warning(f"Rate limiter unavailable, letting request through: {str(e)}")
+                return time.monotonic() - started
+            waited = time.monotonic() - started
+            if wait <= 0:
+                if waited > 0:
+                    metrics.incr("rate_limiter.wait_seconds", round(waited, 3))
+                return waited
+            if waited >= self.max_wait:
+                logger.warning(f"Gave up waiting for rate limit capacity after {waited:.1f}s")
+                return waited
+            metrics.incr("rate_limiter.throttled")
+            # Jitter keeps waiting workers from retrying in lockstep
+            self._sleep(min(wait, self.max_sleep) * random.uniform(1.0, 1.2), interrupt)
+
+    def _sleep(self, seconds: float, interrupt: Optional[Callable[[], None]]) -> None:
+        if interrupt is None:
+            time.sleep(seconds)
+            return
+        until = time.monotonic() + seconds
+        while True:
+            interrupt()
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(1.0, remaining))
+
+
+rate_limiter = RateLimiter()
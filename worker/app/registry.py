@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from shared.db.redis_engine import get_redis
+
+from llm import test_gemini_model
+
+logger = logging.getLogger(__name__)
+
+# How long a successful probe is trusted, and after how long it is re-checked in the background
+MODEL_VALIDATION_TTL = int(os.getenv("MODEL_VALIDATION_TTL", "3600"))
+MODEL_VALIDATION_REFRESH = int(os.getenv("MODEL_VALIDATION_REFRESH", "900"))
+# Failed probes are kept briefly so a broken model is not probed again by every chunk
+MODEL_VALIDATION_FAILURE_TTL = int(os.getenv("MODEL_VALIDATION_FAILURE_TTL", "60"))
+
+
+class ModelValidationRegistry:
+    """Cache of model probe results keyed by (api key id, model encoder)
+
+    Entries live in Redis so every worker process shares them, with a process-local copy
+    in front so the hot path does not even need a Redis round-trip. Entries older than
+    `refresh_after` are still served while a background thread probes the model again.
+    """
+
+    def __init__(
+            self,
+            ttl: int = MODEL_VALIDATION_TTL,
+            refresh_after: int = MODEL_VALIDATION_REFRESH,
+            failure_ttl: int = MODEL_VALIDATION_FAILURE_TTL,
+        ):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.failure_ttl = failure_ttl
+        self._local: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _redis_key(self, api_key_id: str, model_name: str) -> str:
+        return f"tablemind:model_validation:{api_key_id}:{model_name}"
+
+    def _entry_ttl(self, entry: Dict[str, Any]) -> int:
+        return self.ttl if entry["result"].get("success") else self.failure_ttl
+
+    def _read(self, api_key_id: str, model_name: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._local.get((api_key_id, model_name))
+        if entry and now - entry["checked_at"] < self._entry_ttl(entry):
+            return entry
+
+        try:
+            raw = get_redis().get(self._redis_key(api_key_id, model_name))
+        except Exception as e:
+            logger.warning(f"Model validation cache unavailable: {str(e)}")
+            return None
+        if not raw:
+            return None
+
+        entry = json.loads(raw)
+        with self._lock:
+            self._local[(api_key_id, model_name)] = entry
+        return entry
+
+    def _write(self, api_key_id: str, model_name: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._local[(api_key_id, model_name)] = entry
+        try:
+            get_redis().set(self._redis_key(api_key_id, model_name), json.dumps(entry), ex=self._entry_ttl(entry))
+        except Exception as e:
+            logger.warning(f"Could not store model validation result: {str(e)}")
+
+    def _probe(self, api_key_id: str, api_key: str, model_name: str) -> Dict[str, Any]:
+        """Probe the model and cache the result; a probe that raises is cached as a failure"""
+        try:
+            result = test_gemini_model(api_key, model_name)
+        except Exception as e:
+            logger.warning(f"Validation probe of {model_name} raised: {str(e)}")
+            result = {"success": False, "model_tested": model_name, "error": f"Test failed: {str(e)}", "response": None}
+        entry = {"result": result, "checked_at": time.time()}
+        self._write(api_key_id, model_name, entry)
+        return entry
+
+    def _refresh_in_background(self, api_key_id: str, api_key: str, model_name: str) -> None:
+        with self._lock:
+            if (api_key_id, model_name) in self._refreshing:
+                return
+            self._refreshing.add((api_key_id, model_name))
+
+        def refresh():
+            try:
+                self._probe(api_key_id, api_key, model_name)
+            except Exception as e:
+                logger.warning(f"Background validation of {model_name} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard((api_key_id, model_name))
+
+        threading.Thread(target=refresh, name=f"validate-{model_name}", daemon=True).start()
+
+    def get(self, api_key_id: str, api_key: str, model_name: str) -> Dict[str, Any]:
+        """Return the latest probe result for the model, probing only on a cold cache
+
+        A cold probe is a blocking network call: async callers run get() in an executor.
+        """
+        entry = self._read(api_key_id, model_name)
+        if entry is None:
+            entry = self._probe(api_key_id, api_key, model_name)
+        elif time.time() - entry["checked_at"] > self.refresh_after:
+            self._refresh_in_background(api_key_id, api_key, model_name)
+        return entry["result"]
+
+
+validation_registry = ModelValidationRegistry()
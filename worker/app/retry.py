@@ -0,0 +1,185 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import TimeoutError as FuturesTimeout
+from typing import Dict, Iterator, Optional
+
+import httpx
+from google.genai.errors import APIError
+
+from shared.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Calls made for one row or batch before its error is kept as the output
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "4"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+# Consecutive transient failures of a model that open its breaker, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# Seconds between checks of a half-open breaker whose probe call has not come back yet
+CIRCUIT_PROBE_POLL = float(os.getenv("CIRCUIT_PROBE_POLL", "1"))
+
+# Provider answers worth retrying: throttling and server-side failures
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+TRANSIENT_STATUSES = ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "INTERNAL", "DEADLINE_EXCEEDED")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a model whose circuit breaker is open."""
+    pass
+
+
+def _error_chain(error: BaseException) -> Iterator[BaseException]:
+    """error and the errors it was raised from, e.g. the APIError inside a GenerationException"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def api_error(error: BaseException) -> Optional[APIError]:
+    """The google-genai APIError behind error, if the provider answered with one"""
+    return next((e for e in _error_chain(error) if isinstance(e, APIError)), None)
+
+
+def is_timeout_error(error: BaseException) -> bool:
+    return any(isinstance(e, (TimeoutError, FuturesTimeout, httpx.TimeoutException)) for e in _error_chain(error))
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a provider error is worth retrying (throttling, 5xx, timeouts, dropped connections)
+
+    Decided on the APIError code and status and on the exception types, never on the
+    message, which may quote the row being sent.
+    """
+    provider_error = api_error(error)
+    if provider_error is not None:
+        return provider_error.code in TRANSIENT_STATUS_CODES or provider_error.status in TRANSIENT_STATUSES
+    return is_timeout_error(error) or any(
+        isinstance(e, (ConnectionError, httpx.TransportError)) for e in _error_chain(error)
+    )
+
+
+class RetryPolicy:
+    """How many times a failed call is repeated and how long to wait in between
+
+    Waits grow exponentially from base_delay up to max_delay, with full jitter so rows
+    that failed together don't retry together.
+    """
+
+    def __init__(
+            self,
+            attempts: int = LLM_RETRY_ATTEMPTS,
+            base_delay: float = LLM_RETRY_BASE_DELAY,
+            max_delay: float = LLM_RETRY_MAX_DELAY
+        ):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """Seconds to wait after the given failed attempt (1-based)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Stop calling a model after repeated transient failures
+
+    closed: calls go through. After failure_threshold consecutive transient failures the
+    breaker opens and calls fail fast with CircuitOpenError for reset_timeout seconds.
+    Then one probe call is let through (half-open); its outcome closes or reopens it.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout: float = CIRCUIT_RESET_TIMEOUT
+        ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allows_calls(self) -> bool:
+        """False while open; once reset_timeout has passed a probe may go through"""
+        with self._lock:
+            return not (self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout)
+
+    def retry_in(self) -> float:
+        """Seconds until a call may go through: the rest of the reset timeout while open, a
+        short poll while a half-open probe is in flight, 0 otherwise"""
+        with self._lock:
+            if self.state == "open":
+                return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            if self.state == "half_open" and self._probing:
+                return CIRCUIT_PROBE_POLL
+            return 0.0
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit breaker open for model {self.name}")
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    raise CircuitOpenError(f"Circuit breaker half-open for model {self.name}, probe in flight")
+                self._probing = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                opened = True
+            else:
+                opened = False
+        if opened:
+            metrics.incr("llm.circuit_opened")
+            logger.warning(f"Circuit breaker opened for model {self.name} after {self.failures} failures")
+
+    def release_probe(self) -> None:
+        """Give up a half-open probe slot without a verdict, e.g. on a non-transient error"""
+        with self._lock:
+            self._probing = False
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "times_opened": self.times_opened}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model_name: str) -> CircuitBreaker:
+    """Process-wide breaker for a model"""
+    with _breakers_lock:
+        breaker = _breakers.get(model_name)
+        if breaker is None:
+            breaker = _breakers[model_name] = CircuitBreaker(model_name)
+        return breaker
+
+
+retry_policy = RetryPolicy()
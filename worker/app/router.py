@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+from hedge import latency_tracker, LATENCY_WINDOW
+from retry import get_breaker
+
+# Score multiplier for a model's fallback encoders, so they are only preferred when the
+# primary and its equivalents are clearly slower or failing
+MODEL_FALLBACK_PENALTY = float(os.getenv("MODEL_FALLBACK_PENALTY", "2"))
+# How much a model's recent error rate weighs against its latency
+MODEL_ERROR_PENALTY = float(os.getenv("MODEL_ERROR_PENALTY", "10"))
+# Outcomes older than this many seconds no longer count, so a model that failed gets traffic again
+MODEL_HEALTH_HORIZON = float(os.getenv("MODEL_HEALTH_HORIZON", "120"))
+
+
+class ModelGroup:
+    """Encoders a job may be served by: its own, its equivalents and its fallbacks
+
+    Members map to a score multiplier: 1 for the model and its equivalence group,
+    MODEL_FALLBACK_PENALTY for the model's fallback encoders.
+    """
+
+    def __init__(self, primary: str, equivalents: Iterable[str] = (), fallbacks: Iterable[str] = ()):
+        self.primary = primary
+        self.members: Dict[str, float] = {primary: 1.0}
+        for name in equivalents:
+            self.members.setdefault(name, 1.0)
+        for name in fallbacks:
+            self.members.setdefault(name, MODEL_FALLBACK_PENALTY)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+
+class ModelRouter:
+    """Pick the healthiest, fastest member of a model group for each request
+
+    Each member is scored by its median latency over the rolling window times
+    (1 + MODEL_ERROR_PENALTY * error rate over the last MODEL_HEALTH_HORIZON seconds)
+    times its group weight. Members whose
+    circuit breaker is open are skipped, so failover goes straight to a live model
+    instead of walking the list. Members without observations yet are scored as fast as
+    the best known member, so they take over as soon as the leader slows down or fails.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW, horizon: float = MODEL_HEALTH_HORIZON):
+        self.window = window
+        self.horizon = horizon
+        self._outcomes: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, success: bool) -> None:
+        with self._lock:
+            outcomes = self._outcomes.get(model_name)
+            if outcomes is None:
+                outcomes = self._outcomes[model_name] = deque(maxlen=self.window)
+            outcomes.append((time.monotonic(), 0 if success else 1))
+
+    def error_rate(self, model_name: str) -> float:
+        """Share of failed calls among the model's recent calls within the horizon"""
+        since = time.monotonic() - self.horizon
+        with self._lock:
+            recent = [failed for at, failed in self._outcomes.get(model_name, ()) if at >= since]
+        return sum(recent) / len(recent) if recent else 0.0
+
+    def choose(self, group: ModelGroup, avoid: Iterable[str] = ()) -> Optional[str]:
+        """Best member not in avoid whose breaker lets calls through, or None if there is none"""
+        avoided = set(avoid)
+        candidates = [
+            name for name in group.members
+            if name not in avoided and get_breaker(name).allows_calls()
+        ]
+        if not candidates and avoided:
+            # Every live member already failed this request: let it try them again
+            candidates = [name for name in group.members if get_breaker(name).allows_calls()]
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+
+        latencies = {name: latency_tracker.percentile(name, 0.5) for name in candidates}
+        known = [latency for latency in latencies.values() if latency is not None]
+        default = min(known) if known else 1.0
+
+        def score(name: str) -> float:
+            latency = latencies[name] if latencies[name] is not None else default
+            return latency * (1 + MODEL_ERROR_PENALTY * self.error_rate(name)) * group.members[name]
+
+        # min() keeps the first of equal scores, so the primary wins ties
+        return min(candidates, key=score)
+
+    def snapshot(self, group: ModelGroup) -> List[Dict[str, object]]:
+        return [
+            {
+                "model": name,
+                "weight": weight,
+                "latency_p50": latency_tracker.percentile(name, 0.5),
+                "error_rate": round(self.error_rate(name), 3),
+                "breaker": get_breaker(name).state,
+            }
+            for name, weight in group.members.items()
+        ]
+
+
+model_router = ModelRouter()